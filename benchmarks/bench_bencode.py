@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the m2m bencode decoder.
+
+Compares dataplicity.m2m.bencode.decode with the previous recursive decoder, on packets like those
+generated by terminal traffic (small route packets) and port forwarding (64K route packets).
+
+    python benchmarks/bench_bencode.py
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import timeit
+
+from dataplicity.m2m import bencode
+
+
+def decode_recursive(data):
+    """The previous decoder, which read a byte at a time"""
+    read = io.BytesIO(data).read
+
+    def _decode():
+        obj_type = read(1)
+        if obj_type == b'e':
+            return None
+        if obj_type == b'i':
+            number_bytes = b''
+            while 1:
+                c = read(1)
+                if not c.isdigit():
+                    break
+                number_bytes += c
+            return int(number_bytes)
+        elif obj_type == b'l':
+            l = []
+            while 1:
+                i = _decode()
+                if i is None:
+                    break
+                l.append(i)
+            return l
+        elif obj_type == b'd':
+            kv = []
+            while 1:
+                k = _decode()
+                if k is None:
+                    break
+                kv.append((k, _decode()))
+            return dict(kv)
+        else:
+            size_bytes = obj_type
+            while 1:
+                c = read(1)
+                if c == b':':
+                    break
+                size_bytes += c
+            return read(int(size_bytes))
+
+    return _decode()
+
+
+def route_packet(channel, data):
+    """Bencode a route packet ([type, channel, data])"""
+    return b''.join([b'li8ei', str(channel).encode('ascii'), b'e',
+                     str(len(data)).encode('ascii'), b':', data, b'e'])
+
+
+def best_time(decode, packet, number, **kwargs):
+    """Best time per call, in microseconds"""
+    timer = timeit.Timer(lambda: decode(packet, **kwargs))
+    return min(timer.repeat(repeat=9, number=number)) / number * 1e6
+
+
+def run(name, packet, number):
+    assert bencode.decode(packet) == decode_recursive(packet)
+    old = best_time(decode_recursive, packet, number)
+    new = best_time(bencode.decode, packet, number)
+    zero_copy = best_time(bencode.decode, packet, number, zero_copy=True)
+    print("{:<14} recursive {:8.2f}us  iterative {:8.2f}us ({:4.2f}x)  zero copy {:8.2f}us ({:4.2f}x)".format(
+          name, old, new, old / new, zero_copy, old / zero_copy))
+
+
+if __name__ == "__main__":
+    run('terminal', route_packet(3, b'\x1b[32muser@pi\x1b[0m:~$ ls -l\r\n'), 100000)
+    run('port forward', route_packet(12, os.urandom(64 * 1024)), 2000)
+    control = b'li9ei3e' + b'd4:sizeli80ei24ee4:type13:window_resizee' + b'e'
+    run('control', control, 100000)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Benchmark for JSONRPC calls, against a local HTTPS server.
+
+Compares a new connection per call (as with urlopen) with the keep-alive transport. The server
+delays each new connection by two round trips (TCP and TLS handshakes), and each request by one,
+to stand in for a high latency link. Uses plain http if openssl isn't available to make a
+certificate.
+
+    python benchmarks/bench_jsonrpc.py [CALLS] [RTT_MS]
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from dataplicity.compat import urlopen, Request
+from dataplicity.jsonrpc import JSONRPC, encode_request
+from dataplicity.transport import HTTPTransport
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    rtt = 0.0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        time.sleep(self.server.rtt * 2)
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        call = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        time.sleep(self.server.rtt)
+        response = json.dumps({"jsonrpc": "2.0", "id": call['id'], "result": "ok"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_certificate(temp_dir):
+    """Make a self-signed certificate for localhost, or return None if openssl isn't available."""
+    cert_path = os.path.join(temp_dir, 'cert.pem')
+    key_path = os.path.join(temp_dir, 'key.pem')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-keyout', key_path, '-out', cert_path, '-days', '1',
+                               '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert_path, key_path
+
+
+def call_urlopen(url, context, count):
+    for call_id in range(count):
+        body = encode_request({"jsonrpc": "2.0", "method": "bench", "params": {}, "id": call_id})
+        kwargs = {"context": context} if context is not None else {}
+        url_file = urlopen(Request(url, data=body), **kwargs)
+        try:
+            url_file.read()
+        finally:
+            url_file.close()
+
+
+def call_transport(url, context, count):
+    transport = HTTPTransport()
+    if context is not None:
+        transport.ssl_context = context
+    remote = JSONRPC(url, transport=transport)
+    for _ in range(count):
+        remote.call('bench')
+    transport.close()
+    return transport.metrics
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rtt = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.05
+
+    temp_dir = tempfile.mkdtemp('dpbench')
+    server = Server(('127.0.0.1', 0), Handler)
+    server.rtt = rtt
+    certificate = make_certificate(temp_dir)
+    context = None
+    if certificate is not None:
+        cert_path, key_path = certificate
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert_path, key_path)
+        server.socket = server_context.wrap_socket(server.socket, server_side=True)
+        context = ssl.create_default_context(cafile=cert_path)
+        url = "https://localhost:{}/jsonrpc/".format(server.server_address[1])
+    else:
+        url = "http://localhost:{}/jsonrpc/".format(server.server_address[1])
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    print("{} calls to {}, {:.0f}ms simulated round trip".format(count, url, rtt * 1000))
+    try:
+        start = time.time()
+        call_urlopen(url, context, count)
+        elapsed = time.time() - start
+        print("urlopen     {:7.1f}ms per call".format(elapsed * 1000 / count))
+
+        start = time.time()
+        metrics = call_transport(url, context, count)
+        elapsed = time.time() - start
+        print("keep-alive  {:7.1f}ms per call, {connections} connection(s)".format(elapsed * 1000 / count, **metrics))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for m2m packet creation and encoding.
+
+Compares the methods PacketMeta compiles for each packet class with the generic methods on
+PacketBaseType, which were used for every packet previously. Reports packets per second.
+
+    python benchmarks/bench_packets.py
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import timeit
+
+from dataplicity.m2m.packetbase import PacketBaseType
+from dataplicity.m2m.packets import RequestSendPacket, RoutePacket, CommandAddRoutePacket
+
+
+def generic_send(packet_cls, *args):
+    """Create and encode a packet with the generic methods"""
+    packet = packet_cls.__new__(packet_cls)
+    PacketBaseType.__init__(packet, *args)
+    return PacketBaseType.encode_binary(packet)
+
+
+def compiled_send(packet_cls, *args):
+    """Create and encode a packet with the compiled methods"""
+    return packet_cls(*args).encode_binary()
+
+
+def generic_receive(packet_cls, body):
+    """Create a packet from a decoded body with the generic methods"""
+    return PacketBaseType.from_body.__func__(packet_cls, body)
+
+
+def compiled_receive(packet_cls, body):
+    return packet_cls.from_body(body)
+
+
+def packets_per_second(f, args, number):
+    timer = timeit.Timer(lambda: f(*args))
+    return number / min(timer.repeat(repeat=9, number=number))
+
+
+def run(name, generic, compiled, args, number=100000):
+    old = packets_per_second(generic, args, number)
+    new = packets_per_second(compiled, args, number)
+    print("{:<20} generic {:10,.0f}/s  compiled {:10,.0f}/s ({:4.2f}x)".format(name, old, new, new / old))
+
+
+if __name__ == "__main__":
+    data = b'\x1b[32muser@pi\x1b[0m:~$ ls -l\r\n'
+    assert generic_send(RequestSendPacket, 3, data) == compiled_send(RequestSendPacket, 3, data)
+    run('send', generic_send, compiled_send, (RequestSendPacket, 3, data))
+    run('receive', generic_receive, compiled_receive, (RoutePacket, [3, data]))
+    add_route = (CommandAddRoutePacket, 1, b'node1', 2, b'node2', 3, b'requester', 0)
+    run('send add route', generic_send, compiled_send, add_route)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Benchmark for port forwarding, against a local HTTP server.
+
+Forwards batches of parallel HTTP requests (like a browser loading a web UI) through a
+PortForwardManager, with a loopback standing in for the M2M connection. Reports requests and
+bytes per second, and the number of threads used.
+
+    python benchmarks/bench_portforward.py [PARALLEL] [SIZE]
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from dataplicity.m2m.wsclient import Channel
+from dataplicity.portforward import PortForwardManager
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Handler(BaseHTTPRequestHandler):
+    body = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LoopbackM2M(object):
+    """Counts bytes written to channels, and waits for channels to close."""
+
+    def __init__(self):
+        self.m2m_client = self
+        self.channels = {}
+        self.bytes_received = 0
+        self.open_count = 0
+        self.condition = threading.Condition()
+
+    def get_channel(self, channel_no):
+        with self.condition:
+            self.open_count += 1
+        channel = self.channels[channel_no] = Channel(self, channel_no)
+        return channel
+
+    def channel_write(self, channel_no, data, on_sent=None):
+        with self.condition:
+            self.bytes_received += len(data)
+        if on_sent is not None:
+            on_sent()
+
+    def close_channel(self, channel_no):
+        self.channels.pop(channel_no).on_close()
+        with self.condition:
+            self.open_count -= 1
+            self.condition.notify_all()
+
+    def wait_closed(self):
+        with self.condition:
+            while self.open_count:
+                self.condition.wait()
+
+
+class Client(object):
+    def __init__(self):
+        self.m2m = LoopbackM2M()
+
+
+def run(parallel, size, rounds=20):
+    Handler.body = b'x' * size
+    server = Server(('127.0.0.1', 0), Handler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    client = Client()
+    m2m = client.m2m
+    manager = PortForwardManager(client)
+    manager.add_service('web', server.server_address[1])
+    request = b'GET / HTTP/1.0\r\nHost: localhost\r\n\r\n'
+
+    max_threads = 0
+    start = time.time()
+    channel_no = 0
+    for _ in range(rounds):
+        for _ in range(parallel):
+            channel_no += 1
+            manager.open(channel_no, service='web')
+            m2m.channels[channel_no].on_data(request)
+        max_threads = max(max_threads, threading.active_count())
+        m2m.wait_closed()
+    elapsed = time.time() - start
+    manager.close()
+    server.shutdown()
+
+    requests = parallel * rounds
+    print("{} parallel x {} bytes: {:8.0f} requests/s {:8.1f} MB/s, {} threads (including server)".format(
+        parallel, size, requests / elapsed, m2m.bytes_received / elapsed / 1e6, max_threads
+    ))
+
+
+if __name__ == "__main__":
+    parallel = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024
+    run(parallel, size)
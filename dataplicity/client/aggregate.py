@@ -0,0 +1,257 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import division
+
+"""
+Reduces samples before they are synced.
+
+A sampler may have an aggregation pipeline, configured in its [sampler:] section. Each line of
+the `aggregate` key is a stage name followed by a parameter. For example:
+
+    [sampler:vibration]
+    aggregate = deadband 0.01
+        mean 1
+        lttb 500
+
+The stages are applied in order to the timestamps and values of a snapshot, before the samples are
+sent to the server. The snapshot on disk is not modified.
+
+Stages take and return lists, or NumPy arrays (as read by `Sampler.read_samples_array`), in which
+case the work is done with array operations.
+
+"""
+
+from dataplicity import errors
+
+from itertools import groupby
+from math import floor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _is_array(column):
+    return numpy is not None and isinstance(column, numpy.ndarray)
+
+
+# maps a stage name on to a tuple of (stage function, parameter type)
+_stage_registry = {}
+
+
+def register_stage(name, param_type=float):
+    """Decorator to register an aggregation stage"""
+    def deco(f):
+        _stage_registry[name] = (f, param_type)
+        return f
+    return deco
+
+
+@register_stage('deadband')
+def deadband(timestamps, values, threshold):
+    """Drop samples that differ from the last kept sample by no more than `threshold`.
+
+    The last sample is always kept, so the most recent value is never lost.
+
+    """
+    if len(values) < 3:
+        return timestamps, values
+    if _is_array(values):
+        # Each sample depends on the last one kept, so find the indices with a single scan
+        value_list = values.tolist()
+        kept = [0]
+        last_value = value_list[0]
+        for index in range(1, len(value_list) - 1):
+            value = value_list[index]
+            if abs(value - last_value) > threshold:
+                kept.append(index)
+                last_value = value
+        kept.append(len(value_list) - 1)
+        return timestamps[kept], values[kept]
+    kept_timestamps = [timestamps[0]]
+    kept_values = [values[0]]
+    last_value = values[0]
+    for timestamp, value in zip(timestamps[1:-1], values[1:-1]):
+        if abs(value - last_value) > threshold:
+            kept_timestamps.append(timestamp)
+            kept_values.append(value)
+            last_value = value
+    kept_timestamps.append(timestamps[-1])
+    kept_values.append(values[-1])
+    return kept_timestamps, kept_values
+
+
+def _bucket_starts(timestamps, width):
+    """Get the bucket numbers of an array of timestamps, and the indices where each bucket starts"""
+    buckets = numpy.floor(timestamps / width)
+    starts = numpy.flatnonzero(numpy.diff(buckets)) + 1
+    return buckets, numpy.concatenate(([0], starts))
+
+
+def _buckets(timestamps, values, width, reduce, ufunc=None):
+    """Reduce samples in consecutive time buckets of `width` seconds.
+
+    The timestamp of each reduced sample is the start of the bucket. Arrays are reduced with
+    `ufunc.reduceat`, if given.
+
+    """
+    if width <= 0:
+        raise ValueError("bucket width must be positive")
+    if _is_array(timestamps) and ufunc is not None:
+        if not len(timestamps):
+            return timestamps, values
+        buckets, starts = _bucket_starts(timestamps, width)
+        return buckets[starts] * width, ufunc.reduceat(values, starts)
+    bucket_timestamps = []
+    bucket_values = []
+    samples = zip(timestamps, values)
+    for bucket, bucket_samples in groupby(samples, lambda sample: floor(sample[0] / width)):
+        bucket_timestamps.append(bucket * width)
+        bucket_values.append(reduce([value for _, value in bucket_samples]))
+    return bucket_timestamps, bucket_values
+
+
+@register_stage('min')
+def bucket_min(timestamps, values, width):
+    """Minimum value in each bucket"""
+    return _buckets(timestamps, values, width, min, numpy and numpy.minimum)
+
+
+@register_stage('max')
+def bucket_max(timestamps, values, width):
+    """Maximum value in each bucket"""
+    return _buckets(timestamps, values, width, max, numpy and numpy.maximum)
+
+
+@register_stage('mean')
+def bucket_mean(timestamps, values, width):
+    """Mean value in each bucket"""
+    if _is_array(timestamps) and width > 0:
+        if not len(timestamps):
+            return timestamps, values
+        buckets, starts = _bucket_starts(timestamps, width)
+        # Summed as floats, so small integer types don't overflow
+        sums = numpy.add.reduceat(values, starts, dtype=numpy.float64)
+        counts = numpy.diff(numpy.append(starts, len(values)))
+        return buckets[starts] * width, sums / counts
+    return _buckets(timestamps, values, width, lambda bucket_values: sum(bucket_values) / len(bucket_values))
+
+
+@register_stage('lttb', param_type=int)
+def lttb(timestamps, values, threshold):
+    """Decimate to `threshold` samples with the Largest-Triangle-Three-Buckets algorithm.
+
+    Keeps the first and last samples, and from each bucket in between the sample that forms the
+    largest triangle with the previously selected sample and the average of the next bucket.
+
+    """
+    count = len(timestamps)
+    if threshold >= count or threshold < 3:
+        return timestamps, values
+    if _is_array(timestamps):
+        return _lttb_array(timestamps, values, threshold)
+
+    kept_timestamps = [timestamps[0]]
+    kept_values = [values[0]]
+    bucket_size = (count - 2) / (threshold - 2)
+    selected = 0
+
+    for bucket in range(threshold - 2):
+        start = int(floor(bucket * bucket_size)) + 1
+        end = int(floor((bucket + 1) * bucket_size)) + 1
+
+        # Average of the next bucket (or the last sample, for the final bucket)
+        next_start = end
+        next_end = min(int(floor((bucket + 2) * bucket_size)) + 1, count)
+        next_count = next_end - next_start
+        average_timestamp = sum(timestamps[next_start:next_end]) / next_count
+        average_value = sum(values[next_start:next_end]) / next_count
+
+        selected_timestamp = timestamps[selected]
+        selected_value = values[selected]
+        max_area = -1.0
+        max_index = start
+        for index in range(start, end):
+            area = abs((selected_timestamp - average_timestamp) * (values[index] - selected_value) -
+                       (selected_timestamp - timestamps[index]) * (average_value - selected_value))
+            if area > max_area:
+                max_area = area
+                max_index = index
+        kept_timestamps.append(timestamps[max_index])
+        kept_values.append(values[max_index])
+        selected = max_index
+
+    kept_timestamps.append(timestamps[-1])
+    kept_values.append(values[-1])
+    return kept_timestamps, kept_values
+
+
+def _lttb_array(timestamps, values, threshold):
+    """LTTB for NumPy arrays, with the triangle areas of each bucket calculated together"""
+    count = len(timestamps)
+    # As floats, so differences of unsigned values don't wrap
+    x = timestamps.astype(numpy.float64)
+    y = values.astype(numpy.float64)
+    kept = [0]
+    bucket_size = (count - 2) / (threshold - 2)
+    selected = 0
+
+    for bucket in range(threshold - 2):
+        start = int(floor(bucket * bucket_size)) + 1
+        end = int(floor((bucket + 1) * bucket_size)) + 1
+        next_start = end
+        next_end = min(int(floor((bucket + 2) * bucket_size)) + 1, count)
+        average_timestamp = x[next_start:next_end].mean()
+        average_value = y[next_start:next_end].mean()
+
+        selected_timestamp = x[selected]
+        selected_value = y[selected]
+        areas = numpy.abs((selected_timestamp - average_timestamp) * (y[start:end] - selected_value) -
+                          (selected_timestamp - x[start:end]) * (average_value - selected_value))
+        selected = start + int(numpy.argmax(areas))
+        kept.append(selected)
+
+    kept.append(count - 1)
+    return timestamps[kept], values[kept]
+
+
+class Aggregator(object):
+    """A pipeline of aggregation stages"""
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def __repr__(self):
+        return "Aggregator({})".format(", ".join("{} {}".format(name, param) for name, _, param in self.stages))
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Create an aggregator from a list of stage strings, e.g. ['mean 60', 'lttb 500']"""
+        stages = []
+        for stage in spec:
+            name, _, param = stage.partition(' ')
+            try:
+                stage_function, param_type = _stage_registry[name]
+            except KeyError:
+                raise errors.ConfigError("unknown aggregate stage '{}', should be one of {}".format(name, ", ".join(sorted(_stage_registry))))
+            try:
+                param = param_type(param.strip())
+            except ValueError:
+                raise errors.ConfigError("aggregate stage '{}' requires a numeric parameter".format(stage))
+            stages.append((name, stage_function, param))
+        return cls(stages)
+
+    @classmethod
+    def init_from_conf(cls, conf, section):
+        """Create an aggregator from the 'aggregate' key in a section, or return None"""
+        spec = conf.get_list(section, 'aggregate', None)
+        if not spec:
+            return None
+        return cls.from_spec(spec)
+
+    def __call__(self, timestamps, values):
+        """Run the pipeline, return a tuple of (timestamps, values)"""
+        for _, stage_function, param in self.stages:
+            timestamps, values = stage_function(timestamps, values, param)
+        return timestamps, values
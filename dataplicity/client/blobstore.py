@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Stores binary attachments as files named by the SHA-256 of their contents.
+
+Identical attachments are stored once. Data is copied in chunks, so attachments never have to
+be held in memory.
+
+"""
+
+from hashlib import sha256
+import os
+import tempfile
+import time
+
+
+class BlobStore(object):
+    """A directory of content-addressed blobs"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def __repr__(self):
+        return "BlobStore({!r})".format(self.path)
+
+    def __contains__(self, blob_id):
+        return os.path.exists(self.get_path(blob_id))
+
+    def get_path(self, blob_id):
+        """Get the path to a blob"""
+        return os.path.join(self.path, blob_id)
+
+    def get_size(self, blob_id):
+        return os.path.getsize(self.get_path(blob_id))
+
+    def blob_ids(self, min_age=None):
+        """Get a list of stored blob ids, optionally only those not stored in the last `min_age` seconds"""
+        blob_ids = [filename for filename in os.listdir(self.path) if not filename.endswith('.tmp')]
+        if min_age is None:
+            return blob_ids
+        stored_before = time.time() - min_age
+        old_blob_ids = []
+        for blob_id in blob_ids:
+            try:
+                if os.path.getmtime(self.get_path(blob_id)) < stored_before:
+                    old_blob_ids.append(blob_id)
+            except OSError:
+                # Removed since listing
+                pass
+        return old_blob_ids
+
+    def _touch(self, blob_path):
+        """Refresh the modified time of a blob that has been stored again"""
+        try:
+            os.utime(blob_path, None)
+        except OSError:
+            pass
+
+    def add_file(self, input_file):
+        """Copy a file object in to the store, return a tuple of (blob id, size)"""
+        hasher = sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as blob_file:
+                while 1:
+                    chunk = input_file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    blob_file.write(chunk)
+                    size += len(chunk)
+            blob_id = hasher.hexdigest()
+            blob_path = self.get_path(blob_id)
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+                self._touch(blob_path)
+            else:
+                os.rename(tmp_path, blob_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_id, size
+
+    def add_path(self, path):
+        """Copy a file in to the store, return a tuple of (blob id, size)"""
+        with open(path, 'rb') as input_file:
+            return self.add_file(input_file)
+
+    def add_bytes(self, data):
+        """Store bytes, return a tuple of (blob id, size)"""
+        blob_id = sha256(data).hexdigest()
+        blob_path = self.get_path(blob_id)
+        if os.path.exists(blob_path):
+            self._touch(blob_path)
+        else:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as blob_file:
+                blob_file.write(data)
+            os.rename(tmp_path, blob_path)
+        return blob_id, len(data)
+
+    def open(self, blob_id):
+        """Open a blob for reading"""
+        return open(self.get_path(blob_id), 'rb')
+
+    def remove(self, blob_id):
+        """Remove a blob, if it exists"""
+        try:
+            os.remove(self.get_path(blob_id))
+        except OSError:
+            pass
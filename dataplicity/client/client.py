@@ -1,7 +1,7 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-from dataplicity.client import device_meta, settings, serial, tools
+from dataplicity.client import device_meta, settings, serial, tools, sampleencoding
 from dataplicity.client.task import TaskManager
 from dataplicity.client.sampler import SamplerManager
 from dataplicity.client.livesettings import LiveSettingsManager
@@ -11,7 +11,9 @@ from dataplicity.portforward import PortForwardManager
 from dataplicity.rc.manager import RCManager
 from dataplicity.client.exceptions import ForceRestart
 from dataplicity.jsonrpc import JSONRPC, JSONRPCError
+from dataplicity.transport import HTTPTransport
 from dataplicity import constants
+from dataplicity import errors
 from dataplicity import firmware
 
 
@@ -94,6 +96,8 @@ class Client(object):
         self.disable_sync = disable_sync
         self.rpc_url = rpc_url
         self._sent_meta = False
+        # Sample encodings supported by the server (None if we haven't asked)
+        self._sample_encodings = None
 
         self._sync_lock = Lock()
         self.exit_event = Event()
@@ -116,7 +120,22 @@ class Client(object):
             self.push_url = conf.get('server',
                                      'push_url',
                                      constants.PUSH_URL)
-            self.remote = JSONRPC(self.rpc_url)
+            # Connections to the api are kept open between syncs (a transport of our own, so the
+            # settings and connections aren't shared with other clients in the process)
+            transport = HTTPTransport(timeout=conf.get_float('server', 'timeout', 60.0),
+                                      retries=conf.get_integer('server', 'retries', 3))
+            # If the server supports it, sync batches of at least compress_threshold bytes may be compressed
+            compression = conf.get('server', 'compression', 'none')
+            if compression not in ('gzip', 'deflate', 'none'):
+                raise errors.ConfigError("[server]/compression should be 'gzip', 'deflate' or 'none'")
+            self.remote = JSONRPC(self.rpc_url,
+                                  transport=transport,
+                                  compression=None if compression == 'none' else compression,
+                                  compress_threshold=conf.get_integer('server', 'compress_threshold', 1024))
+
+            self.sample_encoding = conf.get('samplers', 'encoding', None)
+            if self.sample_encoding not in (None, sampleencoding.ENCODING):
+                raise errors.ConfigError("[samplers]/encoding should be '{}'".format(sampleencoding.ENCODING))
 
             self.serial = tools.resolve_value(conf.get('device', 'serial', None))
             if self.serial is None:
@@ -155,6 +174,7 @@ class Client(object):
 
             self.sample_now = self.samplers.sample_now
             self.sample = self.samplers.sample
+            self.add_samples = self.samplers.add_samples
 
             self.get_timeline = self.timelines.get_timeline
         except:
@@ -168,6 +188,20 @@ class Client(object):
                 self.m2m.close()
             except Exception:
                 self.log.exception('error closing m2m')
+        try:
+            self.samplers.close()
+        except Exception:
+            self.log.exception('error closing samplers')
+        try:
+            self.timelines.close()
+        except Exception:
+            self.log.exception('error closing timelines')
+        try:
+            self.port_forward.close()
+        except Exception:
+            self.log.exception('error closing port forward')
+        # Close connections kept open to the api
+        self.remote.transport.close()
 
     def connect_wait(self, closing_event, sync_func):
         def do_wait():
@@ -274,20 +308,52 @@ class Client(object):
             self.log.debug('server received m2m identity %s', identity)
             return identity
 
+    def _sync_sample_encodings(self, batch):
+        # Ask the server which sample encodings it supports, if we need a compact encoding
+        if self.sample_encoding is not None and self._sample_encodings is None:
+            batch.call_with_id('sample_encodings_result',
+                               'device.get_sample_encodings')
+
+    def _update_sample_encodings(self, batch):
+        if self.sample_encoding is None or self._sample_encodings is not None:
+            return
+        try:
+            self._sample_encodings = batch.get_result('sample_encodings_result') or []
+        except JSONRPCError as e:
+            # Server doesn't know about encodings, stick with JSON
+            self.log.debug('server does not support sample encodings (%s)', e)
+            self._sample_encodings = []
+        except Exception:
+            self.log.exception('error getting sample encodings')
+        else:
+            if self.sample_encoding in self._sample_encodings:
+                self.log.debug("using '%s' sample encoding", self.sample_encoding)
+
     def _sync_samples(self, batch):
         # Add samples
         samplers_updated = []
+        # Samples are sent as JSON unless the server supports the configured encoding
+        if self.sample_encoding in (self._sample_encodings or ()):
+            encoding = self.sample_encoding
+        else:
+            encoding = None
         try:
             for sampler_name in self.samplers.enumerate_samplers():
                 sampler = self.samplers.get_sampler(sampler_name)
-                samples = sampler.snapshot_samples()
-                if samples:
+                samples = sampler.snapshot_samples_array()
+                if len(samples):
+                    timestamps, values = sampler.aggregate(samples)
+                    if encoding is not None:
+                        samples_params = {"samples": sampleencoding.encode_samples(timestamps, values),
+                                          "encoding": encoding}
+                    else:
+                        samples_params = {"samples": list(zip(timestamps, values))}
                     batch.call_with_id("samples.{}".format(sampler_name),
                                        "device.add_samples",
                                        device_class=self.device_class,
                                        serial=self.serial,
                                        sampler_name=sampler_name,
-                                       samples=samples)
+                                       **samples_params)
                     samplers_updated.append(sampler_name)
                 else:
                     sampler.remove_snapshot()
@@ -322,14 +388,6 @@ class Client(object):
                     self.livesettings.update(changed_conf, self.tasks)
                     changed_conf_names = ", ".join(sorted(changed_conf.keys()))
                     self.log.debug("settings file(s) changed: {}".format(changed_conf_names))
-
-            for timeline in self.timelines:
-                try:
-                    timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
-                except:
-                    self.log.exception('error sending timeline')
-                else:
-                    timeline.clear_events(timeline_result)
         except:
             self.log.error('error updating conf in sync')
 
@@ -370,17 +428,66 @@ class Client(object):
                 uname=meta['uname']
             )
 
-    def _sync_timelines(self, batch):
-        # Update timeline(s)
+    def _sync_timelines(self, batch, cursors):
+        """Add the next page of events to the batch, return the timelines that were sent.
+
+        Pages from each timeline are added until the batch reaches the page limits.
+
+        """
+        timelines_sent = []
+        page_events = self.timelines.page_events
+        page_bytes = self.timelines.page_bytes
         try:
-            if self.timelines:
-                for timeline in self.timelines:
-                    batch.call_with_id('timeline_result_{}'.format(timeline.name),
-                                       'device.add_events',
-                                       name=timeline.name,
-                                       events=timeline.get_events())
+            for cursor in cursors:
+                if cursor.exhausted:
+                    continue
+                events, size = cursor.next_page(page_events, page_bytes, force=not timelines_sent)
+                if not events:
+                    break
+                timeline = cursor.timeline
+                batch.call_with_id('timeline_result_{}'.format(timeline.name),
+                                   'device.add_events',
+                                   name=timeline.name,
+                                   events=events)
+                timelines_sent.append(timeline)
+                page_events -= len(events)
+                page_bytes -= size
+                if page_events <= 0 or page_bytes <= 0:
+                    break
         except:
             self.log.exception('error syncing timelines')
+        return timelines_sent
+
+    def _update_timelines(self, batch, timelines_sent):
+        """Clear events acknowledged by the server, return False if any timeline failed"""
+        success = True
+        for timeline in timelines_sent:
+            try:
+                timeline_result = batch.get_result('timeline_result_{}'.format(timeline.name))
+            except:
+                self.log.exception('error sending timeline')
+                success = False
+            else:
+                timeline.clear_events(timeline_result)
+        return success
+
+    def _sync_timeline_pages(self, cursors, sync_id):
+        """Send events that didn't fit in the sync batch, a page per request"""
+        for _ in range(self.timelines.max_pages - 1):
+            if all(cursor.exhausted for cursor in cursors):
+                break
+            with self.remote.batch() as batch:
+                batch.call_with_id('authenticate_result',
+                                   'device.check_auth',
+                                   device_class=self.device_class,
+                                   serial=self.serial,
+                                   auth_token=self.auth_token,
+                                   sync_id=sync_id)
+                timelines_sent = self._sync_timelines(batch, cursors)
+            batch.get_result('authenticate_result')
+            # Stop if the server rejected a page, the events will be sent again next sync
+            if not self._update_timelines(batch, timelines_sent):
+                break
 
     def _sync_m2m(self, batch):
         try:
@@ -497,9 +604,11 @@ class Client(object):
                 if not self._sent_meta:
                     self.log.debug('sending meta')
                     self._sync_meta(batch)
+                self._sync_sample_encodings(batch)
                 samplers_updated = self._sync_samples(batch)
                 self._sync_conf(batch)
-                self._sync_timelines(batch)
+                timeline_cursors = [timeline.get_cursor() for timeline in self.timelines]
+                timelines_sent = self._sync_timelines(batch, timeline_cursors)
 
             # get_result will throw exceptions with (hopefully) helpful error messages if they fail
             batch.get_result('authenticate_result')
@@ -524,8 +633,14 @@ class Client(object):
                     # Success! Don't send again.
                     self._sent_meta = True
 
+            self._update_sample_encodings(batch)
             self._update_samples(batch, samplers_updated)
             self._update_conf(batch)
+            if self._update_timelines(batch, timelines_sent):
+                try:
+                    self._sync_timeline_pages(timeline_cursors, sync_id)
+                except Exception:
+                    self.log.exception('error syncing timeline pages')
 
             ellapsed = time() - start
 
@@ -0,0 +1,457 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+An append-only, indexed log of keyed records.
+
+Records are appended to segment files in a directory. Each record has the following layout:
+
+    crc32       uint32, of everything following the crc
+    length      uint32, length of the payload
+    type        uint8, RECORD_EVENT or RECORD_TOMBSTONE
+    key length  uint16
+    key         utf-8
+    payload     bytes
+
+An in-memory index maps keys on to the location of their most recent record, so counting,
+enumerating and deleting records never requires a directory scan. Deleting a record appends a
+tombstone. Once enough of the log is garbage (overwritten or deleted records), the sealed segments
+are compacted in a background thread.
+
+Segment files are named <number>.<generation>.log, and are replayed in that order. A compacted
+segment takes the number of the last segment it replaces with the next generation, so if the
+process is interrupted before the old segments are deleted, replaying the log gives the same
+result.
+
+Other processes (e.g. `dataplicity event`) may append to the same log. A log notices records
+appended by another process the next time it is accessed.
+
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from zlib import crc32
+import errno
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+log = logging.getLogger('dataplicity')
+
+
+RECORD_EVENT = 1
+RECORD_TOMBSTONE = 2
+
+_header_struct = struct.Struct(b'<IIBH')
+HEADER_SIZE = _header_struct.size
+
+
+class EventLogError(Exception):
+    pass
+
+
+def _segment_filename(segment):
+    return "{:08d}.{:04d}.log".format(*segment)
+
+
+def _parse_segment_filename(filename):
+    """Get a segment tuple from a filename, or None if it is not a segment"""
+    if not filename.endswith('.log'):
+        return None
+    try:
+        number, generation = filename[:-4].split('.')
+        return int(number), int(generation)
+    except ValueError:
+        return None
+
+
+def _tmp_file_pid(filename):
+    """Get the pid of the process writing a compaction tmp file, or None if it is not one"""
+    if not filename.endswith('.tmp'):
+        return None
+    try:
+        return int(filename[:-4].rsplit('.', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _pid_running(pid):
+    """Check if a process exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def make_record(record_type, key, payload=b''):
+    """Encode a single record"""
+    key_bytes = key.encode('utf-8')
+    body = struct.pack(b'<B', record_type) + struct.pack(b'<H', len(key_bytes))
+    crc = crc32(payload, crc32(key_bytes, crc32(body))) & 0xffffffff
+    return _header_struct.pack(crc, len(payload), record_type, len(key_bytes)) + key_bytes + payload
+
+
+def iter_records(data, offset=0):
+    """Yield (offset, size, record type, key, payload) for each record in `data`.
+
+    Stops at the end of the data, or at the first truncated or corrupt record.
+
+    """
+    data_size = len(data)
+    while offset + HEADER_SIZE <= data_size:
+        crc, payload_size, record_type, key_size = _header_struct.unpack_from(data, offset)
+        key_start = offset + HEADER_SIZE
+        payload_start = key_start + key_size
+        end = payload_start + payload_size
+        if end > data_size:
+            return
+        body = data[offset + 8:offset + HEADER_SIZE]
+        key_bytes = data[key_start:payload_start]
+        payload = data[payload_start:end]
+        if crc32(payload, crc32(key_bytes, crc32(body))) & 0xffffffff != crc:
+            return
+        yield offset, end - offset, record_type, key_bytes.decode('utf-8'), payload
+        offset = end
+
+
+class EventLog(object):
+    """An append-only log of keyed records, with an in-memory index"""
+
+    def __init__(self, path, segment_size=1024 * 1024, compact_ratio=0.5, compact_min_bytes=64 * 1024, background=True):
+        self.path = path
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.background = background
+
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compact_thread = None
+        self._fd = None
+        self._lock_fd = None
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        if fcntl is not None:
+            self._lock_fd = os.open(os.path.join(path, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        self._load()
+
+    def __repr__(self):
+        return "EventLog({!r})".format(self.path)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._refresh()
+            return key in self._index
+
+    @contextmanager
+    def _file_lock(self, exclusive=False):
+        """Lock the log against compaction in another process"""
+        if self._lock_fd is None:
+            yield
+            return
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, _segment_filename(segment))
+
+    def _load(self):
+        """Build the index by replaying all segments"""
+        with self._lock, self._file_lock():
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._index = OrderedDict()
+            self._sizes = {}
+            self._live = {}
+            segments = sorted(filter(None, (_parse_segment_filename(filename)
+                                            for filename in os.listdir(self.path))))
+            self._segments = []
+            clean = True
+            for segment in segments:
+                self._segments.append(segment)
+                self._sizes[segment] = self._live[segment] = 0
+                clean = self._replay(segment)
+                if not clean:
+                    log.warning('%s has a corrupt record at offset %s', self._segment_path(segment), self._sizes[segment])
+            if not self._segments:
+                self._open_active((0, 0))
+            elif not clean or self._sizes[self._segments[-1]] >= self.segment_size:
+                self._open_active((self._segments[-1][0] + 1, 0))
+            else:
+                self._open_active(self._segments[-1])
+
+    def _open_active(self, segment):
+        """Open a segment for appending"""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._active = segment
+        if segment not in self._sizes:
+            self._segments.append(segment)
+            self._sizes[segment] = self._live[segment] = 0
+            self._replay(segment)
+
+    def _replay(self, segment, offset=0):
+        """Apply records in a segment from `offset`, return False if the segment has a bad tail"""
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = offset
+        for record_offset, size, record_type, key, _ in iter_records(data):
+            self._apply(segment, offset + record_offset, size, record_type, key)
+            end = offset + record_offset + size
+        self._sizes[segment] = end
+        return end - offset == len(data)
+
+    def _apply(self, segment, offset, size, record_type, key):
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._live[previous[0]] -= previous[2]
+        if record_type == RECORD_EVENT:
+            self._index[key] = (segment, offset, size)
+            self._live[segment] += size
+
+    def _refresh(self):
+        """Index any records written by another process"""
+        stat = os.fstat(self._fd)
+        if not stat.st_nlink:
+            # Segment was compacted by another process
+            self._load()
+            return
+        if stat.st_size > self._sizes[self._active]:
+            self._replay(self._active, self._sizes[self._active])
+        next_segment = (self._active[0] + 1, 0)
+        while os.path.exists(self._segment_path(next_segment)):
+            self._open_active(next_segment)
+            next_segment = (self._active[0] + 1, 0)
+
+    def _append(self, records):
+        """Append encoded records as a single write"""
+        data = b''.join(record for record, _, _ in records)
+        with self._file_lock():
+            self._refresh()
+            written = os.write(self._fd, data)
+            if written != len(data):
+                raise EventLogError("short write to {}".format(self._segment_path(self._active)))
+            end = os.lseek(self._fd, 0, os.SEEK_CUR)
+            offset = end - len(data)
+            if offset == self._sizes[self._active]:
+                for record, record_type, key in records:
+                    self._apply(self._active, offset, len(record), record_type, key)
+                    offset += len(record)
+                self._sizes[self._active] = end
+            else:
+                # Another process appended since we last looked
+                self._replay(self._active, self._sizes[self._active])
+            if end >= self.segment_size:
+                self._open_active((self._active[0] + 1, 0))
+
+    def put(self, key, payload):
+        """Write a record, replacing any existing record with the same key"""
+        with self._lock:
+            self._refresh()
+            replaced = key in self._index
+            self._append([(make_record(RECORD_EVENT, key, payload), RECORD_EVENT, key)])
+        if replaced:
+            self._check_compact()
+
+    def _read(self, locations):
+        """Read payloads for a list of (segment, offset, size), grouped by segment"""
+        payloads = [None] * len(locations)
+        by_segment = {}
+        for position, location in enumerate(locations):
+            by_segment.setdefault(location[0], []).append((location[1], location[2], position))
+        for segment, reads in by_segment.items():
+            with open(self._segment_path(segment), 'rb') as f:
+                for offset, size, position in sorted(reads):
+                    f.seek(offset)
+                    record = f.read(size)
+                    _, _, _, key_size = _header_struct.unpack_from(record)
+                    payloads[position] = record[HEADER_SIZE + key_size:]
+        return payloads
+
+    def _read_index(self, keys=None):
+        with self._lock:
+            for attempt in (1, 2):
+                self._refresh()
+                if keys is None:
+                    items = list(self._index.items())
+                else:
+                    items = [(key, self._index[key]) for key in keys if key in self._index]
+                try:
+                    payloads = self._read([location for _, location in items])
+                except (IOError, OSError):
+                    if attempt == 2:
+                        raise
+                    # A segment was removed by compaction in another process
+                    self._load()
+                else:
+                    return [(key, payload) for (key, _), payload in zip(items, payloads)]
+
+    def get(self, key):
+        """Get the payload for a key, or raise KeyError"""
+        items = self._read_index([key])
+        if not items:
+            raise KeyError(key)
+        return items[0][1]
+
+    def keys(self):
+        """Get a list of keys, in the order they were written"""
+        with self._lock:
+            self._refresh()
+            return list(self._index.keys())
+
+    def items(self, keys=None):
+        """Get a list of (key, payload), in the order they were written (or the order of `keys`)"""
+        return self._read_index(keys)
+
+    def delete(self, keys):
+        """Delete records, return the number of records deleted"""
+        with self._lock:
+            self._refresh()
+            records = [(make_record(RECORD_TOMBSTONE, key), RECORD_TOMBSTONE, key)
+                       for key in set(keys) if key in self._index]
+            if records:
+                self._append(records)
+        if records:
+            self._check_compact()
+        return len(records)
+
+    def clear(self):
+        """Delete all records"""
+        return self.delete(self.keys())
+
+    @property
+    def garbage(self):
+        """Number of bytes of overwritten or deleted records"""
+        with self._lock:
+            return sum(self._sizes[segment] - self._live[segment] for segment in self._segments)
+
+    def _check_compact(self):
+        """Compact if enough of the log is garbage"""
+        with self._lock:
+            total = sum(self._sizes[segment] for segment in self._segments)
+            garbage = self.garbage
+        if garbage < self.compact_min_bytes or garbage < total * self.compact_ratio:
+            return
+        if not self.background:
+            self.compact()
+        elif self._compact_thread is None or not self._compact_thread.is_alive():
+            self._compact_thread = threading.Thread(target=self._compact_background,
+                                                    name="compact {}".format(self.path))
+            self._compact_thread.daemon = True
+            self._compact_thread.start()
+
+    def _compact_background(self):
+        try:
+            self.compact()
+        except Exception:
+            log.exception('error compacting %s', self.path)
+
+    def compact(self):
+        """Rewrite sealed segments, keeping only live records"""
+        with self._compact_lock:
+            with self._lock:
+                self._refresh()
+                if self._sizes[self._active]:
+                    self._open_active((self._active[0] + 1, 0))
+                sealed = self._segments[:-1]
+                if not sealed:
+                    return
+                sealed_set = set(sealed)
+                snapshot = [(key, location) for key, location in self._index.items()
+                            if location[0] in sealed_set]
+            target = (sealed[-1][0], sealed[-1][1] + 1)
+            target_path = self._segment_path(target)
+            tmp_path = "{}.{}.tmp".format(target_path, os.getpid())
+
+            # Copy live records without holding the lock, so writes may continue
+            new_locations = {}
+            with open(tmp_path, 'wb') as out:
+                try:
+                    position = 0
+                    for segment in sealed:
+                        with open(self._segment_path(segment), 'rb') as f:
+                            for key, location in snapshot:
+                                if location[0] != segment:
+                                    continue
+                                f.seek(location[1])
+                                out.write(f.read(location[2]))
+                                new_locations[key] = (location, position)
+                                position += location[2]
+
+                    with self._lock, self._file_lock(exclusive=True):
+                        # Pick up records appended to sealed segments by other processes
+                        for segment in sealed:
+                            self._replay(segment, self._sizes[segment])
+                        self._refresh()
+                        repointed = {}
+                        for key, location in self._index.items():
+                            if location[0] not in sealed_set:
+                                continue
+                            copied = new_locations.get(key)
+                            if copied is None or copied[0] != location:
+                                with open(self._segment_path(location[0]), 'rb') as f:
+                                    f.seek(location[1])
+                                    out.write(f.read(location[2]))
+                                copied = (location, position)
+                                position += location[2]
+                            repointed[key] = (target, copied[1], location[2])
+                        out.flush()
+                        os.fsync(out.fileno())
+                        os.rename(tmp_path, target_path)
+
+                        self._index.update(repointed)
+
+                        for segment in sealed:
+                            del self._sizes[segment]
+                            del self._live[segment]
+                        self._segments = [target] + self._segments[len(sealed):]
+                        self._sizes[target] = self._live[target] = position
+                        for segment in sealed:
+                            os.remove(self._segment_path(segment))
+                        # Remove output of compactions that were interrupted, but not of those
+                        # still copying records in another process
+                        for filename in os.listdir(self.path):
+                            pid = _tmp_file_pid(filename)
+                            if pid is not None and not _pid_running(pid):
+                                os.remove(os.path.join(self.path, filename))
+                except:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            log.debug('compacted %s segment(s) in %s to %s bytes', len(sealed), self.path, position)
+
+    def close(self):
+        """Wait for any compaction and close files"""
+        thread = self._compact_thread
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
@@ -5,8 +5,16 @@ from __future__ import unicode_literals
 import subprocess
 
 from dataplicity import constants
+from dataplicity import errors
+from dataplicity.compat import PY2
 from dataplicity.m2m import WSClient, EchoService
 from dataplicity.m2m.remoteprocess import RemoteProcess
+from dataplicity.m2m.scheduler import PRIORITY_INTERACTIVE
+from dataplicity.reactor import Reactor
+if PY2:
+    AsyncWSClient = None
+else:
+    from dataplicity.m2m.asyncclient import AsyncWSClient
 
 import os
 import threading
@@ -16,13 +24,21 @@ log = logging.getLogger('dataplicity.m2m')
 
 
 class Terminal(object):
-    """Configured terminal information."""
+    """Configured terminal information.
 
-    def __init__(self, name, command, user=None, group=None):
+    Terminals opened with a session name are detached when their channel (or the m2m
+    connection) closes, and reattached if the same session is opened within `detach_timeout`
+    seconds. Up to `scrollback` bytes of output are replayed to the new channel.
+
+    """
+
+    def __init__(self, name, command, user=None, group=None, detach_timeout=300.0, scrollback=64 * 1024):
         self.name = name
         self.command = command
         self.user = user
         self.group = group
+        self.detach_timeout = detach_timeout
+        self.scrollback = scrollback
         self.processes = []
 
     def __repr__(self):
@@ -32,19 +48,44 @@ class Terminal(object):
         """Remove closed processes."""
         self.processes[:] = [process for process in self.processes if not process.is_closed]
 
-    def launch(self, channel, size=None):
-        """Launch a terminal instance."""
+    def get_session(self, session):
+        """Get the running process for a session, or None."""
+        for process in self.processes:
+            if process.session == session and not process.is_closed:
+                return process
+        return None
+
+    def launch(self, channel, reactor, size=None, session=None):
+        """Launch a terminal instance, with its pty handled by `reactor`.
+
+        If `session` is given, and the session is still running, attach it to `channel`
+        rather than launching a new process.
+
+        """
+        self._prune_closed()
+        if not self.detach_timeout:
+            session = None
+        if session is not None:
+            remote_process = self.get_session(session)
+            if remote_process is not None:
+                log.debug('attaching terminal %s session %s', self.name, session)
+                remote_process.attach(channel, size=size)
+                return
         if size is None:
             size = [80, 24]
-        self._prune_closed()
         log.debug('opening terminal %s', self.name)
         remote_process = None
         try:
             remote_process = RemoteProcess(self.command,
                                            channel,
+                                           reactor,
                                            user=self.user,
                                            group=self.group,
-                                           size=size)
+                                           size=size,
+                                           session=session,
+                                           detach_timeout=self.detach_timeout,
+                                           scrollback=self.scrollback)
+            remote_process.start()
         except:
             log.exception("error launching terminal process '%s'", self.command)
             if remote_process is not None:
@@ -54,8 +95,6 @@ class Terminal(object):
                     pass
         else:
             self.processes.append(remote_process)
-            process_thread = threading.Thread(target=remote_process.run)
-            process_thread.start()
             log.info("launched remote process %r over %r", self, channel)
 
     def close(self):
@@ -70,13 +109,24 @@ class Terminal(object):
                 log.exception('error closing %s', process)
         del self.processes[:]
 
+    def detach(self):
+        """Detach sessions, and close other processes."""
+        self._prune_closed()
+        for process in self.processes:
+            try:
+                process.detach()
+            except:
+                log.exception('error detaching %s', process)
+
 
 class AutoConnectThread(threading.Thread):
     """Maintains a terminal connection."""
 
-    def __init__(self, manager, url, identity=None):
+    def __init__(self, manager, url, identity=None, client_class=None, client_kwargs=None):
         self.manager = manager
         self.url = url
+        self.client_class = client_class or M2MClient
+        self.client_kwargs = client_kwargs or {}
         self._m2m_client = None
         self._identity = identity
         self.lock = threading.RLock()
@@ -101,7 +151,10 @@ class AutoConnectThread(threading.Thread):
     def start_connect(self):
         with self.lock:
             log.debug('connecting to %s', self.url)
-            self._m2m_client = M2MClient(self.url, log=log, uuid=self._identity)
+            self._m2m_client = self.client_class(self.url,
+                                                 log=log,
+                                                 uuid=self._identity,
+                                                 **self.client_kwargs)
             self._m2m_client.set_manager(self.manager)
             self._m2m_client.connect(wait=False)
 
@@ -131,8 +184,8 @@ class AutoConnectThread(threading.Thread):
                 self.m2m_client.close()
 
 
-class M2MClient(WSClient):
-    """Client for M2M server."""
+class ManagedClientMixin(object):
+    """Passes instructions and close notifications to the M2MManager."""
 
     def set_manager(self, manager):
         self._manager = manager
@@ -145,26 +198,72 @@ class M2MClient(WSClient):
         self.manager.on_instruction(sender, data)
 
     def on_close(self, app):
-        super(M2MClient, self).on_close(app)
+        super(ManagedClientMixin, self).on_close(app)
         self.manager.on_client_close()
 
 
+class M2MClient(ManagedClientMixin, WSClient):
+    """Client for M2M server."""
+
+
+if AsyncWSClient is not None:
+    class AsyncM2MClient(ManagedClientMixin, AsyncWSClient):
+        """Client for M2M server, using asyncio."""
+else:
+    AsyncM2MClient = None
+
+
+# maps the [m2m] transport setting on to a client class
+client_classes = {
+    "thread": M2MClient,
+    "asyncio": AsyncM2MClient
+}
+
+
 class M2MManager(object):
     """Manages M2M Services."""
 
-    def __init__(self, client, url, identity=None):
+    def __init__(self, client, url, identity=None, transport="thread",
+                 high_watermark=None, low_watermark=None, max_delay=0.002, max_frame_size=64 * 1024):
         self.client = client
         self.url = url
         self.identity = identity
         self.terminals = {}
         self.notified_identity = None
-        self.connect_thread = AutoConnectThread(self, url, identity=self.identity)
+        self._pty_reactor = None
+        self._lock = threading.Lock()
+        if transport not in client_classes:
+            raise errors.ConfigError("[m2m] transport should be one of {}".format(", ".join(sorted(client_classes))))
+        client_class = client_classes[transport]
+        if client_class is None:
+            log.warning("m2m transport '%s' isn't available in this version of Python", transport)
+            client_class = M2MClient
+        client_kwargs = {
+            "high_watermark": high_watermark,
+            "low_watermark": low_watermark,
+            "max_delay": max_delay,
+            "max_frame_size": max_frame_size
+        }
+        self.connect_thread = AutoConnectThread(self,
+                                                url,
+                                                identity=self.identity,
+                                                client_class=client_class,
+                                                client_kwargs=client_kwargs)
         self.connect_thread.start()
 
     @property
     def m2m_client(self):
         return self.connect_thread.m2m_client
 
+    @property
+    def pty_reactor(self):
+        """Get the reactor that handles terminal ptys, started on first use."""
+        with self._lock:
+            if self._pty_reactor is None:
+                self._pty_reactor = Reactor(name="pty")
+                self._pty_reactor.start()
+            return self._pty_reactor
+
     @classmethod
     def init_from_conf(cls, client, conf):
         # m2m is now on by default
@@ -183,7 +282,27 @@ class M2MManager(object):
         if identity is not None:
             log.debug('m2m identity is %s (works with internal development server only)', identity)
 
-        manager = cls(client, url, identity=identity)
+        transport = conf.get('m2m', 'transport', 'thread')
+        log.debug('m2m transport is %s', transport)
+
+        # Channel flow control, in bytes
+        high_watermark = conf.get_integer('m2m', 'high_watermark', 256 * 1024)
+        low_watermark = conf.get_integer('m2m', 'low_watermark', 64 * 1024)
+        if low_watermark > high_watermark:
+            raise errors.ConfigError("[m2m] low_watermark should not be greater than high_watermark")
+        # Small writes to a channel are held for up to this many milliseconds, to merge with
+        # following writes in to packets of up to max_frame_size bytes
+        coalesce_delay = conf.get_float('m2m', 'coalesce_delay', 2.0)
+        max_frame_size = conf.get_integer('m2m', 'max_frame_size', 64 * 1024)
+
+        manager = cls(client,
+                      url,
+                      identity=identity,
+                      transport=transport,
+                      high_watermark=high_watermark,
+                      low_watermark=low_watermark,
+                      max_delay=coalesce_delay / 1000.0,
+                      max_frame_size=max_frame_size)
 
         for section, name in conf.qualified_sections('terminal'):
             cmd = conf.get(section, 'command', os.environ.get('SHELL', None))
@@ -191,13 +310,18 @@ class M2MManager(object):
                 cmd = "bash"
             user = conf.get(section, 'user', None)
             group = conf.get(section, 'group', None)
-            manager.add_terminal(name, cmd, user=user, group=group)
+            # Seconds a detached session keeps running (0 to disable sessions)
+            detach_timeout = conf.get_float(section, 'detach_timeout', 300.0)
+            scrollback = conf.get_integer(section, 'scrollback', 64 * 1024)
+            manager.add_terminal(name, cmd, user=user, group=group,
+                                 detach_timeout=detach_timeout, scrollback=scrollback)
 
         return manager
 
     def on_client_close(self):
+        # Sessions survive losing the connection, and can be attached when it reconnects
         for terminal in self.terminals.values():
-            terminal.close()
+            terminal.detach()
 
     def set_identity(self, identity):
         """Set the m2m identity, and also notifies the dataplicity server if required."""
@@ -218,10 +342,17 @@ class M2MManager(object):
         self.connect_thread.close()
         if self.m2m_client is not None:
             self.m2m_client.close()
+        for terminal in self.terminals.values():
+            terminal.close()
+        with self._lock:
+            if self._pty_reactor is not None:
+                self._pty_reactor.stop()
+                self._pty_reactor = None
 
-    def add_terminal(self, name, remote_process, user=None, group=None):
+    def add_terminal(self, name, remote_process, user=None, group=None, detach_timeout=300.0, scrollback=64 * 1024):
         log.debug("adding terminal '%s' %s", name, remote_process)
-        self.terminals[name] = Terminal(name, remote_process, user=user, group=group)
+        self.terminals[name] = Terminal(name, remote_process, user=user, group=group,
+                                        detach_timeout=detach_timeout, scrollback=scrollback)
 
     def get_terminal(self, name):
         return self.terminals.get(name, None)
@@ -235,7 +366,8 @@ class M2MManager(object):
             port = data['port']
             terminal_name = data['name']
             size = data.get('size', None)
-            self.open_terminal(terminal_name, port, size=size)
+            session = data.get('session', None)
+            self.open_terminal(terminal_name, port, size=size, session=session)
         elif action == "open-keyboard":
             port = data['port']
             keyboard_name = data['name']
@@ -255,22 +387,28 @@ class M2MManager(object):
             log.debug('reboot requested')
             self.reboot()
 
-    def open_terminal(self, name, port, size=None):
+    def open_terminal(self, name, port, size=None, session=None):
         terminal = self.get_terminal(name)
         if terminal is None:
             log.warning("no terminal called '%s'", name)
             return
-        terminal.launch(self.m2m_client.get_channel(port), size=size)
+        terminal.launch(self.get_interactive_channel(port), self.pty_reactor, size=size, session=session)
+
+    def get_interactive_channel(self, port):
+        """Get a channel that is sent ahead of bulk channels (such as port forwards)."""
+        channel = self.m2m_client.get_channel(port)
+        channel.priority = PRIORITY_INTERACTIVE
+        return channel
 
     def open_keyboard(self, name, port):
-        self.client.rc.open_keyboard(name, self.m2m_client.get_channel(port))
+        self.client.rc.open_keyboard(name, self.get_interactive_channel(port))
 
     def open_buttons(self, name, port):
-        self.client.rc.open_buttons(name, self.m2m_client.get_channel(port))
+        self.client.rc.open_buttons(name, self.get_interactive_channel(port))
 
     def open_echo_service(self, port):
         log.debug('opening echo service on m2m port %s', port)
-        EchoService(self.m2m_client.get_channel(port))
+        EchoService(self.get_interactive_channel(port))
 
     def open_portforward(self, service, route):
         self.client.port_forward.open_service(service, route)
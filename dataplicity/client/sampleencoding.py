@@ -0,0 +1,185 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Compact wire format for samples.
+
+Samples are normally sent to the server as a JSON list of [timestamp, value] pairs. This module
+implements an alternative encoding, which the client will use if the server reports that it
+supports it (see Client._sync_samples).
+
+The encoded samples are base64 of the following binary format, compressed with zlib:
+
+    varint      number of samples
+    byte        value type, b'f' (floats) or b'i' (integers)
+    timestamps  timestamps in microseconds, the first as a zigzag varint, the second as a zigzag
+                varint delta, and the remainder as zigzag varint delta-of-deltas
+    values      for floats, the first value as 8 bytes (IEEE 754 big endian) and subsequent values
+                XORed with the previous value. A XOR of zero is encoded as a single zero byte,
+                otherwise as a control byte (leading zero bytes << 4 | meaningful bytes), followed
+                by the meaningful bytes. For integers, zigzag varint deltas.
+
+Samples taken at regular intervals encode their timestamps in a single byte, and slowly changing
+values in a few bytes. Runs of unchanged intervals and values then compress very well.
+
+"""
+
+from dataplicity.compat import int_types
+
+from base64 import b64encode, b64decode
+import struct
+import zlib
+
+
+ENCODING = "deltaxor1"
+
+_double_struct = struct.Struct(b'>d')
+_uint64_struct = struct.Struct(b'>Q')
+
+
+class SampleEncodingError(ValueError):
+    """Samples could not be encoded / decoded"""
+
+
+def _zigzag(n):
+    return (n << 1) if n >= 0 else ((-n << 1) - 1)
+
+
+def _unzigzag(n):
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while 1:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _float_bits(value):
+    return _uint64_struct.unpack(_double_struct.pack(value))[0]
+
+
+def _bits_float(bits):
+    return _double_struct.unpack(_uint64_struct.pack(bits))[0]
+
+
+def encode_samples(timestamps, values):
+    """Encode sequences of timestamps and values, return base64 text"""
+    if len(timestamps) != len(values):
+        raise SampleEncodingError("timestamps and values must be the same length")
+    out = bytearray()
+    _write_varint(out, len(timestamps))
+    integer_values = all(isinstance(value, int_types) for value in values)
+    out.append(ord(b'i') if integer_values else ord(b'f'))
+
+    previous = previous_delta = 0
+    for index, timestamp in enumerate(timestamps):
+        timestamp = int(round(timestamp * 1000000))
+        if index == 0:
+            _write_varint(out, _zigzag(timestamp))
+        else:
+            delta = timestamp - previous
+            _write_varint(out, _zigzag(delta if index == 1 else delta - previous_delta))
+            previous_delta = delta
+        previous = timestamp
+
+    if integer_values:
+        previous = 0
+        for value in values:
+            _write_varint(out, _zigzag(value - previous))
+            previous = value
+    else:
+        previous_bits = None
+        for value in values:
+            bits = _float_bits(value)
+            if previous_bits is None:
+                out.extend(_uint64_struct.pack(bits))
+            else:
+                xor = bits ^ previous_bits
+                if not xor:
+                    out.append(0)
+                else:
+                    xor_bytes = _uint64_struct.pack(xor)
+                    meaningful = xor_bytes.lstrip(b'\0')
+                    leading = 8 - len(meaningful)
+                    meaningful = meaningful.rstrip(b'\0')
+                    out.append((leading << 4) | len(meaningful))
+                    out.extend(meaningful)
+            previous_bits = bits
+
+    return b64encode(zlib.compress(bytes(out))).decode('ascii')
+
+
+def decode_samples(encoded):
+    """Decode samples from `encode_samples`, return a tuple of (timestamps, values) lists.
+
+    Timestamps are returned as floats (seconds).
+
+    """
+    try:
+        data = bytearray(zlib.decompress(b64decode(encoded)))
+        count, pos = _read_varint(data, 0)
+        value_type = data[pos]
+        pos += 1
+
+        timestamps = []
+        previous = previous_delta = 0
+        for index in range(count):
+            n, pos = _read_varint(data, pos)
+            n = _unzigzag(n)
+            if index == 0:
+                timestamp = n
+            elif index == 1:
+                previous_delta = n
+                timestamp = previous + n
+            else:
+                previous_delta += n
+                timestamp = previous + previous_delta
+            timestamps.append(timestamp / 1000000.0)
+            previous = timestamp
+
+        values = []
+        if value_type == ord(b'i'):
+            previous = 0
+            for _ in range(count):
+                n, pos = _read_varint(data, pos)
+                previous += _unzigzag(n)
+                values.append(previous)
+        elif value_type == ord(b'f'):
+            bits = None
+            for _ in range(count):
+                if bits is None:
+                    bits = _uint64_struct.unpack(bytes(data[pos:pos + 8]))[0]
+                    pos += 8
+                else:
+                    control = data[pos]
+                    pos += 1
+                    if control:
+                        leading = control >> 4
+                        meaningful = control & 0x0f
+                        xor_bytes = (b'\0' * leading +
+                                     bytes(data[pos:pos + meaningful]) +
+                                     b'\0' * (8 - leading - meaningful))
+                        pos += meaningful
+                        bits ^= _uint64_struct.unpack(xor_bytes)[0]
+                values.append(_bits_float(bits))
+        else:
+            raise SampleEncodingError("unknown value type {!r}".format(value_type))
+    except SampleEncodingError:
+        raise
+    except (IndexError, struct.error, zlib.error, TypeError, ValueError) as e:
+        raise SampleEncodingError("samples are badly encoded ({})".format(e))
+    return timestamps, values
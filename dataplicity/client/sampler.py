@@ -2,14 +2,25 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 from dataplicity import errors
+from dataplicity.client.aggregate import Aggregator
 from dataplicity.compat import py2bytes
 
 from time import time
+import logging
 import os
 from os.path import join, getsize, abspath, dirname, exists
 from functools import partial
-from threading import RLock
+from threading import RLock, Thread, Event
 import struct
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+log = logging.getLogger('dataplicity')
 
 
 class SamplerError(Exception):
@@ -20,10 +31,87 @@ class NoSamplerError(KeyError):
     pass
 
 
+# maps struct format characters (standard sizes) on to NumPy types
+_numpy_types = {
+    'b': 'i1', 'B': 'u1',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4',
+    'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'f': 'f4', 'd': 'f8'
+}
+
+
+def sample_dtype(sample_format):
+    """Get a NumPy structured dtype for a sample struct format.
+
+    Returns None if NumPy is not installed, or the format has no NumPy equivalent.
+
+    """
+    if numpy is None:
+        return None
+    byte_order = '>' if sample_format[0] in '>!' else '<'
+    formats = sample_format.lstrip('<>=!@')
+    if len(formats) != 2:
+        return None
+    time_format, value_format = formats
+    if time_format not in _numpy_types or value_format not in _numpy_types:
+        return None
+    return numpy.dtype([('timestamp', byte_order + _numpy_types[time_format]),
+                        ('value', byte_order + _numpy_types[value_format])])
+
+
+def sample_columns(samples):
+    """Split samples in to a (timestamps, values) tuple.
+
+    Samples may be an array returned from `read_samples_array`, in which case the columns are
+    views on the array, or a list of (timestamp, value) tuples.
+
+    """
+    if numpy is not None and isinstance(samples, numpy.ndarray):
+        return samples['timestamp'], samples['value']
+    if not samples:
+        return [], []
+    timestamps, values = zip(*samples)
+    return list(timestamps), list(values)
+
+
+def column_to_list(column):
+    """Convert a column from `sample_columns` to a list of Python numbers"""
+    if hasattr(column, 'tolist'):
+        return column.tolist()
+    return list(column)
+
+
+# maps a storage name on to a sampler class
+_sampler_registry = {}
+
+
+def register_sampler(storage):
+    """Class decorator to register a sampler storage engine"""
+    def class_deco(cls):
+        cls.storage = storage
+        _sampler_registry[storage] = cls
+        return cls
+    return class_deco
+
+
 class SamplerManager(object):
+    """Manages samplers.
+
+    Samplers that buffer samples are flushed from a background thread, so samples don't wait in
+    memory for longer than the sampler's `buffer_time` when no more samples arrive.
+
+    """
+
+    # Shortest time between checks for buffered samples to flush
+    min_flush_interval = 0.1
+
     def __init__(self, path):
         self.path = path
         self.samplers = {}
+        self._flush_thread = None
+        self._closing = Event()
 
     def get_sampler(self, sampler_name):
         """Get a named sampler"""
@@ -45,6 +133,14 @@ class SamplerManager(object):
             time_format = conf.get(section, 'time_format', 'd')
             value_format = conf.get(section, 'value_format', 'd')
             max_samples = conf.get_integer(section, 'max_sample', 10000)
+            buffer_size = conf.get_integer(section, 'buffer_size', 1)
+            buffer_time = conf.get_float(section, 'buffer_time', 1.0)
+            aggregator = Aggregator.init_from_conf(conf, section)
+            storage = conf.get(section, 'storage', 'file')
+            try:
+                sampler_cls = _sampler_registry[storage]
+            except KeyError:
+                raise errors.ConfigError("[{}]/storage should be one of {}".format(section, ", ".join(sorted(_sampler_registry))))
             path = join(dirname(conf.path), samplers_path, client.device_class, name)
             try:
                 os.makedirs(path)
@@ -53,11 +149,14 @@ class SamplerManager(object):
             else:
                 client.log.debug("created {}".format(path))
 
-            sampler = Sampler(path,
-                              name,
-                              time_format=time_format,
-                              value_format=value_format,
-                              max_samples=max_samples)
+            sampler = sampler_cls(path,
+                                  name,
+                                  time_format=time_format,
+                                  value_format=value_format,
+                                  max_samples=max_samples,
+                                  buffer_size=buffer_size,
+                                  buffer_time=buffer_time,
+                                  aggregator=aggregator)
             sampler_manager.add_sampler(name, sampler)
             client.log.debug("initialized sampler '{}'".format(name))
         return sampler_manager
@@ -67,6 +166,10 @@ class SamplerManager(object):
         if name in self.samplers:
             raise errors.ConfigError("sampler '{}' is already registered".format(name))
         self.samplers[name] = sampler
+        if sampler.buffer_size > 1 and self._flush_thread is None:
+            self._flush_thread = Thread(target=self._run_flush, name="sampler-flush")
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
 
     def sample(self, sampler_name, timestamp, value):
         """Add a sample to the given sampler"""
@@ -76,18 +179,73 @@ class SamplerManager(object):
         """Add a sample to the given sampler, with the current time"""
         self.get_sampler(sampler_name).add_sample(time(), value)
 
+    def add_samples(self, sampler_name, timestamps, values):
+        """Add a batch of samples to the given sampler"""
+        self.get_sampler(sampler_name).add_samples(timestamps, values)
+
     def enumerate_samplers(self):
         """Get the names of all the samplers"""
         return sorted(self.samplers.keys())
 
+    def flush(self):
+        """Write any buffered samples"""
+        for sampler in self.samplers.values():
+            sampler.flush()
 
+    def flush_expired(self):
+        """Write buffered samples that are older than their sampler's `buffer_time`"""
+        for sampler in list(self.samplers.values()):
+            try:
+                sampler.flush_expired()
+            except Exception:
+                log.exception('error flushing sampler %s', sampler.name)
+
+    def _run_flush(self):
+        while 1:
+            buffer_times = [sampler.buffer_time for sampler in list(self.samplers.values())
+                            if sampler.buffer_size > 1]
+            interval = max(self.min_flush_interval, min(buffer_times or [1.0]))
+            if self._closing.wait(interval):
+                break
+            self.flush_expired()
+
+    def close(self):
+        """Release any resources held by the samplers"""
+        self._closing.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+        for sampler in self.samplers.values():
+            sampler.close()
+
+
+@register_sampler('file')
 class Sampler(object):
-    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000):
+    """A sampler that appends samples to a file, and stops sampling when the file is full.
+
+    Samples are packed in to an in-memory buffer, which is written when it contains
+    `buffer_size` samples, when the oldest buffered sample is more than `buffer_time`
+    seconds old (checked when samples are added, and by the SamplerManager), or before
+    samples are read.
+
+    If `aggregator` is given, it is used to reduce snapshots before they are synced.
+
+    """
+
+    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000,
+                 buffer_size=1, buffer_time=1.0, aggregator=None):
         self.path = abspath(path)
         self.name = name
         self.time_format = time_format
         self.value_format = value_format
         self.max_samples = max_samples
+        self.buffer_size = buffer_size
+        self.buffer_time = buffer_time
+        self.aggregator = aggregator
+
+        self._buffer = []
+        self._buffer_count = 0
+        self._buffer_start = None
 
         self.samples_path = join(path, 'samples.smp')
         self.samples_snapshot_path = join(path, 'samples.smp.snapshot')
@@ -138,6 +296,7 @@ class Sampler(object):
         """Read and unpack all the samples in to a list of tuples (timestamp, value)"""
         # N.B. Doesn't lock
         if samples_path is None:
+            self.flush()
             samples_path = self.samples_path
         with open(samples_path, 'rb') as f:
             sample_format = self._read_header(f).decode('utf-8')
@@ -148,9 +307,28 @@ class Sampler(object):
             samples = [unpack(sample) for sample in iter(read_sample, b'')]
         return samples
 
+    def read_samples_array(self, samples_path=None):
+        """Read all the samples in to a NumPy structured array, with fields 'timestamp' and 'value'.
+
+        Falls back to `read_samples` (a list of tuples) if NumPy is not installed, or the sample
+        format isn't supported by NumPy.
+
+        """
+        if numpy is None:
+            return self.read_samples(samples_path)
+        if samples_path is None:
+            self.flush()
+            samples_path = self.samples_path
+        with open(samples_path, 'rb') as f:
+            dtype = sample_dtype(self._read_header(f).decode('utf-8'))
+            if dtype is not None:
+                return numpy.fromfile(f, dtype=dtype)
+        return self.read_samples(samples_path)
+
     def reset(self):
         """Reset samples"""
         with self.lock:
+            self._clear_buffer()
             with open(self.samples_path, 'wb') as f:
                 f.write(self.header)
 
@@ -159,26 +337,114 @@ class Sampler(object):
         A return value of False indicates the sampler file has reached the maximum number of samples allowed.
 
         """
-        if self.full:
-            # Stop sampling when the file is full
-            return False
         with self.lock:
-            with open(self.samples_path, 'ab') as f:
-                f.write(self.sample_pack(timestamp, value))
+            return self._buffer_samples(self.sample_pack(timestamp, value), 1)
+
+    def add_samples(self, timestamps, values):
+        """Add a batch of samples from sequences of timestamps and values.
+
+        Returns False if any of the samples were dropped because the sampler file is full.
+
+        """
+        if len(timestamps) != len(values):
+            raise ValueError("timestamps and values should be the same length ({} != {})".format(len(timestamps), len(values)))
+        dtype = sample_dtype(self.sample_format)
+        if dtype is not None:
+            samples = numpy.empty(len(timestamps), dtype=dtype)
+            samples['timestamp'] = timestamps
+            samples['value'] = values
+            data = samples.tobytes()
+            count = len(samples)
+        else:
+            pack = self.sample_pack
+            data = b''.join([pack(timestamp, value) for timestamp, value in zip(timestamps, values)])
+            count = len(data) // self.sample_size
+        if not count:
+            return True
+        with self.lock:
+            return self._buffer_samples(data, count)
+
+    def _buffer_samples(self, data, count):
+        """Add packed samples to the buffer, and flush if a threshold has been reached"""
+        self._buffer.append(data)
+        self._buffer_count += count
+        if self._buffer_start is None:
+            self._buffer_start = time()
+        if self._buffer_count >= self.buffer_size or time() - self._buffer_start >= self.buffer_time:
+            return self.flush()
         return True
 
-    def snapshot_samples(self):
+    def _clear_buffer(self):
+        del self._buffer[:]
+        self._buffer_count = 0
+        self._buffer_start = None
+
+    def flush_expired(self):
+        """Write buffered samples if the oldest is more than `buffer_time` seconds old"""
+        with self.lock:
+            if self._buffer_start is not None and time() - self._buffer_start >= self.buffer_time:
+                return self.flush()
+        return True
+
+    def flush(self):
+        """Write buffered samples, return False if any samples had to be dropped"""
+        with self.lock:
+            if not self._buffer:
+                return True
+            data = b''.join(self._buffer)
+            count = self._buffer_count
+            self._clear_buffer()
+            return self._write_samples(data, count)
+
+    def _write_samples(self, data, count):
+        """Append packed samples to the file, up to the maximum file size"""
+        space = self.max_file_size - getsize(self.samples_path)
+        if space <= 0:
+            # Stop sampling when the file is full
+            return False
+        write_count = min(count, space // self.sample_size)
+        with open(self.samples_path, 'ab') as f:
+            f.write(data[:write_count * self.sample_size])
+        return write_count == count
+
+    def close(self):
+        """Write any buffered samples (files are not held open)"""
+        self.flush()
+
+    def take_snapshot(self):
         """Take a snapshot of samples for syncing, so that sampling may continue uninterrupted"""
         # A snapshot is a copy of the current samples file
         # Once it has been synced it can be deleted
+        self.flush()
         if not exists(self.samples_snapshot_path):
             with self.lock:
                 self.check_create()
                 if not exists(self.samples_snapshot_path):
                     os.rename(self.samples_path, self.samples_snapshot_path)
                 self.check_create()
+
+    def snapshot_samples(self):
+        """Take a snapshot and return a list of (timestamp, value) tuples"""
+        self.take_snapshot()
         return self.read_samples(self.samples_snapshot_path)
 
+    def snapshot_samples_array(self):
+        """Take a snapshot and return an array of samples (see `read_samples_array`)"""
+        self.take_snapshot()
+        return self.read_samples_array(self.samples_snapshot_path)
+
+    def aggregate(self, samples):
+        """Reduce samples with the aggregator (if there is one), return a tuple of (timestamps, values) lists.
+
+        Arrays from `read_samples_array` are aggregated as arrays, and only the result is
+        converted to lists.
+
+        """
+        timestamps, values = sample_columns(samples)
+        if self.aggregator is not None:
+            timestamps, values = self.aggregator(timestamps, values)
+        return column_to_list(timestamps), column_to_list(values)
+
     def remove_snapshot(self):
         """Remove any samples snapshot"""
         try:
@@ -187,6 +453,214 @@ class Sampler(object):
             pass
 
 
+@register_sampler('ring')
+class RingSampler(Sampler):
+    """A sampler that stores samples in a preallocated memory mapped circular buffer.
+
+    The file has a fixed size header followed by `max_samples` slots. The header stores
+    the sample format and the sequence numbers of the oldest (tail) and next (head) sample,
+    where a sample with sequence number n lives in slot n % max_samples. Adding a sample is
+    a struct pack in to the mapping; when the buffer is full the oldest sample is overwritten.
+
+    """
+
+    magic = b"smpring1"
+
+    # magic, sample format, sample size, capacity, tail sequence, head sequence
+    ring_header_struct = struct.Struct(py2bytes('<8s16sIIQQ'))
+    ring_indices_struct = struct.Struct(py2bytes('<QQ'))
+    ring_indices_offset = 32
+    ring_data_offset = 64
+
+    def __init__(self, path, name, time_format='d', value_format='d', max_samples=1000,
+                 buffer_size=1, buffer_time=1.0, aggregator=None):
+        self._mmap = None
+        self._tail = 0
+        self._head = 0
+        self.ring_path = join(path, 'samples.ring')
+        super(RingSampler, self).__init__(path,
+                                          name,
+                                          time_format=time_format,
+                                          value_format=value_format,
+                                          max_samples=max_samples,
+                                          buffer_size=buffer_size,
+                                          buffer_time=buffer_time,
+                                          aggregator=aggregator)
+
+    @property
+    def ring_size(self):
+        return self.ring_data_offset + self.sample_size * self.max_samples
+
+    @property
+    def full(self):
+        """A ring sampler is never full, old samples are overwritten"""
+        return False
+
+    @property
+    def count(self):
+        """Number of samples in the ring"""
+        return self._head - self._tail
+
+    def _ring_header(self, tail, head):
+        return self.ring_header_struct.pack(self.magic,
+                                            self.sample_format.encode('utf-8'),
+                                            self.sample_size,
+                                            self.max_samples,
+                                            tail,
+                                            head)
+
+    def _open_ring(self):
+        """Open the ring file, (re)creating it if it doesn't match the current format"""
+        header = self._ring_header(0, 0)
+        tail = head = 0
+        try:
+            with open(self.ring_path, 'rb') as f:
+                existing = f.read(self.ring_header_struct.size)
+        except IOError:
+            existing = b''
+        if len(existing) == len(header) and existing[:self.ring_indices_offset] == header[:self.ring_indices_offset]:
+            tail, head = self.ring_indices_struct.unpack_from(existing, self.ring_indices_offset)
+            if not 0 <= head - tail <= self.max_samples:
+                tail = head = 0
+
+        f = open(self.ring_path, 'r+b' if existing else 'w+b')
+        try:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != self.ring_size:
+                f.truncate(self.ring_size)
+            f.seek(0)
+            f.write(self._ring_header(tail, head))
+            f.flush()
+            self._mmap = mmap.mmap(f.fileno(), self.ring_size)
+        finally:
+            f.close()
+        self._tail = tail
+        self._head = head
+
+    def _get_mmap(self):
+        """Get the mapping of the ring file, mapping it again if the sampler was closed"""
+        if self._mmap is None:
+            self.check_create()
+        return self._mmap
+
+    def _set_indices(self, tail, head):
+        ring = self._get_mmap()
+        self._tail = tail
+        self._head = head
+        self.ring_indices_struct.pack_into(ring, self.ring_indices_offset, tail, head)
+
+    def _read_ring_bytes(self):
+        """Get the packed samples in the ring, oldest first"""
+        ring = self._get_mmap()
+        sample_size = self.sample_size
+        data_offset = self.ring_data_offset
+        start = self._tail % self.max_samples
+        count = self.count
+        first = min(count, self.max_samples - start)
+        start_offset = data_offset + start * sample_size
+        data = ring[start_offset:start_offset + first * sample_size]
+        if count > first:
+            data += ring[data_offset:data_offset + (count - first) * sample_size]
+        return data
+
+    def check_create(self):
+        """Map the ring file in to memory if it isn't already"""
+        with self.lock:
+            if self._mmap is None:
+                if not exists(self.path):
+                    try:
+                        os.makedirs(self.path)
+                    except OSError:
+                        pass
+                self._open_ring()
+
+    def close(self):
+        """Flush and unmap the ring file"""
+        with self.lock:
+            if self._mmap is not None:
+                self.flush()
+                self._mmap.flush()
+                self._mmap.close()
+                self._mmap = None
+
+    def read_samples(self, samples_path=None):
+        """Read samples from the ring (or a snapshot if `samples_path` is given)"""
+        if samples_path is not None:
+            return super(RingSampler, self).read_samples(samples_path)
+        with self.lock:
+            self.flush()
+            data = self._read_ring_bytes()
+        unpack_from = self.sample_struct.unpack_from
+        sample_size = self.sample_size
+        return [unpack_from(data, offset) for offset in range(0, len(data), sample_size)]
+
+    def read_samples_array(self, samples_path=None):
+        """Read samples from the ring (or a snapshot) in to an array"""
+        if samples_path is not None:
+            return super(RingSampler, self).read_samples_array(samples_path)
+        dtype = sample_dtype(self.sample_format)
+        if dtype is None:
+            return self.read_samples()
+        with self.lock:
+            self.flush()
+            data = self._read_ring_bytes()
+        return numpy.frombuffer(data, dtype=dtype)
+
+    def reset(self):
+        """Discard all samples in the ring"""
+        with self.lock:
+            self._clear_buffer()
+            self._set_indices(self._head, self._head)
+
+    def add_sample(self, timestamp, value):
+        """Add a sample, overwriting the oldest sample if the ring is full. Always returns True."""
+        with self.lock:
+            if self.buffer_size > 1:
+                return self._buffer_samples(self.sample_pack(timestamp, value), 1)
+            self.flush()
+            ring = self._get_mmap()
+            head = self._head
+            tail = self._tail
+            self.sample_struct.pack_into(ring,
+                                         self.ring_data_offset + (head % self.max_samples) * self.sample_size,
+                                         timestamp,
+                                         value)
+            head += 1
+            if head - tail > self.max_samples:
+                tail = head - self.max_samples
+            self._set_indices(tail, head)
+        return True
+
+    def _write_samples(self, data, count):
+        """Copy packed samples in to the ring, overwriting the oldest samples if required"""
+        ring = self._get_mmap()
+        capacity = self.max_samples
+        sample_size = self.sample_size
+        data_offset = self.ring_data_offset
+        write_count = min(count, capacity)
+        if write_count < count:
+            data = data[(count - write_count) * sample_size:]
+        head = self._head + count
+        slot = (head - write_count) % capacity
+        first = min(write_count, capacity - slot)
+        offset = data_offset + slot * sample_size
+        ring[offset:offset + first * sample_size] = data[:first * sample_size]
+        if write_count > first:
+            ring[data_offset:data_offset + (write_count - first) * sample_size] = data[first * sample_size:]
+        self._set_indices(max(self._tail, head - capacity), head)
+        return True
+
+    def take_snapshot(self):
+        """Copy the samples in the ring to a snapshot file, and empty the ring"""
+        if not exists(self.samples_snapshot_path):
+            with self.lock:
+                self.flush()
+                if not exists(self.samples_snapshot_path):
+                    with open(self.samples_snapshot_path, 'wb') as f:
+                        f.write(self.header + self._read_ring_bytes())
+                    self._set_indices(self._head, self._head)
+
+
 if __name__ == "__main__":
     from time import time
     sampler = Sampler('./testsampler', 'hobbits')
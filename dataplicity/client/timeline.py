@@ -4,11 +4,31 @@ from __future__ import print_function
 """
 Creates a database of timestamped events.
 
+Events are stored as JSON in an append-only EventLog (see eventlog.py), one per timeline.
+
+Events written with overwrite=True are "latest value" slots, such as status information which is
+re-written with the same event id on every poll. The timeline keeps a hash of the content of each
+slot, and only writes the event when the content (ignoring the timestamp) changes. Since synced
+events are cleared, an unchanged slot is not sent to the server again.
+
+Events are synced in pages (see EventCursor), bounded by count and size, so a large backlog makes
+steady progress rather than producing one enormous request.
+
+Attachments are stored in a BlobStore (see blobstore.py) in the timeline directory, and events
+reference them by content hash. When syncing, the attachments are streamed in to the request
+rather than read in to memory. Blobs no event references are removed, but only once they are
+older than a grace period, since another process may have stored a blob and not yet written its
+event.
+
 """
 
 from dataplicity import constants
 from dataplicity.compat import text_type, itervalues
+from dataplicity.client.eventlog import EventLog
+from dataplicity.client.blobstore import BlobStore
+from dataplicity.jsonrpc import StreamedBase64
 
+import os
 import os.path
 from os.path import splitext
 from time import time
@@ -17,9 +37,9 @@ from json import dumps, loads
 from operator import itemgetter
 from base64 import b64encode
 from os.path import basename
-
-from fs.osfs import OSFS
-from fs.errors import FSError
+from hashlib import sha1
+from threading import RLock
+from collections import deque
 
 import logging
 log = logging.getLogger('dataplicity')
@@ -98,21 +118,26 @@ class Event(object):
         """Attach a file to this event"""
         if name is None:
             name = filename
-        with open(filename, 'rb') as f:
-            data_bin = f.read()
-        return self.attach_bytes(data_bin, filename=filename, name=name)
+        blob_id, size = self.timeline.blobs.add_path(filename)
+        return self.attach_blob(blob_id, size, filename=filename, name=name, ext=ext)
 
     def attach_bytes(self, data_bin, filename=None, name=None, ext=None):
         """Attach binary data to this event"""
+        blob_id, size = self.timeline.blobs.add_bytes(data_bin)
+        return self.attach_blob(blob_id, size, filename=filename, name=name, ext=ext)
+
+    def attach_blob(self, blob_id, size, filename=None, name=None, ext=None):
+        """Attach a blob in the timeline's blob store to this event"""
         if ext is None and filename is not None:
             ext = splitext(filename)[-1]
-        data_b64 = b64encode(data_bin)
         if filename is not None:
             filename_base = basename(filename)
         else:
             filename_base = None
+        self.timeline._add_pending_blob(blob_id)
         attachment = {
-            "data": data_b64,
+            "blob": blob_id,
+            "size": size,
             "encoding": 'base64',
             "name": name or filename_base,
             "filename": filename_base,
@@ -158,12 +183,75 @@ class ImageEvent(Event):
                 "attachments": self.attachments}
 
 
+class EventCursor(object):
+    """Reads the events in a timeline in pages, oldest first"""
+
+    def __init__(self, timeline, stream=True):
+        self.timeline = timeline
+        self.stream = stream
+        self._event_ids = deque(timeline.event_log.keys())
+        # An event that didn't fit in the previous page
+        self._next = None
+
+    def __repr__(self):
+        return "<cursor {} ({} remaining)>".format(self.timeline.name, len(self._event_ids))
+
+    @property
+    def exhausted(self):
+        return self._next is None and not self._event_ids
+
+    def _read_events(self, count):
+        """Yield (event, estimated size) for up to `count` events"""
+        event_ids = [self._event_ids.popleft() for _ in range(min(count, len(self._event_ids)))]
+        for _, payload in self.timeline.event_log.items(event_ids):
+            event = loads(payload.decode('utf-8'))
+            size = len(payload)
+            for attachment in event.get('attachments', ()):
+                size += (attachment.get('size', 0) + 2) // 3 * 4
+            yield event, size
+
+    def next_page(self, max_events, max_bytes, force=True):
+        """Get a tuple of (events, estimated size) for the next page.
+
+        A page contains at most `max_events` events, and if possible no more than `max_bytes` of
+        encoded events. If `force` is True, the page will contain at least one event (if there are
+        any), even if it is larger than `max_bytes`.
+
+        """
+        events = []
+        page_size = 0
+        while len(events) < max_events and not self.exhausted:
+            if self._next is not None:
+                pending, self._next = [self._next], None
+            else:
+                pending = list(self._read_events(max_events - len(events)))
+            for index, (event, size) in enumerate(pending):
+                if page_size + size > max_bytes and (events or not force):
+                    # Keep this event for the next page, and put back any that weren't used
+                    self._next = (event, size)
+                    self._event_ids.extendleft(reversed([unused['event_id'] for unused, _ in pending[index + 1:]]))
+                    break
+                events.append(event)
+                page_size += size
+            if self._next is not None:
+                break
+        for event in events:
+            if event.get('attachments'):
+                self.timeline._load_attachments(event, self.stream)
+        events.sort(key=itemgetter('timestamp'))
+        return events, page_size
+
+
 class TimelineManager(object):
     """Manages a collection of timelines"""
 
-    def __init__(self, path):
+    def __init__(self, path, page_events=100, page_bytes=1024 * 1024, max_pages=20):
         self.path = path
         self.timelines = {}
+        # Limits for syncing events
+        self.page_events = page_events
+        self.page_bytes = page_bytes
+        self.max_pages = max_pages
 
     def __nonzero__(self):
         return bool(self.timelines)
@@ -175,10 +263,15 @@ class TimelineManager(object):
     def init_from_conf(cls, client, conf):
         timelines_path = conf.get('timelines', 'path', constants.TIMELINE_PATH)
         timelines_path = os.path.join(timelines_path, client.device_class)
-        timeline_manager = cls(timelines_path)
+        timeline_manager = cls(timelines_path,
+                               page_events=conf.get_integer('timelines', 'page_events', 100),
+                               page_bytes=conf.get_integer('timelines', 'page_bytes', 1024 * 1024),
+                               max_pages=conf.get_integer('timelines', 'max_pages', 20))
 
         for section, name in conf.qualified_sections('timeline'):
             max_events = conf.get(section, 'max_events', None)
+            if max_events is not None:
+                max_events = conf.get_integer(section, 'max_events')
             timeline_manager.new_timeline(name, max_events=max_events)
         return timeline_manager
 
@@ -196,24 +289,59 @@ class TimelineManager(object):
         else:
             return timeline
 
+    def close(self):
+        """Close all timelines"""
+        for timeline in itervalues(self.timelines):
+            timeline.close()
+
 
 class Timeline(object):
     """A timeline is a sequence of timestamped events."""
 
+    # Unreferenced blobs younger than this (in seconds) are left alone when sweeping the blob
+    # store, as another process may have stored them and not yet written the event
+    blob_grace_period = 10 * 60
+
     def __init__(self, path, name, max_events=None):
         self.path = path
         self.name = name
-        self.fs = OSFS(path, create=True)
         self.max_events = max_events
+        self.event_log = EventLog(path)
+        self.blobs = BlobStore(os.path.join(path, 'blobs'))
+        self._lock = RLock()
+        # maps event ids of overwrite events on to a hash of their last written content
+        self._slots = {}
+        # maps event ids on to the blobs they reference
+        self._event_blobs = {}
+        # counts of blobs attached to events that haven't been written yet
+        self._pending_blobs = {}
+        self._migrate_json_events()
+        self._release_blobs(self.blobs.blob_ids(min_age=self.blob_grace_period))
 
     def __repr__(self):
         return "Timeline({!r}, {!r}, max_events={!r})".format(self.path, self.name, self.max_events)
 
+    def __len__(self):
+        return len(self.event_log)
+
+    def _migrate_json_events(self):
+        """Move events stored by older versions (one JSON file per event) in to the event log"""
+        filenames = sorted(filename for filename in os.listdir(self.path) if filename.endswith('.json'))
+        for filename in filenames:
+            event_path = os.path.join(self.path, filename)
+            try:
+                with open(event_path, 'rb') as f:
+                    event = loads(f.read().decode('utf-8'))
+                self._write_event(event.get('event_id') or splitext(filename)[0], event)
+            except Exception:
+                log.exception('unable to migrate event %s', event_path)
+            else:
+                os.remove(event_path)
+
     def new_event(self, event_type, timestamp=None, *args, **kwargs):
         """Create and return an event, to be used as a context manager"""
-        if self.max_events is not None:
-            size = len(self.fs.listdir(wildcard="*.json"))
-            if size >= self.max_events:
+        if self.max_events is not None and kwargs.get('event_id') not in self.event_log:
+            if len(self.event_log) >= self.max_events:
                 raise TimelineFullError("The timeline has reached its maximum size")
 
         if timestamp is None:
@@ -232,59 +360,133 @@ class Timeline(object):
 
     def new_photo(self, file, filename=None, ext=None, **kwargs):
         """Create a new photo object"""
+        if file is None:
+            raise ValueError("A value for 'file' is required")
         event = self.new_event('IMAGE', **kwargs)
 
-        if hasattr(file, 'getvalue'):
-            bytes = file.getvalue()
-        elif file is not None:
-            if isinstance(file, text_type):
-                with open(file, 'rb') as f:
-                    bytes = f.read()
-            else:
-                bytes = file.read()
+        if isinstance(file, text_type):
+            blob_id, size = self.blobs.add_path(file)
         else:
-            if bytes is None:
-                raise ValueError("A value for 'file' or 'bytes' is required")
-        event.attach_bytes(bytes, name='photo', filename=filename, ext=ext)
+            if hasattr(file, 'getvalue'):
+                # In memory file, copy all of it
+                file.seek(0)
+            blob_id, size = self.blobs.add_file(file)
+        event.attach_blob(blob_id, size, name='photo', filename=filename, ext=ext)
         return event
 
-    def get_events(self, sort=True):
-        """Get all accumulated events"""
+    def get_cursor(self, stream=True):
+        """Get an EventCursor to read events in pages"""
+        return EventCursor(self, stream=stream)
+
+    def get_events(self, sort=True, stream=False):
+        """Get all accumulated events.
+
+        If `stream` is True, attachment data is a StreamedBase64 object rather than base64 text.
+
+        """
         events = []
-        for event_filename in self.fs.listdir(wildcard="*.json"):
-            with self.fs.open(event_filename, 'rb') as f:
-                event = loads(f.read().decode('utf-8'))
-                events.append(event)
+        for _, payload in self.event_log.items():
+            event = loads(payload.decode('utf-8'))
+            if event.get('attachments'):
+                self._load_attachments(event, stream)
+            events.append(event)
         if sort:
             # sort by timestamp
             events.sort(key=itemgetter('timestamp'))
         return events
 
+    def _load_attachments(self, event, stream):
+        """Replace blob references in an event's attachments with their data"""
+        attachments = []
+        for attachment in event['attachments']:
+            blob_id = attachment.pop('blob', None)
+            size = attachment.pop('size', None)
+            if blob_id is not None:
+                blob_path = self.blobs.get_path(blob_id)
+                if not os.path.exists(blob_path):
+                    log.warning('attachment %s for event %s is missing', blob_id, event.get('event_id'))
+                    continue
+                if stream:
+                    attachment['data'] = StreamedBase64(blob_path, size)
+                else:
+                    with self.blobs.open(blob_id) as blob_file:
+                        attachment['data'] = b64encode(blob_file.read()).decode('ascii')
+            attachments.append(attachment)
+        event['attachments'] = attachments
+
     def clear_all(self):
         """Clear all stored events"""
-        for filename in self.fs.listdir(wildcard="*.json"):
-            try:
-                self.fs.remove(filename)
-            except FSError:
-                pass
+        with self._lock:
+            self.event_log.clear()
+            self._slots.clear()
+            self._event_blobs.clear()
+            self._release_blobs(self.blobs.blob_ids(min_age=self.blob_grace_period))
 
     def clear_events(self, event_ids):
         """Clear any events that have been processed"""
-        for event_id in event_ids:
-            filename = "{}.json".format(event_id)
-            try:
-                self.fs.remove(filename)
-            except FSError:
-                pass
+        with self._lock:
+            self.event_log.delete(event_ids)
+            released = set()
+            for event_id in event_ids:
+                released.update(self._event_blobs.pop(event_id, ()))
+            self._release_blobs(released)
+
+    @classmethod
+    def _get_blob_ids(cls, event):
+        return [attachment['blob'] for attachment in event.get('attachments', ()) if 'blob' in attachment]
+
+    def _add_pending_blob(self, blob_id):
+        with self._lock:
+            self._pending_blobs[blob_id] = self._pending_blobs.get(blob_id, 0) + 1
+
+    def _release_blobs(self, blob_ids):
+        """Remove blobs that are no longer referenced by an event"""
+        if not blob_ids:
+            return
+        with self._lock:
+            # Find blobs referenced by events we haven't seen (from another process)
+            event_ids = [event_id for event_id in self.event_log.keys() if event_id not in self._event_blobs]
+            for event_id, payload in self.event_log.items(event_ids):
+                self._event_blobs[event_id] = self._get_blob_ids(loads(payload.decode('utf-8')))
+            referenced = set(self._pending_blobs)
+            for event_blob_ids in itervalues(self._event_blobs):
+                referenced.update(event_blob_ids)
+            for blob_id in blob_ids:
+                if blob_id not in referenced:
+                    self.blobs.remove(blob_id)
+
+    def close(self):
+        self.event_log.close()
 
     def _write_event(self, event_id, event):
         if hasattr(event, 'to_data'):
             event = event.to_data()
         event['event_id'] = event_id
-        event_json = dumps(event, indent=4).encode('utf-8')
-        filename = "{}.json".format(event_id)
-        with self.fs.open(filename, 'wb') as f:
-            f.write(event_json)
+        blob_ids = self._get_blob_ids(event)
+        with self._lock:
+            for blob_id in blob_ids:
+                if self._pending_blobs.get(blob_id, 0) > 1:
+                    self._pending_blobs[blob_id] -= 1
+                else:
+                    self._pending_blobs.pop(blob_id, None)
+
+            slot_hash = None
+            if event.get('overwrite', False):
+                content = dict(event)
+                del content['timestamp']
+                slot_hash = sha1(dumps(content, sort_keys=True).encode('utf-8')).digest()
+                if self._slots.get(event_id) == slot_hash:
+                    # Content hasn't changed since it was last written
+                    return False
+            event_json = dumps(event, separators=(',', ':')).encode('utf-8')
+            self.event_log.put(event_id, event_json)
+            if slot_hash is not None:
+                self._slots[event_id] = slot_hash
+
+            previous_blob_ids = self._event_blobs.get(event_id, ())
+            self._event_blobs[event_id] = blob_ids
+            self._release_blobs(set(previous_blob_ids).difference(blob_ids))
+        return True
 
 
 if __name__ == "__main__":
@@ -54,13 +54,17 @@ if PY2:
     from urlparse import urlparse, parse_qs, urlunparse
     from urllib import urlencode, quote
     from itertools import izip_longest as zip_longest
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import getproxies, proxy_bypass
+    import httplib as http_client
     import Queue as queue
 else:
     from urllib.parse import urlparse, parse_qs, urlunparse
     from urllib.parse import urlencode, quote
     from itertools import zip_longest
-    from urllib.request import urlopen, HTTPError
+    from urllib.request import urlopen, Request, HTTPError
+    from urllib.request import getproxies, proxy_bypass
+    import http.client as http_client
     import queue
 
 
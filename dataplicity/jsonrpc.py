@@ -3,8 +3,15 @@ from __future__ import unicode_literals
 
 import json
 import logging
+import os
+import re
+import tempfile
+import zlib
+from base64 import b64encode
+from binascii import hexlify
 
-from dataplicity.compat import urlopen, text_type
+from dataplicity.compat import text_type, HTTPError
+from dataplicity.transport import get_transport
 
 
 log = logging.getLogger('dataplicity')
@@ -45,6 +52,162 @@ class RemoteMethodError(JSONRPCError):
     """An error returned from the server"""
 
 
+class StreamedBase64(object):
+    """A placeholder for the contents of a file, which is streamed in to the request as base64 text.
+
+    May be used in place of a string in call parameters, so large files don't have to be read in to
+    memory.
+
+    """
+
+    # A multiple of 3, so chunks encode without padding
+    chunk_size = 48 * 1024
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = os.path.getsize(path) if size is None else size
+
+    def __repr__(self):
+        return "StreamedBase64({!r})".format(self.path)
+
+    def __len__(self):
+        """Length of the encoded data"""
+        return (self.size + 2) // 3 * 4
+
+    def iter_chunks(self):
+        """Yield base64 encoded chunks"""
+        with open(self.path, 'rb') as f:
+            while 1:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield b64encode(chunk)
+
+
+class RequestBody(object):
+    """A file-like request body, made from bytes and StreamedBase64 objects"""
+
+    def __init__(self, parts):
+        self.parts = parts
+        self._chunks = self._iter_chunks()
+        self._buffer = b''
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def _iter_chunks(self):
+        for part in self.parts:
+            if isinstance(part, StreamedBase64):
+                for chunk in part.iter_chunks():
+                    yield chunk
+            else:
+                yield part
+
+    def rewind(self):
+        """Go back to the start, so the body may be sent again."""
+        self._chunks = self._iter_chunks()
+        self._buffer = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self._buffer + b''.join(self._chunks)
+            self._buffer = b''
+            return data
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer = chunk
+        # May return less than `size`, like a socket
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class CompressedBody(object):
+    """A compressed copy of a streamed RequestBody.
+
+    Compressed in to a temporary file (in memory up to `max_memory` bytes), so the length is
+    known before the request is sent.
+
+    """
+
+    max_memory = 1024 * 1024
+
+    def __init__(self, body, compressor):
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.max_memory)
+        while 1:
+            chunk = body.read(64 * 1024)
+            if not chunk:
+                break
+            self._file.write(compressor.compress(chunk))
+        self._file.write(compressor.flush())
+        self._size = self._file.tell()
+        self._file.seek(0)
+
+    def __len__(self):
+        return self._size
+
+    def rewind(self):
+        self._file.seek(0)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+
+def compress_body(body, encoding='gzip'):
+    """Compress a request body with `encoding` ('gzip' or 'deflate').
+
+    Returns bytes, or a CompressedBody for a streamed RequestBody.
+
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(6)
+    else:
+        raise ValueError("unsupported encoding '{}'".format(encoding))
+    if isinstance(body, RequestBody):
+        body.rewind()
+        return CompressedBody(body, compressor)
+    return compressor.compress(body) + compressor.flush()
+
+
+def encode_request(call):
+    """Encode a call (or list of calls) as JSON.
+
+    Returns bytes, or a RequestBody if there are any StreamedBase64 objects in the call.
+
+    """
+    streams = []
+    token = hexlify(os.urandom(8)).decode('ascii')
+
+    def default(obj):
+        if isinstance(obj, StreamedBase64):
+            streams.append(obj)
+            return "{}:{}".format(token, len(streams) - 1)
+        raise TypeError("{!r} is not JSON serializable".format(obj))
+
+    call_json = json.dumps(call, default=default)
+    # Py2 returns bytes, Py3 returns unicode str
+    if isinstance(call_json, text_type):
+        call_json = call_json.encode('utf-8')
+    if not streams:
+        return call_json
+
+    # Replace the placeholders with the streams
+    parts = []
+    placeholder_re = re.compile('"{}:(\\d+)"'.format(token).encode('ascii'))
+    for index, part in enumerate(placeholder_re.split(call_json)):
+        if index % 2:
+            parts.extend([b'"', streams[int(part)], b'"'])
+        elif part:
+            parts.append(part)
+    return RequestBody(parts)
+
+
 class ErrorCode(object):
     """Enumeration of JSONRPC error codes"""
 
@@ -158,31 +321,77 @@ class Batch(object):
 
 
 class JSONRPC(object):
-    """A client for a JSONRPC server."""
+    """A client for a JSONRPC server.
+
+    Requests are sent with `transport` (an HTTPTransport), or the transport shared by the process
+    if it isn't given, so connections to the server are reused.
+
+    If `compression` is set ('gzip' or 'deflate'), request bodies of at least `compress_threshold`
+    bytes are compressed. Servers that don't support compressed requests may respond with 415
+    (Unsupported Media Type), 400, or a JSONRPC parse error. Then the request is sent again
+    uncompressed, and later requests aren't compressed.
+
+    """
 
     unknown_error_msg = "the server did not supply further information"
 
-    def __init__(self, url):
+    def __init__(self, url, transport=None, compression=None, compress_threshold=1024):
         self.url = url
+        self.transport = transport or get_transport()
+        self.compression = compression
+        self.compress_threshold = compress_threshold
         self.call_id = 1
 
     def new_call_id(self):
         self.call_id += 1
         return self.call_id
 
+    def _post(self, body, encoding=None):
+        headers = {'Content-Type': 'application/json'}
+        if encoding is not None:
+            body = compress_body(body, encoding)
+            headers['Content-Encoding'] = encoding
+        if not isinstance(body, bytes):
+            # Streamed, so http.client can't calculate the length
+            headers['Content-Length'] = str(len(body))
+        try:
+            return self.transport.post(self.url, body, headers=headers)
+        finally:
+            if isinstance(body, CompressedBody):
+                body.close()
+
+    @classmethod
+    def _is_parse_error(cls, response):
+        """Check if the server couldn't parse the request."""
+        if b'-32700' not in response:
+            return False
+        try:
+            response = json.loads(response.decode('utf-8'))
+        except ValueError:
+            return True
+        responses = response if isinstance(response, list) else [response]
+        return any(isinstance(r, dict) and (r.get('error') or {}).get('code') == ErrorCode.parse_error
+                   for r in responses)
+
     def _send(self, call):
-        call_json = json.dumps(call)
-        # Py2 returns bytes, Py3 returns unicode str
-        if isinstance(call_json, text_type):
-            call_json = call_json.encode('utf-8')
-        url_file = None
+        call_body = encode_request(call)
+        encoding = self.compression
+        if len(call_body) < self.compress_threshold:
+            encoding = None
         try:
             try:
-                url_file = urlopen(self.url, call_json)
-                response_json = url_file.read().decode('utf-8')
-            finally:
-                if url_file is not None:
-                    url_file.close()
+                response = self._post(call_body, encoding)
+            except HTTPError as e:
+                if encoding is None or e.code not in (400, 415):
+                    raise
+                response = None
+            if encoding is not None and (response is None or self._is_parse_error(response)):
+                log.info("%s doesn't accept %s requests, sending uncompressed", self.url, encoding)
+                self.compression = None
+                if isinstance(call_body, RequestBody):
+                    call_body.rewind()
+                response = self._post(call_body)
+            response_json = response.decode('utf-8')
         except Exception as e:
             raise ServerUnreachableError(self.url, e)
         return response_json
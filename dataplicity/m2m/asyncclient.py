@@ -0,0 +1,402 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+An asyncio transport for M2M (Python 3 only).
+
+AsyncWSClient handles the same packets as WSClient, but all connection I/O happens in a single
+event loop. Writes from any thread are handed to the loop, rather than serialised with a lock,
+and channels may be read and written with coroutines (`AsyncChannel.aread` / `awrite`), so a
+device can serve many channels without a thread per channel.
+
+Code that uses the blocking channel interface (read / write / set_callbacks) works unchanged.
+Channel callbacks are called from the event loop thread, and so must not block.
+
+Enable with the following in dataplicity.conf:
+
+    [m2m]
+    transport = asyncio
+
+"""
+
+import asyncio
+import logging
+import socket
+import ssl
+import threading
+
+from . import rfc6455
+from .packets import PacketType
+from .wsclient import BaseClient, Channel
+from ..compat import urlparse
+
+log = logging.getLogger('m2m.client')
+
+
+class WebSocketConnection(object):
+    """A websocket connection over asyncio streams."""
+
+    def __init__(self, reader, writer, mask=True, max_size=16 * 1024 * 1024):
+        self.reader = reader
+        self.writer = writer
+        # Clients mask frames, servers don't
+        self.mask = mask
+        self.max_size = max_size
+        self.closed = False
+        self.last_received = asyncio.get_event_loop().time()
+
+    @classmethod
+    async def open(cls, url, headers=None, timeout=30):
+        """Connect to a ws:// or wss:// url."""
+        url = urlparse(url)
+        secure = url.scheme == 'wss'
+        port = url.port or (443 if secure else 80)
+        ssl_context = None
+        if secure:
+            # Same as the websocket-client transport, which uses cert_reqs=CERT_NONE
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, port, ssl=ssl_context),
+            timeout
+        )
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        resource = url.path or '/'
+        if url.query:
+            resource += '?' + url.query
+        host = url.hostname if url.port is None else '{}:{}'.format(url.hostname, url.port)
+        key = rfc6455.make_key()
+        try:
+            writer.write(rfc6455.handshake_request(host, resource, key, headers=headers))
+            response = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+            rfc6455.check_handshake_response(response, key)
+        except:
+            writer.close()
+            raise
+        return cls(reader, writer)
+
+    def _send_frame(self, opcode, payload):
+        if not self.closed:
+            self.writer.write(rfc6455.encode_frame(opcode, payload, mask=self.mask))
+
+    def send_binary(self, data):
+        """Send a binary message (doesn't block)."""
+        self._send_frame(rfc6455.OP_BINARY, data)
+
+    def ping(self, data=b''):
+        self._send_frame(rfc6455.OP_PING, data)
+
+    @property
+    def write_buffer_size(self):
+        """Bytes written but not yet sent to the socket."""
+        return self.writer.transport.get_write_buffer_size()
+
+    async def drain(self):
+        """Wait until the write buffer is below the high water mark."""
+        await self.writer.drain()
+
+    def close(self, code=rfc6455.CLOSE_NORMAL):
+        """Send a close frame and close the stream."""
+        if not self.closed:
+            try:
+                self.writer.write(rfc6455.encode_close(code, mask=self.mask))
+            except Exception:
+                pass
+            self.closed = True
+            self.writer.close()
+
+    async def _read_frame(self):
+        reader = self.reader
+        fin, opcode, masked, length = rfc6455.parse_header(await reader.readexactly(2))
+        if length >= 126:
+            length = rfc6455.parse_extended_length(length, await reader.readexactly(2 if length == 126 else 8))
+        if length > self.max_size:
+            raise rfc6455.WebSocketError("frame is too large ({} bytes)".format(length))
+        mask_key = await reader.readexactly(4) if masked else None
+        payload = await reader.readexactly(length)
+        if mask_key is not None:
+            payload = rfc6455.apply_mask(mask_key, payload)
+        self.last_received = asyncio.get_event_loop().time()
+        return fin, opcode, payload
+
+    async def recv(self):
+        """Receive the next message, or return None if the connection closed."""
+        fragments = []
+        size = 0
+        while not self.closed:
+            try:
+                fin, opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                return None
+            except rfc6455.WebSocketError as error:
+                log.error('websocket error %s', error)
+                self.close(rfc6455.CLOSE_PROTOCOL_ERROR)
+                return None
+
+            if opcode == rfc6455.OP_PING:
+                self._send_frame(rfc6455.OP_PONG, payload)
+            elif opcode == rfc6455.OP_PONG:
+                pass
+            elif opcode == rfc6455.OP_CLOSE:
+                self.close()
+                return None
+            else:
+                if (opcode == rfc6455.OP_CONTINUATION) != bool(fragments):
+                    log.error('websocket error, unexpected continuation frame')
+                    self.close(rfc6455.CLOSE_PROTOCOL_ERROR)
+                    return None
+                size += len(payload)
+                if size > self.max_size:
+                    self.close(rfc6455.CLOSE_TOO_BIG)
+                    return None
+                if fin and not fragments:
+                    return payload
+                fragments.append(payload)
+                if fin:
+                    return b''.join(fragments)
+        return None
+
+
+class AsyncChannel(Channel):
+    """A channel that may also be read and written with coroutines."""
+
+    def __init__(self, client, number, **kwargs):
+        super(AsyncChannel, self).__init__(client, number, **kwargs)
+        # Created in the event loop, when first awaited
+        self._readable = None
+
+    def on_data(self, data):
+        super(AsyncChannel, self).on_data(data)
+        if self._readable is not None:
+            self._readable.set()
+
+    def on_close(self):
+        super(AsyncChannel, self).on_close()
+        if self._readable is not None:
+            self._readable.set()
+
+    async def aread(self, count):
+        """Read up to `count` bytes, waiting for data. Returns b'' when the channel closes."""
+        while not self.buffer and not self._closed:
+            if self._readable is None:
+                self._readable = asyncio.Event()
+            self._readable.clear()
+            await self._readable.wait()
+        return self.read(count)
+
+    async def awrite(self, data):
+        """Write data, waiting if the connection's write buffer is full."""
+        assert isinstance(data, bytes), "data must be bytes"
+        size = len(data)
+        self._open_window(size)
+        await self.client.channel_write_async(self.number, data, on_sent=lambda: self.on_sent(size))
+
+
+class AsyncWSClient(BaseClient):
+    """Interface to the M2M server, with an asyncio event loop.
+
+    If `loop` isn't given, `connect` runs a new event loop in a thread.
+
+    """
+
+    channel_class = AsyncChannel
+
+    ping_interval = 30
+    ping_timeout = 10
+
+    # Wait for the socket write buffer to drain when it is larger than this
+    sent_buffer_size = 64 * 1024
+
+    def __init__(self, url, uuid=None, log=None,
+                 channel_callback=None, control_callback=None,
+                 high_watermark=None, low_watermark=None,
+                 max_delay=0.002, max_frame_size=64 * 1024, loop=None):
+        self.url = url
+        self.loop = loop
+        self.connection = None
+        self._loop_thread_id = None
+        self._send_ready = None
+        super(AsyncWSClient, self).__init__(uuid=uuid,
+                                            log=log,
+                                            channel_callback=channel_callback,
+                                            control_callback=control_callback,
+                                            high_watermark=high_watermark,
+                                            low_watermark=low_watermark,
+                                            max_delay=max_delay,
+                                            max_frame_size=max_frame_size)
+
+    def __repr__(self):
+        return 'AsyncWSClient({!r})'.format(self.url)
+
+    def connect(self, wait=True, timeout=None):
+        """Connect and optionally wait until we are ready to communicate with the server."""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self._run_loop, name="m2m")
+            thread.daemon = True
+            thread.start()
+        else:
+            asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+        if wait:
+            return self.wait_ready(timeout=timeout)
+        return None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    def run_coroutine(self, coro):
+        """Run a coroutine in the client's event loop (from another thread), return a future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self):
+        """Connect, and handle packets until the connection closes."""
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self._loop_thread_id = threading.current_thread().ident
+        try:
+            self.connection = await WebSocketConnection.open(self.url)
+        except Exception as error:
+            log.error('unable to initialise websocket (%s)', error)
+            self.on_error(None, error)
+            return
+
+        self._send_ready = asyncio.Event()
+        writer = self.loop.create_task(self._write_loop(self.connection))
+        keep_alive = self.loop.create_task(self._keep_alive())
+        try:
+            self.on_open(None)
+            while True:
+                data = await self.connection.recv()
+                if data is None:
+                    break
+                self.on_message(None, data)
+        except asyncio.CancelledError:
+            log.info('wsclient exit requested')
+        except Exception:
+            log.exception('error in websocket')
+        finally:
+            keep_alive.cancel()
+            self.connection.close()
+            self._wake_writer()
+            await writer
+            self.on_error(None, None)
+            self.on_close(None)
+
+    async def _keep_alive(self):
+        """Ping the server, and close the connection if nothing is received."""
+        connection = self.connection
+        while not connection.closed:
+            await asyncio.sleep(self.ping_interval)
+            ping_time = self.loop.time()
+            connection.ping()
+            await asyncio.sleep(self.ping_timeout)
+            if connection.last_received < ping_time:
+                log.error('websocket ping timed out')
+                connection.close()
+
+    def _in_loop(self):
+        return threading.current_thread().ident == self._loop_thread_id
+
+    def _call_in_loop(self, function, *args):
+        if self._in_loop():
+            function(*args)
+        elif self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(function, *args)
+            except RuntimeError:
+                # Loop closed in the meantime
+                pass
+
+    def _wake_writer(self):
+        if self._send_ready is not None:
+            self._send_ready.set()
+
+    def on_queued(self):
+        self._call_in_loop(self._wake_writer)
+
+    async def _write_loop(self, connection):
+        """Send packets from the scheduler."""
+        scheduler = self.scheduler
+        while not connection.closed:
+            packet = scheduler.pop()
+            if packet is None:
+                self._send_ready.clear()
+                wait_time = scheduler.wait_time()
+                if wait_time is None:
+                    await self._send_ready.wait()
+                else:
+                    # A write is being held for more writes to merge with
+                    try:
+                        await asyncio.wait_for(self._send_ready.wait(), wait_time)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            packet_bytes, on_sent = packet
+            try:
+                connection.send_binary(packet_bytes)
+                # Keep the socket buffer small, so the scheduler decides what is sent next
+                if connection.write_buffer_size > self.sent_buffer_size:
+                    await connection.drain()
+            except Exception:
+                log.exception('error sending packet')
+                connection.close()
+            finally:
+                if on_sent is not None:
+                    on_sent()
+        scheduler.close()
+
+    async def channel_write_async(self, channel, data, on_sent=None):
+        """Write data to a channel, and wait until it has been sent."""
+        sent = self.loop.create_future()
+
+        def on_channel_sent():
+            if on_sent is not None:
+                on_sent()
+            if not sent.done():
+                sent.set_result(None)
+
+        self.channel_write(channel, data, on_sent=on_channel_sent)
+        await sent
+
+    def close(self, timeout=5):
+        if not self._closed and self.ready_event.is_set():
+            self.send(PacketType.request_leave)
+            # Can't wait for the server in the loop thread
+            if timeout and not self._in_loop():
+                self.close_event.wait(timeout)
+            self.clear_callbacks()
+        self._closed = True
+        self.identity = None
+        self.ready_event.set()
+        self._call_in_loop(self._close_connection)
+
+    def _close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+        self._wake_writer()
+
+    def on_error(self, app, error):
+        """Called when the connection fails or closes."""
+        if error:
+            self.log.error("websocket error %r", error)
+        self._closed = True
+        self.identity = None
+        self.close_event.set()
+        self.ready_event.set()
+        self.scheduler.close()
+        self.hard_close_channels()
+        self.clear_callbacks()
+
+    def on_close(self, app):
+        """Called when the connection closes."""
+        self.log.debug('connection closed')
+
@@ -8,6 +8,7 @@ Encode / Decode Bencode (http://en.wikipedia.org/wiki/Bencode)
 
 import io
 import sys
+import threading
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
@@ -53,89 +54,203 @@ class DecoderError(Exception):
         return "{} (#{}), {}".format(DecoderError.error_text[self.code], self.code, self.text)
 
 
+# Cached length prefixes (b'5:') and integers (b'i5e') for common values
+_CACHE_SIZE = 1024
+_length_prefixes = [str(n).encode('ascii') + b':' for n in range(_CACHE_SIZE)]
+_integers = [b'i' + str(n).encode('ascii') + b'e' for n in range(_CACHE_SIZE)]
+
+
+def _encode_length(length):
+    if length < _CACHE_SIZE:
+        return _length_prefixes[length]
+    return str(length).encode('ascii') + b':'
+
+
+def _encode_integer(number):
+    if 0 <= number < _CACHE_SIZE:
+        return _integers[number]
+    return b'i' + str(number).encode('ascii') + b'e'
+
+
+class Encoder(object):
+    """Encodes objects to Bencode in to a reusable buffer.
+
+    Not thread safe; use the module level `encode` function, which keeps an encoder per thread.
+
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def encode(self, obj):
+        """Encode to Bencode, return bytes"""
+        buffer = self.buffer
+        del buffer[:]
+        # Iterators over the contents of the lists / dicts being encoded
+        stack = [iter((obj,))]
+        while stack:
+            for value in stack[-1]:
+                if isinstance(value, bytes):
+                    buffer += _encode_length(len(value))
+                    buffer += value
+                elif isinstance(value, text_type):
+                    value = value.encode('utf-8')
+                    buffer += _encode_length(len(value))
+                    buffer += value
+                elif isinstance(value, number_types):
+                    buffer += _encode_integer(int(value))
+                elif isinstance(value, (list, tuple)):
+                    buffer += b'l'
+                    stack.append(iter(value))
+                    break
+                elif isinstance(value, dict):
+                    buffer += b'd'
+                    items = sorted(value.items()) if len(value) > 1 else value.items()
+                    key_values = []
+                    for k, v in items:
+                        if not isinstance(k, bytes):
+                            raise EncodingError("dict keys must be bytes")
+                        key_values.append(k)
+                        key_values.append(v)
+                    stack.append(iter(key_values))
+                    break
+                elif isinstance(value, (bytearray, memoryview)):
+                    value = memoryview(value)
+                    buffer += _encode_length(value.nbytes if PY3 else len(value) * value.itemsize)
+                    buffer += value
+                else:
+                    raise EncodingError('value {!r} can not be encoded in Bencode'.format(value))
+            else:
+                stack.pop()
+                if stack:
+                    buffer += b'e'
+        return bytes(buffer)
+
+
+_encoders = threading.local()
+
+
 def encode(obj):
     """Encode to Bencode, return bytes"""
-    binary = []
-    append = binary.append
-
-    def add_encode(obj):
-        if isinstance(obj, bytes):
-            append(b"{}:{}".format(len(obj), obj))
-        elif isinstance(obj, text_type):
-            obj = obj.encode('utf-8')
-            append(b"{}:{}".format(len(obj), obj))
-        elif isinstance(obj, number_types):
-            append(b"i{}e".format(obj))
-        elif isinstance(obj, (list, tuple)):
-            append(b"l")
-            for item in obj:
-                add_encode(item)
-            append(b'e')
-        elif isinstance(obj, dict):
-            append(b'd')
-            keys = sorted(obj.keys())
-            for k in keys:
-                if not isinstance(k, bytes):
-                    raise EncodingError("dict keys must be bytes")
-                add_encode(k)
-                add_encode(obj[k])
-            append(b'e')
-        else:
-            raise EncodingError('value {!r} can not be encoded in Bencode'.format(obj))
+    try:
+        encoder = _encoders.encoder
+    except AttributeError:
+        encoder = _encoders.encoder = Encoder()
+    return encoder.encode(obj)
+
 
-    add_encode(obj)
-    return b''.join(binary)
+def encode_channel_packet(packet_type, channel, data):
+    """Encode a packet of the form [packet_type, channel, data], return bytes.
 
+    Equivalent to encode([packet_type, channel, data]), for sending channel data with a single copy
+    of `data`.
 
-def decode(data):
-    """Decode Bencode, return an object."""
-    assert isinstance(data, bytes), "decode takes bytes"
-    return _decode(io.BytesIO(data).read)
+    """
+    return b''.join((b'l',
+                     _encode_integer(int(packet_type)),
+                     _encode_integer(int(channel)),
+                     _encode_length(len(data)),
+                     data,
+                     b'e'))
 
 
-def _decode(read):
-    """Decode bebcode, `read` should be a callable that returns number of bytes."""
-    # TODO: Some input validation
-    obj_type = read(1)
-    if obj_type == b'e':
-        return None
-    if obj_type == b'i':
-        number_bytes = b''
-        while 1:
-            c = read(1)
-            if not c.isdigit():
-                if c != b'e':
-                    raise DecodeError('illegal digit in size')
-                break
-            number_bytes += c
-        number = int(number_bytes)
-        return number
-    elif obj_type == b'l':
-        l = []
-        while 1:
-            i = _decode(read)
-            if i is None:
-                break
-            l.append(i)
-        return l
-    elif obj_type == b'd':
-        kv = []
-        while 1:
-            k = _decode(read)
-            if k is None:
-                break
-            v = _decode(read)
-            kv.append((k, v))
-        return dict(kv)
-    else:
-        size_bytes = obj_type
+# Maximum nesting of lists / dicts
+MAX_DEPTH = 100
+
+# Strings at least this size are returned as memoryview slices, when decoding with zero_copy=True
+ZERO_COPY_SIZE = 4096
+
+# Byte values, compared against data[pos] (an int on Py3, a 1 byte str on Py2)
+_INTEGER = b'i'[0]
+_LIST = b'l'[0]
+_DICT = b'd'[0]
+_END = b'e'[0]
+_DIGITS = frozenset(b'0123456789')
+
+
+# Placeholder for a dict key that hasn't been decoded yet
+_NO_KEY = object()
+
+
+def decode(data, max_depth=MAX_DEPTH, max_size=None, zero_copy=False):
+    """Decode Bencode, return an object.
+
+    data -- Bencoded bytes.
+    max_depth -- Maximum nesting of lists and dicts.
+    max_size -- Maximum size of `data`, or None for no limit.
+    zero_copy -- Return strings of ZERO_COPY_SIZE bytes or more as memoryview slices of `data`,
+    rather than copies.
+
+    """
+    if not isinstance(data, bytes):
+        raise DecodeError("decode takes bytes")
+    end = len(data)
+    if max_size is not None and end > max_size:
+        raise DecodeError("data exceeds maximum size ({} bytes)".format(max_size))
+    index = data.index
+    view = None
+
+    # Lists and dicts under construction, and the pending key of each enclosing dict
+    stack = []
+    keys = []
+    key = _NO_KEY
+    pos = 0
+    try:
         while 1:
-            c = read(1)
-            if c == b':':
+            c = data[pos]
+            if c in _DIGITS:
+                colon = index(b':', pos)
+                start = colon + 1
+                pos = start + int(data[pos:colon])
+                if pos > end:
+                    raise DecodeError("string at {} exceeds the data".format(start))
+                if zero_copy and pos - start >= ZERO_COPY_SIZE:
+                    if view is None:
+                        view = memoryview(data)
+                    value = view[start:pos]
+                else:
+                    value = data[start:pos]
+            elif c == _INTEGER:
+                number_end = index(b'e', pos)
+                value = int(data[pos + 1:number_end])
+                pos = number_end + 1
+            elif c == _END:
+                if not stack:
+                    raise DecodeError("unexpected end marker at {}".format(pos))
+                if key is not _NO_KEY:
+                    raise DecodeError("dict has a key without a value at {}".format(pos))
+                value = stack.pop()
+                key = keys.pop()
+                pos += 1
+            elif c == _LIST or c == _DICT:
+                if len(stack) >= max_depth:
+                    raise DecodeError("maximum depth ({}) exceeded".format(max_depth))
+                stack.append([] if c == _LIST else {})
+                keys.append(key)
+                key = _NO_KEY
+                pos += 1
+                continue
+            else:
+                raise DecodeError("unexpected {!r} at {}".format(data[pos:pos + 1], pos))
+
+            if not stack:
                 break
-            size_bytes += c
-        size = int(size_bytes)
-        return read(size)
+            container = stack[-1]
+            if container.__class__ is list:
+                container.append(value)
+            elif key is _NO_KEY:
+                key = value
+            else:
+                container[key] = value
+                key = _NO_KEY
+    except IndexError:
+        raise DecodeError("unexpected end of data")
+    except (ValueError, TypeError):
+        raise DecodeError("badly formatted data at {}".format(pos))
+
+    if pos != end:
+        raise DecodeError("unexpected data after position {}".format(pos))
+    return value
 
 
 class StringDecoder(object):
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+A FIFO byte buffer for incoming channel data.
+
+Data is stored as the chunks it arrived in. A partial read of a chunk advances an offset rather
+than slicing the remainder, so reading a large backlog in small pieces copies each byte once.
+
+"""
+
+from collections import deque
+
+from ..compat import implements_bool, PY2
+
+
+@implements_bool
+class ChunkBuffer(object):
+    """A queue of bytes chunks, read as a stream."""
+
+    def __init__(self):
+        self._chunks = deque()
+        # Bytes already read from the first chunk
+        self._offset = 0
+        self._size = 0
+
+    def __repr__(self):
+        return "<chunkbuffer {} bytes in {} chunks>".format(self._size, len(self._chunks))
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def append(self, data):
+        """Add bytes (or a memoryview) to the end of the buffer."""
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def clear(self):
+        self._chunks.clear()
+        self._offset = 0
+        self._size = 0
+
+    def _consume(self, count):
+        """Remove up to `count` bytes, and return a list of memoryviews of them."""
+        chunks = self._chunks
+        offset = self._offset
+        views = []
+        remaining = count
+        while chunks and remaining:
+            chunk = chunks[0]
+            available = len(chunk) - offset
+            if remaining < available:
+                views.append(memoryview(chunk)[offset:offset + remaining])
+                offset += remaining
+                remaining = 0
+            else:
+                views.append(memoryview(chunk)[offset:] if offset else memoryview(chunk))
+                chunks.popleft()
+                offset = 0
+                remaining -= available
+        self._offset = offset
+        self._size -= count - remaining
+        return views
+
+    def peek(self):
+        """Get a memoryview of the unread part of the first chunk, without removing it."""
+        if not self._chunks:
+            return memoryview(b'')
+        return memoryview(self._chunks[0])[self._offset:]
+
+    def skip(self, count):
+        """Remove up to `count` bytes without reading them."""
+        self._consume(count)
+
+    def read(self, count=None):
+        """Remove and return up to `count` bytes (or all bytes if `count` is None)."""
+        if count is None or count > self._size:
+            count = self._size
+        if not count:
+            return b''
+        chunks = self._chunks
+        head = chunks[0]
+        if not self._offset and len(head) == count and isinstance(head, bytes):
+            # Whole chunk, no copy required
+            chunks.popleft()
+            self._size -= count
+            return head
+        views = self._consume(count)
+        if len(views) == 1:
+            return views[0].tobytes()
+        if PY2:
+            return b''.join(view.tobytes() for view in views)
+        return b''.join(views)
+
+    def readinto(self, buffer):
+        """Remove bytes in to a writable buffer, return the number of bytes read."""
+        target = memoryview(buffer).cast('B') if hasattr(memoryview, 'cast') else memoryview(buffer)
+        position = 0
+        for view in self._consume(len(target)):
+            size = len(view)
+            target[position:position + size] = view
+            position += size
+        return position
@@ -4,6 +4,10 @@ from __future__ import print_function
 """
 Dispatches incoming packets
 
+Handler signatures are inspected once, when the dispatcher is created. Each packet class is then
+bound to its handler in a call table, which reads the packet attributes straight in to the handler
+arguments.
+
 """
 
 
@@ -11,6 +15,12 @@ from dataplicity.compat import text_type
 
 import logging
 import inspect
+from operator import attrgetter
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # Py2
+    from inspect import getargspec
 
 
 class PacketFormatError(Exception):
@@ -29,17 +39,30 @@ def expose(packet_type):
     return deco
 
 
+def _make_args_getter(attrib_names):
+    """Make a function that returns a tuple of packet attributes"""
+    if not attrib_names:
+        return lambda packet: ()
+    getter = attrgetter(*attrib_names)
+    if len(attrib_names) == 1:
+        return lambda packet: (getter(packet),)
+    return getter
+
+
 class Dispatcher(object):
     """
     Base class to dispatch to handlers for a packet.
 
     May also be used to dispatch to methods of another object, rather than a base class.
 
+    If `debug` is True, the handler arguments are checked for every packet.
+
     """
 
-    def __init__(self, packet_cls=None, handler_instance=None, log=None):
+    def __init__(self, packet_cls=None, handler_instance=None, log=None, debug=False):
         super(Dispatcher, self).__init__()
         self._handler_instance = handler_instance or self
+        self.debug = debug
 
         if log is None:
             self.log = logging.getLogger('dispatcher')
@@ -48,10 +71,13 @@ class Dispatcher(object):
 
         self._packet_cls = packet_cls
         self._packet_handlers = {}
+        self._arg_counts = {}
+        self._call_table = {}
         self._init_dispatcher()
 
     def set_packet_class(self, packet_cls):
         self._packet_cls = packet_cls
+        self._init_call_table()
 
     def _init_dispatcher(self):
         for method_name in dir(self._handler_instance):
@@ -61,6 +87,40 @@ class Dispatcher(object):
             if getattr(method, '_dispatcher_exposed', False):
                 packet_type = method._dispatcher_packet_type
                 self._packet_handlers[packet_type] = method
+                self._arg_counts[packet_type] = len(getargspec(method)[0])
+        self._init_call_table()
+
+    def _init_call_table(self):
+        """Bind handlers to the registered packet classes."""
+        self._call_table.clear()
+        if self._packet_cls is not None:
+            for packet_type, packet_cls in self._packet_cls.registry.items():
+                if packet_type in self._packet_handlers:
+                    self._bind_handler(packet_cls)
+
+    def _bind_handler(self, packet_cls):
+        """Make a call table entry for a packet class.
+
+        The entry is a tuple of (method, args getter, keyword attributes, error). The first
+        attributes are passed as positional arguments, as many as the handler has parameters.
+
+        """
+        packet_type = packet_cls.type
+        method = self._packet_handlers[packet_type]
+        attrib_names = [attrib_name for attrib_name, _ in packet_cls.attributes]
+        arg_count = self._arg_counts[packet_type]
+        arg_names = attrib_names[:arg_count]
+        kwarg_names = attrib_names[arg_count:]
+        # The packet class fixes the arguments, so a bad signature can be detected here
+        try:
+            inspect.getcallargs(method, packet_type, *arg_names, **{name: None for name in kwarg_names})
+        except TypeError as e:
+            error = text_type(e)
+        else:
+            error = None
+        call = (method, _make_args_getter(arg_names), kwarg_names, error)
+        self._call_table[packet_cls] = call
+        return call
 
     def dispatch(self, packet_type, packet_body):
         """Dispatch a packet to appropriate handler"""
@@ -75,26 +135,27 @@ class Dispatcher(object):
         if not getattr(packet, 'no_log', False):
             self.log.debug('received %r', packet)
         packet_type = packet.type
-        method = self._packet_handlers.get(packet_type, None)
-
-        if method is None:
-            self.on_missing_handler(packet)
-            return None
-
-        arg_spec = inspect.getargspec(method)
-        args, kwargs = packet.get_method_args(len(arg_spec[0]))
-
-        try:
-            inspect.getcallargs(method, packet_type, *args, **kwargs)
-        except TypeError as e:
-            raise PacketFormatError(text_type(e))
-
-        try:
-            ret = method(packet_type, *args, **kwargs)
-        except Exception:
-            raise
-        else:
-            return ret
+        call = self._call_table.get(packet.__class__, None)
+        if call is None:
+            if packet_type not in self._packet_handlers:
+                self.on_missing_handler(packet)
+                return None
+            call = self._bind_handler(packet.__class__)
+
+        method, get_args, kwarg_names, error = call
+        if error is not None:
+            raise PacketFormatError(error)
+        if self.debug:
+            args, kwargs = packet.get_method_args(self._arg_counts[packet_type])
+            try:
+                inspect.getcallargs(method, packet_type, *args, **kwargs)
+            except TypeError as e:
+                raise PacketFormatError(text_type(e))
+            return method(packet_type, *args, **kwargs)
+        if kwarg_names:
+            kwargs = {name: getattr(packet, name) for name in kwarg_names}
+            return method(packet_type, *get_args(packet), **kwargs)
+        return method(packet_type, *get_args(packet))
 
     def on_missing_handler(self, packet):
         """Called when no handler is available to handle `packet`"""
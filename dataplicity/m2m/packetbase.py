@@ -4,6 +4,11 @@ from __future__ import print_function
 """
 Packet management
 
+Packet classes declare their `attributes`, a list of (name, type). When a packet class is created,
+PacketMeta generates `__slots__` for the attributes, and compiles an __init__, encode,
+encode_binary and from_body specialised for them, so that creating and encoding a packet is only a
+handful of operations.
+
 """
 
 from dataplicity.m2m import bencode
@@ -22,21 +27,98 @@ class UnknownPacketError(PacketError):
     """A packet we don't know how to handle."""
 
 
+# Default for missing packet attributes
+_MISSING = object()
+
+
+def _check_attribute(packet, attrib_name, value, attrib_type):
+    """Check (and convert) an attribute value that doesn't have the exact expected type."""
+    if value is _MISSING:
+        raise PacketFormatError("missing attribute '{}', in {!r}".format(attrib_name, packet))
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+    if attrib_type is not None and not isinstance(value, attrib_type):
+        raise PacketFormatError("parameter '{}' should be a {!r}, in {!r} (not {!r})".format(attrib_name, attrib_type, packet, type(value)))
+    return value
+
+
+def _compile_packet_methods(packet_cls):
+    """Generate methods specialised for the attributes of a packet class."""
+    attributes = packet_cls.attributes
+    names = [attrib_name for attrib_name, _ in attributes]
+    packet_type = int(packet_cls.type)
+    namespace = {
+        "_MISSING": _MISSING,
+        "_check": _check_attribute,
+        "_text_type": text_type,
+        "_encode": bencode.encode,
+        "_encode_channel_packet": bencode.encode_channel_packet
+    }
+
+    code = ["def __init__(self, {}*_args, **_kwargs):".format(''.join("{}=_MISSING, ".format(attrib_name) for attrib_name in names))]
+    for index, (attrib_name, attrib_type) in enumerate(attributes):
+        if attrib_type is None:
+            code.append("    if {0} is _MISSING or {0}.__class__ is _text_type:".format(attrib_name))
+        else:
+            # Check the exact type first, and fall back to _check for subclasses / text
+            exact_type = int if attrib_type is int_types else attrib_type
+            namespace["_exact_type{}".format(index)] = exact_type
+            namespace["_type{}".format(index)] = attrib_type
+            code.append("    if {}.__class__ is not _exact_type{}:".format(attrib_name, index))
+        code.append("        {0} = _check(self, {0!r}, {0}, _type{1})".format(attrib_name, index))
+        namespace.setdefault("_type{}".format(index), None)
+    for attrib_name in names:
+        code.append("    self.{0} = {0}".format(attrib_name))
+    if packet_cls.validate is not PacketBaseType.validate:
+        code.append("    self.validate()")
+    code.append("    pass")
+
+    values = ''.join(", self.{}".format(attrib_name) for attrib_name in names)
+    code.append("def encode(self):")
+    code.append("    return [{}{}]".format(packet_type, values))
+    code.append("def encode_binary(self):")
+    if [attrib_type for _, attrib_type in attributes] in ([int_types, bytes], [int, bytes]):
+        code.append("    return _encode_channel_packet({}{})".format(packet_type, values))
+    else:
+        code.append("    return _encode([{}{}])".format(packet_type, values))
+    code.append("def from_body(cls, packet_body):")
+    code.append("    return cls(*packet_body[:{}])".format(len(names)))
+
+    exec("\n".join(code), namespace)
+    packet_cls.__init__ = namespace['__init__']
+    packet_cls.encode = namespace['encode']
+    packet_cls.encode_binary = namespace['encode_binary']
+    packet_cls.from_body = classmethod(namespace['from_body'])
+
+
 class PacketMeta(type):
     """Maintains a registry of packet classes."""
 
     def __new__(mcs, name, bases, attrs):
+        if '__slots__' not in attrs:
+            # Slots for attributes not already in a base class
+            attributes = attrs.get('attributes', getattr(bases[0], 'attributes', []))
+            base_slots = set()
+            for base in bases:
+                for cls in base.__mro__:
+                    base_slots.update(getattr(cls, '__slots__', ()))
+            attrs['__slots__'] = tuple(attrib_name for attrib_name, _ in attributes
+                                       if attrib_name not in base_slots)
         packet_cls = super(PacketMeta, mcs).__new__(mcs, name, bases, attrs)
         if bases[0] is not object:
             if packet_cls.type >= 0:
                 assert packet_cls.type not in packet_cls.registry, "packet type {!r} has already been registered".format(packet_cls, type)
                 packet_cls.registry[packet_cls.type] = packet_cls
+                if '__init__' not in attrs and 'init_params' not in attrs:
+                    _compile_packet_methods(packet_cls)
         return packet_cls
 
 
 class PacketBaseType(object):
     """Metaclass to register packet type."""
 
+    __slots__ = ()
+
     registry = {}
 
     # Packet type
@@ -69,7 +151,10 @@ class PacketBaseType(object):
         packet_cls = cls.registry.get(cls.process_packet_type(packet_type))
         if packet_cls is None:
             raise ValueError('no packet type {}'.format(packet_type))
-        return packet_cls(*args, **kwargs)
+        try:
+            return packet_cls(*args, **kwargs)
+        except TypeError as e:
+            raise PacketFormatError("unable to create {} ({})".format(packet_cls.__name__, e))
 
     @classmethod
     def from_bytes(cls, packet_bytes):
@@ -51,10 +51,24 @@ class Interceptor(object):
             size = [80, 24]
         self.size = size
         self.master_fd = None
+        self.pid = None
 
     def spawn(self, argv=None):
         '''
-        Create a spawned process.
+        Create a spawned process, and copy its output until it exits.
+        '''
+        self.fork(argv)
+        try:
+            self._copy()
+        except (IOError, OSError):
+            pass
+
+        os.close(self.master_fd)
+        self.master_fd = None
+
+    def fork(self, argv=None):
+        '''
+        Create a spawned process, with a pty in self.master_fd.
         Based on the code for pty.spawn().
         '''
         assert self.master_fd is None
@@ -86,13 +100,6 @@ class Interceptor(object):
             return
 
         self._init_fd()
-        try:
-            self._copy()
-        except (IOError, OSError):
-            pass
-
-        os.close(master_fd)
-        self.master_fd = None
 
     def _init_fd(self):
         '''
@@ -125,6 +132,7 @@ class Interceptor(object):
         assert self.master_fd is not None
         master_fd = self.master_fd
         while 1:
+            self.wait_master_read()
             rfds, wfds, xfds = select.select([master_fd], [], [])
             if master_fd in rfds:
                 data = os.read(self.master_fd, 1024 * 64)
@@ -152,6 +160,11 @@ class Interceptor(object):
             n = os.write(master_fd, data)
             data = data[n:]
 
+    def wait_master_read(self):
+        '''
+        Called before reading from the child process, may block to throttle the child's output.
+        '''
+
     def master_read(self, data):
         '''
         Called when there is data to be sent from the child process back to the user.
@@ -3,30 +3,92 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import errno
+import fcntl
 import json
 import logging
 import os
 import signal
 import shlex
+import threading
+import time
+import zlib
 
 from . import proxy
+from .chunkbuffer import ChunkBuffer
+from .screen import ScreenDiffFilter
+from .scrollback import Scrollback
+from ..reactor import selectors
 
 log = logging.getLogger('dataplicity.m2m')
 
 
+_WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
 class RemoteProcess(proxy.Interceptor):
-    """Process managed remotely over m2m."""
+    """Process managed remotely over m2m.
+
+    The process's pty is read and written in a reactor thread, which may be shared by many
+    processes. Input from the channel is buffered until the pty will take it, and the pty is
+    only read while the channel is writable.
+
+    The remote side may ask for output to be compressed, and for full screen apps to be sent
+    as screen changes (see screen.py), with a control packet such as:
+
+        {"type": "terminal_options", "compression": ["deflate"], "screen_diff": true}
+
+    The reply has the options used for output that follows it, e.g.:
+
+        {"type": "terminal_options", "compression": "deflate", "screen_diff": true}
+
+    Compressed output is a zlib stream, flushed (Z_SYNC_FLUSH) at the end of every write.
 
-    def __init__(self, command, channel, user=None, group=None, size=None):
+    A process with a `session` name is detached, rather than killed, when its channel closes. It
+    keeps running with output going to a scrollback buffer, until `attach` gives it a new channel
+    (and the scrollback is replayed), or `detach_timeout` seconds pass.
+
+    """
+
+    # Max to read at-a-time
+    BUFFER_SIZE = 1024 * 64
+    # Seconds between checks for the process exiting, where pidfds aren't supported
+    REAP_INTERVAL = 1.0
+    # Minimum seconds between screen updates, in screen diff mode
+    FRAME_INTERVAL = 0.05
+    # Supported values for the compression option, in order of preference
+    COMPRESSION = ['deflate']
+
+    def __init__(self, command, channel, reactor, user=None, group=None, size=None,
+                 session=None, detach_timeout=300.0, scrollback=64 * 1024):
         self.command = command
         self.channel = channel
+        self.reactor = reactor
         self.size = size
+        self.session = session
+        self.detach_timeout = detach_timeout
+        # Recent output, replayed when a session is attached to a new channel
+        self.scrollback = Scrollback(scrollback) if session is not None else None
+        self._detach_timer = None
 
+        self._lock = threading.Lock()
+        # Data from the channel, to write to the pty
+        self.write_buffer = ChunkBuffer()
+        self._flush_pending = False
+        self._pidfd = None
+        self._exited = False
+        self.exit_status = None
+        self._closing = False
         self._closed = False
+        # Output encoding, agreed with terminal_options
+        self._screen_filter = None
+        self._compressor = None
+        self._frame_timer = None
+        self._last_frame = 0.0
 
-        self.channel.set_callbacks(on_data=self.on_data,
-                                   on_close=self.on_close,
-                                   on_control=self.on_control)
+        self._set_callbacks(channel)
 
         super(RemoteProcess, self).__init__(user=user, group=group, size=size)
 
@@ -34,17 +96,227 @@ class RemoteProcess(proxy.Interceptor):
     def is_closed(self):
         return self._closed
 
+    @property
+    def is_detached(self):
+        return self.channel is None
+
     def __repr__(self):
         return "RemoteProcess({!r}, {!r})".format(self.command, self.channel)
 
-    def run(self):
-        self.spawn(shlex.split(self.command))
+    def _set_callbacks(self, channel):
+        channel.set_callbacks(on_data=self.on_data,
+                              on_close=lambda: self.on_close(channel),
+                              on_control=self.on_control,
+                              on_writable=self.on_writable)
 
-    def on_data(self, data):
+    def start(self):
+        """Start the process (doesn't block)."""
+        self.fork(shlex.split(self.command))
+        flags = fcntl.fcntl(self.master_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.reactor.call_soon(self._start)
+
+    def _start(self):
+        if self._closing:
+            return
+        self._update_events()
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open is not None:
+            try:
+                self._pidfd = pidfd_open(self.pid)
+            except OSError:
+                # Kernel too old
+                self._pidfd = None
+        if self._pidfd is not None:
+            # Readable when the process exits
+            self.reactor.register(self._pidfd, selectors.EVENT_READ, lambda events: self._reap())
+        else:
+            self.reactor.call_later(self.REAP_INTERVAL, self._poll_exit)
+
+    def _update_events(self):
+        """Wait for the pty events we can handle."""
+        if self._closing:
+            return
+        events = 0
+        # Detached processes are always read, so they don't block on output
+        if self.channel is None or self.channel.writable:
+            events |= selectors.EVENT_READ
+        if self.write_buffer:
+            events |= selectors.EVENT_WRITE
+        self.reactor.modify(self.master_fd, events, self._on_events)
+
+    def _on_events(self, events):
+        if events & selectors.EVENT_WRITE:
+            self._flush()
+        if events & selectors.EVENT_READ and not self._closing:
+            self._read()
+
+    def _read(self):
         try:
-            self.stdin_read(data)
-        except:
+            data = os.read(self.master_fd, self.BUFFER_SIZE)
+        except OSError as error:
+            if error.errno in _WOULD_BLOCK:
+                return
+            # EIO means the process has closed the pty
+            data = b''
+        if not data:
+            self._close()
+            return
+        self.master_read(data)
+        if self.channel is not None and not self.channel.writable:
+            # Stop reading until the channel's window reopens, which blocks the process
+            # when the pty buffer fills
+            self._update_events()
+
+    def _flush(self):
+        """Write as much buffered input as the pty will take."""
+        if self._closing:
+            return
+        with self._lock:
+            self._flush_pending = False
+            write_buffer = self.write_buffer
+            try:
+                while write_buffer:
+                    data = write_buffer.peek()
+                    written = os.write(self.master_fd, data)
+                    write_buffer.skip(written)
+                    if written < len(data):
+                        break
+            except OSError as error:
+                if error.errno not in _WOULD_BLOCK:
+                    log.debug('error writing to %r (%s)', self, error)
+                    write_buffer.clear()
+        self._update_events()
+
+    def _poll_exit(self):
+        if not self._reap():
+            self.reactor.call_later(self.REAP_INTERVAL, self._poll_exit)
+
+    def _reap(self):
+        """Check if the process has exited, and clean up if it has."""
+        if self._exited:
+            return True
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError as error:
+            if error.errno != errno.ECHILD:
+                raise
+            pid, status = self.pid, None
+        if not pid:
+            return False
+        self._exited = True
+        self.exit_status = status
+        log.debug('%r exited with status %s', self, status)
+        if self._pidfd is not None:
+            self.reactor.unregister(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        if self._closing:
+            self._closed = True
+        else:
+            self._drain()
+            self._close()
+        return True
+
+    def _drain(self):
+        """Send output remaining in the pty."""
+        while True:
+            try:
+                data = os.read(self.master_fd, self.BUFFER_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            self.master_read(data)
+
+    def _close(self):
+        if self._closing:
+            return
+        self._send_frame()
+        self._closing = True
+        if self._detach_timer is not None:
+            self.reactor.cancel(self._detach_timer)
+            self._detach_timer = None
+        if self.master_fd is not None:
+            self.reactor.unregister(self.master_fd)
+            os.close(self.master_fd)
+            self.master_fd = None
+        with self._lock:
+            self.write_buffer.clear()
+        if self.channel is not None:
             self.channel.close()
+        if self.pid is None or self._exited:
+            self._closed = True
+            return
+        log.debug('sending kill signal to %r', self)
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        if self._pidfd is None:
+            self.reactor.call_later(0, self._poll_exit)
+
+    def close(self):
+        """Kill the process and close the channel (doesn't block)."""
+        self.reactor.call_soon(self._close)
+
+    def detach(self):
+        """Detach a session from its channel, or close the process if it isn't a session."""
+        self.reactor.call_soon(self._detach, self.channel)
+
+    def _detach(self, channel):
+        if self._closing or self.channel is None or channel is not self.channel:
+            return
+        if self.session is None or not self.detach_timeout:
+            self._close()
+            return
+        log.debug('detaching %r', self)
+        self._send_frame()
+        self._reset_options()
+        self.channel = None
+        self._detach_timer = self.reactor.call_later(self.detach_timeout, self._on_detach_timeout)
+        self._update_events()
+
+    def _on_detach_timeout(self):
+        self._detach_timer = None
+        log.debug('%r was detached for %s seconds', self, self.detach_timeout)
+        self._close()
+
+    def attach(self, channel, size=None):
+        """Attach a new channel to a session, and replay its scrollback (doesn't block)."""
+        self._set_callbacks(channel)
+        self.reactor.call_soon(self._attach, channel, size)
+
+    def _attach(self, channel, size):
+        if self._closing:
+            log.debug('%r closed before it could be attached to %r', self, channel)
+            channel.close()
+            return
+        if self._detach_timer is not None:
+            self.reactor.cancel(self._detach_timer)
+            self._detach_timer = None
+        previous = self.channel
+        self._send_frame()
+        self._reset_options()
+        self.channel = channel
+        if previous is not None and previous is not channel:
+            # Taken over by the new channel
+            previous.close()
+        log.debug('attached %r', self)
+        if self.scrollback:
+            self._send(self.scrollback.getvalue())
+        if size is not None:
+            self._resize_terminal(size)
+        self._update_events()
+
+    def on_data(self, data):
+        self.stdin_read(data)
+
+    def on_writable(self):
+        self.reactor.call_soon(self._update_events)
+
+    def on_close(self, channel):
+        self.reactor.call_soon(self._detach, channel)
 
     def on_control(self, data):
         try:
@@ -56,28 +328,88 @@ class RemoteProcess(proxy.Interceptor):
         if control_type == "window_resize":
             size = control['size']
             log.debug('resize terminal to {} X {}'.format(*size))
-            self.resize_terminal(size)
+            self.reactor.call_soon(self._resize_terminal, size)
+        elif control_type == "terminal_options":
+            self.reactor.call_soon(self._set_options, control)
         else:
             log.warning('unknown control packet {}'.format(control_type))
 
-    def on_close(self):
-        self.close()
+    def _resize_terminal(self, size):
+        if self.master_fd is not None:
+            self.resize_terminal(size)
+            if self._screen_filter is not None:
+                columns, rows = size
+                self._screen_filter.resize(columns, rows)
 
-    def master_read(self, data):
+    def _set_options(self, control):
+        """Agree output options with the remote side."""
+        if self._closing:
+            return
+        requested = control.get('compression') or []
+        compression = next((name for name in self.COMPRESSION if name in requested), None)
+        screen_diff = bool(control.get('screen_diff', False))
+        log.debug('%r terminal options compression=%s screen_diff=%s', self, compression, screen_diff)
+
+        # Output before the reply uses the previous options
+        self._send_frame()
+        if self.channel is None:
+            return
+        reply = {"type": "terminal_options", "compression": compression, "screen_diff": screen_diff}
+        self.channel.write_control(json.dumps(reply).encode('utf-8'))
+        self._compressor = zlib.compressobj() if compression == 'deflate' else None
+        if not screen_diff:
+            self._screen_filter = None
+        elif self._screen_filter is None:
+            columns, rows = self.size
+            self._screen_filter = ScreenDiffFilter(columns, rows)
+
+    def _reset_options(self):
+        """Go back to uncompressed output, for a new channel."""
+        if self._frame_timer is not None:
+            self.reactor.cancel(self._frame_timer)
+            self._frame_timer = None
+        self._compressor = None
+        self._screen_filter = None
+
+    def _send(self, data):
+        if not data or self.channel is None:
+            return
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
         self.channel.write(data)
+
+    def _schedule_frame(self):
+        if self._frame_timer is None:
+            delay = max(0.0, self._last_frame + self.FRAME_INTERVAL - _clock())
+            self._frame_timer = self.reactor.call_later(delay, self._send_frame)
+
+    def _send_frame(self):
+        """Send screen changes."""
+        if self._frame_timer is not None:
+            self.reactor.cancel(self._frame_timer)
+            self._frame_timer = None
+        if self._screen_filter is not None and self._screen_filter.pending:
+            self._last_frame = _clock()
+            self._send(self._screen_filter.render())
+
+    def master_read(self, data):
+        if self.scrollback is not None:
+            self.scrollback.append(data)
+        screen_filter = self._screen_filter
+        if screen_filter is not None:
+            data = screen_filter.feed(data)
+            if screen_filter.pending:
+                self._schedule_frame()
+        self._send(data)
         super(RemoteProcess, self).master_read(data)
 
     def write_master(self, data):
-        super(RemoteProcess, self).write_master(data)
-
-    def close(self):
-        if not self._closed:
-            log.debug('sending kill signal to %r', self)
-            # TODO: Implement a non-blocking kill
-            os.kill(self.pid, signal.SIGKILL)
-            os.waitpid(self.pid, 0)
-            log.debug('killed %r', self)
-            self._closed = True
+        with self._lock:
+            self.write_buffer.append(data)
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        self.reactor.call_soon(self._flush)
 
     def __enter__(self):
         return self
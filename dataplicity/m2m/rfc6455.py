@@ -0,0 +1,169 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+The parts of the websocket protocol (RFC 6455) needed by the asyncio M2M client.
+
+Only the opening handshake and framing are implemented here, the I/O is in asyncclient.py.
+
+"""
+
+from dataplicity.compat import PY2
+
+from base64 import b64encode
+from hashlib import sha1
+import os
+import struct
+
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+_length16_struct = struct.Struct(b'>H')
+_length64_struct = struct.Struct(b'>Q')
+
+
+class WebSocketError(Exception):
+    """The websocket protocol was violated."""
+
+
+def make_key():
+    """Make a random Sec-WebSocket-Key."""
+    return b64encode(os.urandom(16))
+
+
+def accept_key(key):
+    """The Sec-WebSocket-Accept value for a key."""
+    return b64encode(sha1(key + GUID).digest())
+
+
+def handshake_request(host, resource, key, headers=None):
+    """Make the HTTP request to upgrade to a websocket."""
+    lines = [
+        "GET {} HTTP/1.1".format(resource),
+        "Host: {}".format(host),
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Key: {}".format(key.decode('ascii')),
+        "Sec-WebSocket-Version: 13",
+    ]
+    for header, value in (headers or {}).items():
+        lines.append("{}: {}".format(header, value))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8')
+
+
+def parse_headers(header_bytes):
+    """Parse the start line and headers of a HTTP message, return (start line, headers dict)."""
+    lines = header_bytes.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        header, sep, value = line.partition(':')
+        if sep:
+            headers[header.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def check_handshake_response(header_bytes, key):
+    """Check the server's response to the upgrade request."""
+    status_line, headers = parse_headers(header_bytes)
+    status = status_line.split(' ', 2)
+    if len(status) < 2 or status[1] != '101':
+        raise WebSocketError("websocket upgrade failed ({})".format(status_line))
+    if headers.get('upgrade', '').lower() != 'websocket':
+        raise WebSocketError("server didn't upgrade to websocket")
+    if headers.get('sec-websocket-accept', '').encode('ascii') != accept_key(key):
+        raise WebSocketError("bad Sec-WebSocket-Accept header")
+    return headers
+
+
+def handshake_response(header_bytes):
+    """Make the response to a client's upgrade request (used by test servers)."""
+    _, headers = parse_headers(header_bytes)
+    key = headers.get('sec-websocket-key', '').encode('ascii')
+    if not key:
+        raise WebSocketError("no Sec-WebSocket-Key header")
+    lines = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        "Sec-WebSocket-Accept: {}".format(accept_key(key).decode('ascii')),
+    ]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8')
+
+
+if PY2:
+    def apply_mask(mask, data):
+        """XOR data with a 4 byte mask."""
+        mask = bytearray(mask)
+        data = bytearray(data)
+        for index in range(len(data)):
+            data[index] ^= mask[index & 3]
+        return bytes(data)
+else:
+    def apply_mask(mask, data):
+        """XOR data with a 4 byte mask."""
+        size = len(data)
+        if not size:
+            return b''
+        # XOR as big integers, which is much faster than a byte at a time
+        repeated_mask = (mask * (size // 4 + 1))[:size]
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated_mask, 'big')).to_bytes(size, 'big')
+
+
+def encode_frame(opcode, payload, mask=True, fin=True):
+    """Encode a single frame. Frames sent by a client must be masked."""
+    size = len(payload)
+    header = bytearray()
+    header.append((0x80 if fin else 0) | opcode)
+    mask_bit = 0x80 if mask else 0
+    if size < 126:
+        header.append(mask_bit | size)
+    elif size < 0x10000:
+        header.append(mask_bit | 126)
+        header.extend(_length16_struct.pack(size))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(_length64_struct.pack(size))
+    if mask:
+        mask_key = os.urandom(4)
+        header.extend(mask_key)
+        payload = apply_mask(mask_key, payload)
+    return bytes(header) + payload
+
+
+def encode_close(code=CLOSE_NORMAL, reason=b'', mask=True):
+    """Encode a close frame."""
+    return encode_frame(OP_CLOSE, _length16_struct.pack(code) + reason, mask=mask)
+
+
+def parse_header(header):
+    """Parse the first two bytes of a frame, return (fin, opcode, masked, length).
+
+    A length of 126 or 127 means the length is in the following 2 or 8 bytes.
+
+    """
+    first, second = bytearray(header)
+    if first & 0x70:
+        raise WebSocketError("reserved bits set, but no extension negotiated")
+    opcode = first & 0x0f
+    length = second & 0x7f
+    if opcode & 0x8 and (length > 125 or not first & 0x80):
+        raise WebSocketError("control frames must not be fragmented or have more than 125 bytes")
+    return bool(first & 0x80), opcode, bool(second & 0x80), length
+
+
+def parse_extended_length(length, extended_bytes):
+    """Get the payload length from the extended length bytes."""
+    if length == 126:
+        return _length16_struct.unpack(extended_bytes)[0]
+    return _length64_struct.unpack(extended_bytes)[0]
@@ -0,0 +1,249 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Orders outgoing packets, so that bulk transfers don't delay interactive channels.
+
+Packets are queued by priority class. A class is only serviced when the higher classes have
+nothing to send. Within a class, channels share the connection by deficit round robin: each
+channel may send up to `quantum` bytes per turn, so a channel sending large packets can't
+starve one sending small packets.
+
+Packets that don't belong to a channel (pings, control packets etc.) have the highest
+priority, and are sent in order.
+
+Channel data is queued unencoded, and adjacent writes to a channel are merged in to a single
+request_send packet of up to `max_frame_size` bytes. A write smaller than that is held for up
+to `max_delay` seconds, for more writes to merge with (like Nagle's algorithm), which saves a
+packet and a websocket frame for every small write merged.
+
+"""
+
+from collections import deque
+import threading
+import time
+
+from . import bencode
+from .packets import PacketType
+
+
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class _Entry(object):
+    """A queued packet, or channel data."""
+
+    __slots__ = ['payload', 'callbacks', 'is_data', 'ready_time']
+
+    def __init__(self, payload, on_sent, is_data, ready_time):
+        self.payload = payload
+        self.callbacks = [on_sent] if on_sent is not None else []
+        self.is_data = is_data
+        self.ready_time = ready_time
+
+
+def _make_on_sent(callbacks):
+    if not callbacks:
+        return None
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def on_sent():
+        for callback in callbacks:
+            callback()
+    return on_sent
+
+
+class SendScheduler(object):
+    """A thread safe queue of outgoing packets."""
+
+    def __init__(self, quantum=16 * 1024, max_delay=0.002, max_frame_size=64 * 1024):
+        self.quantum = quantum
+        self.max_delay = max_delay
+        self.max_frame_size = max_frame_size
+        self._condition = threading.Condition(threading.Lock())
+        self._closed = False
+        # Packets without a channel
+        self._control = deque()
+        # maps channel on to a deque of _Entry objects
+        self._queues = {}
+        self._deficits = {}
+        # Channels with packets to send, in round robin order, per priority
+        self._active = {priority: deque() for priority in PRIORITIES}
+        self._size = 0
+        # When the next held write will be ready, if nothing else is
+        self._wait_until = None
+
+    def __len__(self):
+        """Number of bytes queued."""
+        return self._size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _queue(self, channel, priority):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = deque()
+        if not queue:
+            self._active[priority].append(channel)
+            self._deficits[channel] = self.quantum
+        return queue
+
+    def put(self, packet_bytes, channel=None, priority=PRIORITY_CONTROL, on_sent=None):
+        """Queue a packet. `on_sent` is called when the packet has been sent (or dropped)."""
+        with self._condition:
+            if self._closed:
+                if on_sent is not None:
+                    on_sent()
+                return
+            entry = _Entry(packet_bytes, on_sent, False, 0)
+            if channel is None:
+                self._control.append(entry)
+            else:
+                self._queue(channel, priority).append(entry)
+            self._size += len(packet_bytes)
+            self._condition.notify()
+
+    def put_data(self, channel, data, priority=PRIORITY_BULK, on_sent=None):
+        """Queue data to send to a channel, merging with queued data if possible."""
+        with self._condition:
+            if self._closed:
+                if on_sent is not None:
+                    on_sent()
+                return
+            queue = self._queue(channel, priority)
+            tail = queue[-1] if queue else None
+            if (tail is not None and tail.is_data and
+                    len(tail.payload) + len(data) <= self.max_frame_size):
+                tail.payload += data
+                if on_sent is not None:
+                    tail.callbacks.append(on_sent)
+            else:
+                queue.append(_Entry(bytearray(data), on_sent, True, _clock() + self.max_delay))
+            self._size += len(data)
+            self._condition.notify()
+
+    def _ready(self, queue, now):
+        """Check if the head of a channel queue may be sent now."""
+        entry = queue[0]
+        if (not entry.is_data or
+                len(queue) > 1 or
+                now >= entry.ready_time or
+                len(entry.payload) >= self.max_frame_size):
+            return True
+        if self._wait_until is None or entry.ready_time < self._wait_until:
+            self._wait_until = entry.ready_time
+        return False
+
+    def _encode(self, channel, entry):
+        if entry.is_data:
+            packet_bytes = bencode.encode_channel_packet(PacketType.request_send, channel, bytes(entry.payload))
+        else:
+            packet_bytes = entry.payload
+        return packet_bytes, _make_on_sent(entry.callbacks)
+
+    def _pop(self):
+        self._wait_until = None
+        if self._control:
+            entry = self._control.popleft()
+            self._size -= len(entry.payload)
+            return entry.payload, _make_on_sent(entry.callbacks)
+        now = _clock()
+        deficits = self._deficits
+        for priority in PRIORITIES:
+            active = self._active[priority]
+            # Count of consecutive channels with held writes
+            held = 0
+            while held < len(active):
+                channel = active[0]
+                queue = self._queues[channel]
+                if not self._ready(queue, now):
+                    active.rotate(-1)
+                    held += 1
+                    continue
+                entry = queue[0]
+                size = len(entry.payload)
+                if deficits[channel] >= size:
+                    queue.popleft()
+                    self._size -= size
+                    if queue:
+                        deficits[channel] -= size
+                    else:
+                        # No credit is kept by idle channels
+                        active.popleft()
+                        del self._queues[channel]
+                        del deficits[channel]
+                    return self._encode(channel, entry)
+                # End of this channel's turn
+                active.rotate(-1)
+                deficits[channel] += self.quantum
+                held = 0
+        return None
+
+    def pop(self):
+        """Get the next (packet bytes, on_sent) to send, or None if nothing is ready."""
+        with self._condition:
+            return self._pop()
+
+    def wait_time(self):
+        """Seconds until a held write is ready to send, or None if nothing is held.
+
+        Only valid after `pop` returns None.
+
+        """
+        with self._condition:
+            if self._wait_until is None:
+                return None
+            return max(0.0, self._wait_until - _clock())
+
+    def get(self, timeout=None):
+        """Block until there is a packet to send, return (packet bytes, on_sent).
+
+        Returns None on timeout, or when the scheduler is closed.
+
+        """
+        with self._condition:
+            deadline = None if timeout is None else _clock() + timeout
+            while not self._closed:
+                packet = self._pop()
+                if packet is not None:
+                    return packet
+                wait = self._wait_until
+                if deadline is not None:
+                    wait = deadline if wait is None else min(wait, deadline)
+                if wait is None:
+                    self._condition.wait()
+                else:
+                    remaining = wait - _clock()
+                    if remaining > 0:
+                        self._condition.wait(remaining)
+                    elif deadline is not None and wait == deadline:
+                        return None
+            return None
+
+    def close(self):
+        """Drop queued packets, and wake up the writer."""
+        with self._condition:
+            self._closed = True
+            dropped = list(self._control)
+            for queue in self._queues.values():
+                dropped.extend(queue)
+            self._control.clear()
+            self._queues.clear()
+            self._deficits.clear()
+            for active in self._active.values():
+                active.clear()
+            self._size = 0
+            self._condition.notify_all()
+        # Release any writers waiting on the channel windows
+        for entry in dropped:
+            for on_sent in entry.callbacks:
+                on_sent()
@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+Sends full screen terminal apps (top, htop, vim etc.) as screen updates.
+
+Full screen apps redraw much more than changes, e.g. top rewrites the whole screen every few
+seconds. ScreenDiffFilter passes terminal output through unchanged, until an app switches to the
+alternate screen or clears the screen. From then on output is fed to a model of the screen, and
+only the cells that changed since the last frame are sent, as escape codes that bring the
+remote terminal up to date.
+
+Output is sent unchanged again once the app leaves the alternate screen. On the normal screen,
+output is sent unchanged again as soon as it would scroll the screen, so that the remote
+terminal's scrollback is kept.
+
+The model covers the escape codes used by curses apps. Sequences that don't change the screen
+contents (modes, titles, queries) are passed through to the remote terminal.
+
+"""
+
+import codecs
+import re
+
+from ..compat import PY2
+
+
+# Enter / leave the alternate screen
+ALTERNATE_MODES = (47, 1047, 1049)
+# Output that starts screen diffs; entering the alternate screen, or clearing the screen
+_start_re = re.compile(r'(\x1b\[\?(?:1049|1047|47)h)|\x1b\[H\x1b\[2J')
+
+# DEC special graphics (line drawing) characters
+_DEC_GRAPHICS = dict(zip(
+    '`abcdefghijklmnopqrstuvwxyz{|}~',
+    '◆▒␉␌␍␊°±␤␋┘┐┌└'
+    '┼⎺⎻─⎼⎽├┤┴┬│≤≥π'
+    '≠£·'
+))
+
+# SGR parameters that set flags, and the parameters that clear them
+_SGR_FLAGS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 7: 7, 8: 8, 9: 9}
+_SGR_CLEAR_FLAGS = {22: (1, 2), 23: (3,), 24: (4,), 25: (5,), 27: (7,), 28: (8,), 29: (9,)}
+
+_ERROR_HANDLER = 'replace' if PY2 else 'surrogateescape'
+
+
+def _sgr(attrs):
+    """Escape code to set attributes."""
+    return '\x1b[0;{}m'.format(attrs) if attrs else '\x1b[0m'
+
+
+class Screen(object):
+    """A model of a terminal screen."""
+
+    def __init__(self, columns=80, rows=24):
+        self.columns = columns
+        self.rows = rows
+        self.reset()
+
+    def reset(self, alternate=False):
+        """Clear the screen, and reset the cursor and attributes."""
+        # Modelling the alternate screen, or the normal screen
+        self.alternate = alternate
+        # Why `feed` stopped early
+        self.stop_reason = None
+        self.attrs = ''
+        self._flags = set()
+        self._foreground = None
+        self._background = None
+        self.lines = [self._blank_line() for _ in range(self.rows)]
+        # What the remote terminal is showing
+        self._rendered = [self._blank_line() for _ in range(self.rows)]
+        self.dirty = set()
+        self.x = 0
+        self.y = 0
+        self.scroll_top = 0
+        self.scroll_bottom = self.rows - 1
+        self.saved_cursor = (0, 0, '')
+        self.cursor_visible = True
+        self._rendered_cursor_visible = True
+        # Which of the G0 and G1 character sets are line drawing, and which is in use
+        self._charsets = [False, False]
+        self._shift = 0
+        self._state = 'ground'
+        self._params = ''
+        # Escape codes to send to the remote terminal as they are
+        self._passthrough = []
+        # The escape code that entered or left the alternate screen
+        self.mode_sequence = None
+
+    def _blank_line(self, attrs=''):
+        return [(' ', attrs)] * self.columns
+
+    def resize(self, columns, rows):
+        """Change the size of the screen. The next render redraws everything."""
+        self.columns = columns
+        self.rows = rows
+        self.lines = [
+            (line + self._blank_line())[:columns]
+            for line in (self.lines + [self._blank_line()] * rows)[:rows]
+        ]
+        self._rendered = None
+        self.scroll_top = 0
+        self.scroll_bottom = rows - 1
+        self.x = min(self.x, columns - 1)
+        self.y = min(self.y, rows - 1)
+
+    @property
+    def changed(self):
+        """True if there is something to render."""
+        return bool(self.dirty or self._passthrough or self._rendered is None or
+                    self.cursor_visible != self._rendered_cursor_visible)
+
+    # ------------------------------------------------------------------
+    # Updating the model
+
+    def feed(self, text):
+        """Update the screen with terminal output.
+
+        Stops early, and returns the number of characters processed, when the output can't be
+        sent as screen changes. `stop_reason` is then one of:
+
+            "enter" -- after an escape code that enters the alternate screen
+            "leave" -- after an escape code that leaves the alternate screen
+            "scroll" -- before a character that would scroll the normal screen
+
+        Returns None if all the text was processed.
+
+        """
+        rows = self.rows
+        for index, char in enumerate(text):
+            state = self._state
+            if state == 'ground':
+                if (not self.alternate and self.y == rows - 1 and
+                        (char in '\n\x0b\x0c' or (self.x >= self.columns and char >= ' ')) and
+                        self.scroll_top == 0 and self.scroll_bottom == rows - 1):
+                    self.stop_reason = 'scroll'
+                    return index
+                if char >= ' ' and char != '\x7f':
+                    self._print(char)
+                elif char == '\x1b':
+                    self._state = 'escape'
+                else:
+                    self._control(char)
+            elif state == 'csi':
+                if '\x40' <= char <= '\x7e':
+                    self._state = 'ground'
+                    self.stop_reason = self._csi(self._params, char)
+                    if self.stop_reason is not None:
+                        return index + 1
+                elif '\x20' <= char <= '\x3f':
+                    self._params += char
+                elif char == '\x1b':
+                    self._state = 'escape'
+                else:
+                    self._control(char)
+            elif state == 'escape':
+                self._escape(char)
+            elif state == 'osc':
+                if char == '\x07':
+                    self._state = 'ground'
+                    self._passthrough.append('\x1b]' + self._params + '\x07')
+                elif char == '\x1b':
+                    self._state = 'osc_end'
+                else:
+                    self._params += char
+            elif state == 'osc_end':
+                self._state = 'ground'
+                self._passthrough.append('\x1b]' + self._params + '\x1b\\')
+            elif state == 'string':
+                # DCS, PM and APC strings are ignored
+                if char == '\x1b':
+                    self._state = 'string_end'
+                elif char == '\x07':
+                    self._state = 'ground'
+            elif state == 'string_end':
+                self._state = 'ground'
+            elif state == 'charset':
+                self._state = 'ground'
+                if self._params in ('(', ')'):
+                    self._charsets[self._params == ')'] = char == '0'
+        return None
+
+    def _print(self, char):
+        if self.x >= self.columns:
+            # Pending wrap
+            self.x = 0
+            self._index()
+        if self._charsets[self._shift]:
+            char = _DEC_GRAPHICS.get(char, char)
+        self.lines[self.y][self.x] = (char, self.attrs)
+        self.dirty.add(self.y)
+        self.x += 1
+
+    def _control(self, char):
+        if char == '\r':
+            self.x = 0
+        elif char in '\n\x0b\x0c':
+            self._index()
+        elif char == '\x08':
+            self.x = max(0, min(self.x, self.columns - 1) - 1)
+        elif char == '\t':
+            self.x = min(self.columns - 1, (self.x // 8 + 1) * 8)
+        elif char == '\x07':
+            self._passthrough.append(char)
+        elif char == '\x0e':
+            self._shift = 1
+        elif char == '\x0f':
+            self._shift = 0
+
+    def _escape(self, char):
+        self._state = 'ground'
+        if char == '[':
+            self._state = 'csi'
+            self._params = ''
+        elif char == ']':
+            self._state = 'osc'
+            self._params = ''
+        elif char in 'P^_X':
+            self._state = 'string'
+        elif char in '()*+':
+            self._state = 'charset'
+            self._params = char
+        elif char in '#% ':
+            self._state = 'charset'
+            self._params = ''
+        elif char == '7':
+            self._save_cursor()
+        elif char == '8':
+            self._restore_cursor()
+        elif char == 'D':
+            self._index()
+        elif char == 'E':
+            self.x = 0
+            self._index()
+        elif char == 'M':
+            self._reverse_index()
+        elif char == 'c':
+            self.reset()
+            self._rendered = None
+        elif char in '=>':
+            # Keypad mode
+            self._passthrough.append('\x1b' + char)
+
+    def _csi(self, params, final):
+        """Handle a control sequence, return "enter" or "leave" if it changes screen."""
+        private = params[:1] in ('?', '>', '=', '<')
+        intermediate = params and params[-1] in ' !"#$%&\'()*+,-./'
+        if intermediate or (private and final not in 'hl'):
+            self._passthrough.append('\x1b[' + params + final)
+            return None
+        if private:
+            return self._set_modes(params[1:], final == 'h')
+
+        args = []
+        for param in params.split(';'):
+            try:
+                args.append(int(param.split(':')[0] or 0))
+            except ValueError:
+                args.append(0)
+        count = max(1, args[0])
+        columns = self.columns
+        rows = self.rows
+        x = min(self.x, columns - 1)
+
+        if final == 'm':
+            self._set_attributes(params)
+        elif final in 'Hf':
+            self.y = min(rows - 1, max(1, args[0]) - 1)
+            self.x = min(columns - 1, max(1, args[1] if len(args) > 1 else 1) - 1)
+        elif final == 'A':
+            self.y = max(self.scroll_top if self.y >= self.scroll_top else 0, self.y - count)
+            self.x = x
+        elif final in 'Be':
+            self.y = min(self.scroll_bottom if self.y <= self.scroll_bottom else rows - 1, self.y + count)
+            self.x = x
+        elif final in 'Ca':
+            self.x = min(columns - 1, x + count)
+        elif final == 'D':
+            self.x = max(0, x - count)
+        elif final == 'E':
+            self.y = min(rows - 1, self.y + count)
+            self.x = 0
+        elif final == 'F':
+            self.y = max(0, self.y - count)
+            self.x = 0
+        elif final in 'G`':
+            self.x = min(columns - 1, count - 1)
+        elif final == 'd':
+            self.y = min(rows - 1, count - 1)
+        elif final == 'J':
+            self._erase_display(args[0])
+        elif final == 'K':
+            self._erase_line(args[0])
+        elif final == 'X':
+            self._fill(self.y, x, min(columns, x + count))
+        elif final == '@':
+            line = self.lines[self.y]
+            line[x:x] = [(' ', self.attrs)] * count
+            del line[columns:]
+            self.dirty.add(self.y)
+        elif final == 'P':
+            line = self.lines[self.y]
+            del line[x:x + count]
+            line.extend([(' ', self.attrs)] * (columns - len(line)))
+            self.dirty.add(self.y)
+        elif final == 'L':
+            if self.scroll_top <= self.y <= self.scroll_bottom:
+                self._scroll_down(count, self.y)
+                self.x = 0
+        elif final == 'M':
+            if self.scroll_top <= self.y <= self.scroll_bottom:
+                self._scroll_up(count, self.y)
+                self.x = 0
+        elif final == 'S':
+            self._scroll_up(count, self.scroll_top)
+        elif final == 'T':
+            self._scroll_down(count, self.scroll_top)
+        elif final == 'r':
+            top = max(1, args[0]) - 1
+            bottom = (args[1] if len(args) > 1 and args[1] else rows) - 1
+            if top < bottom < rows:
+                self.scroll_top = top
+                self.scroll_bottom = bottom
+                self.x = self.y = 0
+        elif final == 's':
+            self._save_cursor()
+        elif final == 'u':
+            self._restore_cursor()
+        elif final in 'cnt':
+            # Queries and window operations are for the remote terminal
+            self._passthrough.append('\x1b[' + params + final)
+        return None
+
+    def _set_modes(self, params, enable):
+        change = None
+        for param in params.split(';'):
+            try:
+                mode = int(param)
+            except ValueError:
+                continue
+            if mode in ALTERNATE_MODES:
+                if enable != self.alternate:
+                    self.mode_sequence = '\x1b[?{}{}'.format(mode, 'h' if enable else 'l')
+                    change = 'enter' if enable else 'leave'
+            elif mode == 25:
+                self.cursor_visible = enable
+            else:
+                # Cursor key, mouse and paste modes change what the remote terminal sends
+                self._passthrough.append('\x1b[?{}{}'.format(mode, 'h' if enable else 'l'))
+        return change
+
+    def _set_attributes(self, params):
+        args = params.split(';') if params else ['0']
+        flags = self._flags
+        index = 0
+        while index < len(args):
+            try:
+                arg = int(args[index].split(':')[0] or 0)
+            except ValueError:
+                arg = 0
+            if arg == 0:
+                flags.clear()
+                self._foreground = self._background = None
+            elif arg in _SGR_FLAGS:
+                flags.add(_SGR_FLAGS[arg])
+            elif arg in _SGR_CLEAR_FLAGS:
+                flags.difference_update(_SGR_CLEAR_FLAGS[arg])
+            elif 30 <= arg <= 37 or 90 <= arg <= 97:
+                self._foreground = str(arg)
+            elif 40 <= arg <= 47 or 100 <= arg <= 107:
+                self._background = str(arg)
+            elif arg == 39:
+                self._foreground = None
+            elif arg == 49:
+                self._background = None
+            elif arg in (38, 48):
+                if ':' in args[index]:
+                    color = args[index]
+                else:
+                    size = 3 if args[index + 1:index + 2] == ['5'] else 5
+                    color = ';'.join(args[index:index + size])
+                    index += size - 1
+                if arg == 38:
+                    self._foreground = color
+                else:
+                    self._background = color
+            index += 1
+        attrs = [str(flag) for flag in sorted(flags)]
+        if self._foreground is not None:
+            attrs.append(self._foreground)
+        if self._background is not None:
+            attrs.append(self._background)
+        self.attrs = ';'.join(attrs)
+
+    def _save_cursor(self):
+        self.saved_cursor = (self.x, self.y, self.attrs)
+
+    def _restore_cursor(self):
+        self.x, self.y, attrs = self.saved_cursor
+        self._set_attributes(attrs)
+
+    def _fill(self, y, start, end):
+        line = self.lines[y]
+        line[start:end] = [(' ', self.attrs)] * (end - start)
+        self.dirty.add(y)
+
+    def _erase_display(self, mode):
+        x = min(self.x, self.columns - 1)
+        if mode == 0:
+            self._fill(self.y, x, self.columns)
+            rows = range(self.y + 1, self.rows)
+        elif mode == 1:
+            self._fill(self.y, 0, x + 1)
+            rows = range(self.y)
+        else:
+            rows = range(self.rows)
+        for y in rows:
+            self.lines[y] = self._blank_line(self.attrs)
+            self.dirty.add(y)
+
+    def _erase_line(self, mode):
+        x = min(self.x, self.columns - 1)
+        if mode == 0:
+            self._fill(self.y, x, self.columns)
+        elif mode == 1:
+            self._fill(self.y, 0, x + 1)
+        else:
+            self._fill(self.y, 0, self.columns)
+
+    def _scroll_up(self, count, top):
+        bottom = self.scroll_bottom
+        count = min(count, bottom - top + 1)
+        del self.lines[top:top + count]
+        self.lines[bottom - count + 1:bottom - count + 1] = [self._blank_line() for _ in range(count)]
+        self.dirty.update(range(top, bottom + 1))
+
+    def _scroll_down(self, count, top):
+        bottom = self.scroll_bottom
+        count = min(count, bottom - top + 1)
+        del self.lines[bottom - count + 1:bottom + 1]
+        self.lines[top:top] = [self._blank_line() for _ in range(count)]
+        self.dirty.update(range(top, bottom + 1))
+
+    def _index(self):
+        if self.y == self.scroll_bottom:
+            self._scroll_up(1, self.scroll_top)
+        elif self.y < self.rows - 1:
+            self.y += 1
+
+    def _reverse_index(self):
+        if self.y == self.scroll_top:
+            self._scroll_down(1, self.scroll_top)
+        elif self.y > 0:
+            self.y -= 1
+
+    # ------------------------------------------------------------------
+    # Rendering
+
+    def render(self):
+        """Get the escape codes that update the remote terminal to match the screen."""
+        output = []
+        write = output.append
+        remote_attrs = [None]
+
+        def set_attrs(attrs):
+            if attrs != remote_attrs[0]:
+                write(_sgr(attrs))
+                remote_attrs[0] = attrs
+
+        if self._rendered is None:
+            # Remote screen is in an unknown state
+            set_attrs('')
+            write('\x1b[H\x1b[2J')
+            self._rendered = [self._blank_line() for _ in range(self.rows)]
+            self.dirty = set(range(self.rows))
+
+        columns = self.columns
+        for y in sorted(self.dirty):
+            line = self.lines[y]
+            rendered = self._rendered[y]
+            if line == rendered:
+                continue
+            first = 0
+            while line[first] == rendered[first]:
+                first += 1
+            last = columns - 1
+            while line[last] == rendered[last]:
+                last -= 1
+            # Clear the end of the line rather than write spaces, if we can
+            blank = line[-1]
+            clear_from = columns
+            if blank[0] == ' ':
+                while clear_from > first and line[clear_from - 1] == blank:
+                    clear_from -= 1
+                if clear_from > last or columns - clear_from < 4:
+                    clear_from = columns
+            write('\x1b[{};{}H'.format(y + 1, first + 1))
+            for char, attrs in line[first:min(last + 1, clear_from)]:
+                set_attrs(attrs)
+                write(char)
+            if clear_from < columns:
+                set_attrs(blank[1])
+                write('\x1b[K')
+            self._rendered[y] = line[:]
+        self.dirty.clear()
+
+        if output or self._passthrough:
+            if self.x >= columns:
+                # Write the last character again, so the remote terminal wraps the next one
+                char, attrs = self.lines[self.y][columns - 1]
+                write('\x1b[{};{}H'.format(self.y + 1, columns))
+                set_attrs(attrs)
+                write(char)
+            else:
+                write('\x1b[{};{}H'.format(self.y + 1, self.x + 1))
+            set_attrs(self.attrs)
+        if self.cursor_visible != self._rendered_cursor_visible:
+            write('\x1b[?25h' if self.cursor_visible else '\x1b[?25l')
+            self._rendered_cursor_visible = self.cursor_visible
+        output.extend(self._passthrough)
+        del self._passthrough[:]
+        return ''.join(output)
+
+
+class ScreenDiffFilter(object):
+    """Filters terminal output, so full screen apps send changes rather than redraws."""
+
+    def __init__(self, columns=80, rows=24):
+        self.screen = Screen(columns, rows)
+        # True when sending screen changes
+        self.active = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(_ERROR_HANDLER)
+        # Output held back in case it is the start of an escape code
+        self._tail = ''
+
+    @property
+    def pending(self):
+        """True if there is output waiting for `render`."""
+        return bool(self._tail) or (self.active and self.screen.changed)
+
+    def resize(self, columns, rows):
+        self.screen.resize(columns, rows)
+
+    def _encode(self, text):
+        return text.encode('utf-8', _ERROR_HANDLER)
+
+    def _start(self, alternate):
+        self.active = True
+        self.screen.reset(alternate=alternate)
+
+    def feed(self, data):
+        """Process terminal output, and return the bytes to send now."""
+        text = self._tail + self._decoder.decode(data)
+        self._tail = ''
+        output = []
+        screen = self.screen
+        while text:
+            if self.active:
+                count = screen.feed(text)
+                if count is None:
+                    break
+                text = text[count:]
+                # Bring the remote screen up to date, before sending output unchanged
+                output.append(screen.render())
+                self.active = False
+                if screen.stop_reason == 'enter':
+                    output.append(screen.mode_sequence)
+                    self._start(True)
+                    output.append('\x1b[0m\x1b[H\x1b[2J')
+                elif screen.stop_reason == 'leave':
+                    output.append(screen.mode_sequence)
+            else:
+                match = _start_re.search(text)
+                if match is None:
+                    # Hold back a partial escape code at the end
+                    escape = text.rfind('\x1b', max(0, len(text) - 8))
+                    if escape != -1 and not re.search(r'[\x40-\x7e]', text[escape + 2:]):
+                        text, self._tail = text[:escape], text[escape:]
+                    output.append(text)
+                    break
+                output.append(text[:match.end()])
+                text = text[match.end():]
+                alternate = match.group(1) is not None
+                self._start(alternate)
+                if alternate:
+                    # Put the remote screen in the state the model starts in
+                    output.append('\x1b[0m\x1b[H\x1b[2J')
+        return self._encode(''.join(output))
+
+    def render(self):
+        """Get the bytes that update the remote screen."""
+        if self.active:
+            output = self.screen.render()
+        else:
+            output = self._tail
+            self._tail = ''
+        return self._encode(output)
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+"""
+A bounded record of recent terminal output.
+
+Detached terminal sessions keep running, and their output goes here so it can be replayed when
+a new channel attaches. The oldest output is dropped to keep within `max_size` bytes. Partially
+dropped chunks are trimmed to the start of a line where there is one, so a replay doesn't start part
+way through an escape code.
+
+"""
+
+from collections import deque
+
+from ..compat import implements_bool
+
+
+@implements_bool
+class Scrollback(object):
+    """A ring of the last `max_size` bytes of output."""
+
+    def __init__(self, max_size=64 * 1024):
+        self.max_size = max_size
+        self._chunks = deque()
+        self._size = 0
+
+    def __repr__(self):
+        return "<scrollback {} of {} bytes>".format(self._size, self.max_size)
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def append(self, data):
+        """Record output, dropping the oldest output if necessary."""
+        if not data:
+            return
+        chunks = self._chunks
+        chunks.append(bytes(data))
+        self._size += len(data)
+        while self._size > self.max_size:
+            excess = self._size - self.max_size
+            first = chunks[0]
+            if len(first) <= excess:
+                chunks.popleft()
+                self._size -= len(first)
+                continue
+            newline = first.find(b'\n', excess)
+            start = excess if newline == -1 else newline + 1
+            self._size -= start
+            if start == len(first):
+                chunks.popleft()
+            else:
+                chunks[0] = first[start:]
+
+    def getvalue(self):
+        """Get the recorded output as bytes."""
+        return b''.join(self._chunks)
+
+    def clear(self):
+        self._chunks.clear()
+        self._size = 0
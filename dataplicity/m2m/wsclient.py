@@ -7,7 +7,8 @@ import socket
 import ssl
 import sys
 import threading
-from collections import defaultdict, deque
+import time
+from collections import defaultdict
 
 import websocket
 
@@ -17,6 +18,8 @@ from ..compat import text_type
 from .dispatcher import Dispatcher, expose
 from .packets import M2MPacket as Packet
 from .packets import PacketType
+from .scheduler import SendScheduler, PRIORITY_BULK
+from .chunkbuffer import ChunkBuffer
 
 log = logging.getLogger('m2m.client')
 server_log = logging.getLogger('m2m.log')
@@ -42,20 +45,41 @@ class ChannelFile(object):
 
 
 class Channel(object):
-    """An interface to a channel."""
+    """
+    An interface to a channel.
 
-    def __init__(self, client, number):
+    Writes are flow controlled. Bytes written count against the channel's window until the
+    transport has sent them. When the window reaches the high watermark the channel is no
+    longer writable, until the window drains to the low watermark. Producers call
+    `wait_writable` before reading more data to send.
+
+    """
+
+    def __init__(self, client, number, high_watermark=256 * 1024, low_watermark=64 * 1024):
         self.client = client
         self.number = number
         self._closed = False
+        # Scheduling priority of writes (see scheduler.py)
+        self.priority = PRIORITY_BULK
 
         self._data_callback = None
         self._close_callback = None
         self._control_callback = None
+        self._writable_callback = None
         self._lock = threading.RLock()
-        self.deque = deque()
+        self.buffer = ChunkBuffer()
         self._data_event = threading.Event()
 
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._window_condition = threading.Condition(threading.Lock())
+        self._window = 0
+        self._paused = False
+        self._pause_count = 0
+        self._pause_time = 0.0
+        self._bytes_written = 0
+        self._bytes_read = 0
+
     def __repr__(self):
         """Show the channel number."""
         return "<channel {}>".format(self.number)
@@ -70,6 +94,8 @@ class Channel(object):
         if self._closed:
             return
         self._closed = True
+        with self._window_condition:
+            self._window_condition.notify_all()
         try:
             if self._close_callback is not None:
                 self._close_callback()
@@ -85,11 +111,12 @@ class Channel(object):
         if self._closed:
             log.debug('%s bytes from closed %r ignored', len(data), self)
             return
+        self._bytes_read += len(data)
         if self._data_callback is not None:
             self._data_callback(data)
         else:
             with self._lock:
-                self.deque.append(data)
+                self.buffer.append(data)
                 self._data_event.set()
 
     def on_control(self, data):
@@ -100,51 +127,118 @@ class Channel(object):
         if self._control_callback is not None:
             self._control_callback(data)
 
-    def set_callbacks(self, on_data=None, on_close=None, on_control=None):
+    def set_callbacks(self, on_data=None, on_close=None, on_control=None, on_writable=None):
+        """Set callbacks. `on_writable` is called (from the transport) when the window reopens."""
         self._data_callback = on_data
         self._close_callback = on_close
         self._control_callback = on_control
+        self._writable_callback = on_writable
 
     @property
     def size(self):
-        with self._lock:
-            return sum(len(b) for b in self.deque)
+        return len(self.buffer)
 
     def __nonzero__(self):
         return self._data_event.is_set()
 
     def read(self, count, timeout=None, block=False):
         """Read up to `count` bytes."""
-        incoming_bytes = []
-        bytes_remaining = count
-
         # Block until data
-
         if block:
             if not self._data_event.wait(timeout):
                 return b''
 
         with self._lock:
-            # Data may be spread across multiple / partial messages
-            while self.deque and bytes_remaining:
-                head = self.deque[0]
-                read_bytes = min(bytes_remaining, len(head))
-                incoming_bytes.append(head[:read_bytes])
-                bytes_left = head[read_bytes:]
-                bytes_remaining -= read_bytes
-                if not bytes_left:
-                    self.deque.popleft()
-                else:
-                    self.deque[0] = bytes_left
-            if not self.deque:
+            data = self.buffer.read(count)
+            if not self.buffer:
                 self._data_event.clear()
+        return data
 
-        return b''.join(incoming_bytes)
+    def readinto(self, buffer, timeout=None, block=False):
+        """Read in to a writable buffer, return the number of bytes read."""
+        if block:
+            if not self._data_event.wait(timeout):
+                return 0
+
+        with self._lock:
+            size = self.buffer.readinto(buffer)
+            if not self.buffer:
+                self._data_event.clear()
+        return size
 
     def write(self, data):
         assert isinstance(data, bytes), "data must be bytes"
+        size = len(data)
+        self._open_window(size)
         with self._lock:
-            self.client.channel_write(self.number, data)
+            self.client.channel_write(self.number, data, on_sent=lambda: self.on_sent(size))
+
+    def write_control(self, data):
+        """Send out of band data, after data already written."""
+        assert isinstance(data, bytes), "data must be bytes"
+        self.client.channel_write_control(self.number, data)
+
+    def _open_window(self, size):
+        """Count bytes against the window."""
+        with self._window_condition:
+            self._window += size
+            self._bytes_written += size
+            if self._window >= self.high_watermark:
+                self._paused = True
+
+    def on_sent(self, size):
+        """Called by the transport when `size` bytes written to the channel have been sent."""
+        with self._window_condition:
+            self._window -= size
+            reopened = self._paused and self._window <= self.low_watermark
+            if reopened:
+                self._paused = False
+                self._window_condition.notify_all()
+        if reopened and self._writable_callback is not None:
+            try:
+                self._writable_callback()
+            except:
+                log.exception('error in writable callback')
+
+    @property
+    def writable(self):
+        """True if the window is open."""
+        return not self._paused
+
+    def wait_writable(self, timeout=None):
+        """Block until the channel is writable (or closed). Return False on timeout."""
+        if not self._paused:
+            return True
+        start = time.time()
+        with self._window_condition:
+            if self._paused and not self._closed:
+                self._pause_count += 1
+            while self._paused and not self._closed:
+                if timeout is None:
+                    self._window_condition.wait()
+                else:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    self._window_condition.wait(remaining)
+            self._pause_time += time.time() - start
+            return not self._paused or self._closed
+
+    @property
+    def metrics(self):
+        """A dict of flow control metrics."""
+        with self._window_condition:
+            return {
+                "bytes_written": self._bytes_written,
+                "bytes_read": self._bytes_read,
+                "window": self._window,
+                "buffered": self.size,
+                "high_watermark": self.high_watermark,
+                "low_watermark": self.low_watermark,
+                "writable": not self._paused,
+                "pause_count": self._pause_count,
+                "pause_time": self._pause_time
+            }
 
     def get_file(self):
         return ChannelFile(self.client, self.number)
@@ -160,41 +254,39 @@ class ThreadedDispatcher(threading.Thread, Dispatcher):
         Dispatcher.__init__(self, Packet, log=kwargs.get('log'))
 
 
-class WSClient(ThreadedDispatcher):
-    """Interface to the M2M server."""
+class BaseClient(Dispatcher):
+    """
+    The transport independent part of a M2M client.
 
-    def __init__(self, url, uuid=None, log=None,
-                 channel_callback=None, control_callback=None, **kwargs):
-        self.url = url
+    Manages channels and command callbacks, and handles packets from the server. Transports call
+    `on_packet` with incoming packets, and implement `send_bytes`.
+
+    """
+
+    channel_class = Channel
+
+    def __init__(self, uuid=None, log=None, channel_callback=None, control_callback=None,
+                 high_watermark=None, low_watermark=None, max_delay=0.002, max_frame_size=64 * 1024):
         self.channel_callback = channel_callback
         self.control_callback = control_callback
-        kwargs['on_open'] = self.on_open
-        kwargs['on_message'] = self.on_message
-        kwargs['on_error'] = self.on_error
-        kwargs['on_close'] = self.on_close
-        self.kwargs = kwargs
+        self.channel_kwargs = {}
+        if high_watermark is not None:
+            self.channel_kwargs['high_watermark'] = high_watermark
+        if low_watermark is not None:
+            self.channel_kwargs['low_watermark'] = low_watermark
 
         self._closed = False
         self.identity = uuid
         self.channels = {}
 
         self.callback_lock = threading.RLock()
-        self.write_lock = threading.Lock()
         self.ready_event = threading.Event()
         self.close_event = threading.Event()
         self.callbacks = defaultdict(list)
         self.hooks = defaultdict(list)
+        self.scheduler = SendScheduler(max_delay=max_delay, max_frame_size=max_frame_size)
 
-        super(WSClient, self).__init__(log=log)
-        self.name = "m2m"  # Thread name
-        self.daemon = True
-
-        self.app = websocket.WebSocketApp(self.url,
-                                          **self.kwargs)
-
-    def __repr__(self):
-        """Return the URL."""
-        return 'WSClient({!r})'.format(self.url)
+        super(BaseClient, self).__init__(Packet, log=log)
 
     def __enter__(self):
         """Wait until the client is connected and ready."""
@@ -219,13 +311,6 @@ class WSClient(ThreadedDispatcher):
         """List of open channels."""
         return self.channels.keys()
 
-    def connect(self, wait=True, timeout=None):
-        """Connect and optionally wait until we are ready to communicate with the server."""
-        self.start()
-        if wait:
-            return self.wait_ready(timeout=timeout)
-        return None
-
     def add_callback(self, command_id, callback):
         self.callbacks[command_id].append(callback)
 
@@ -252,7 +337,7 @@ class WSClient(ThreadedDispatcher):
     def get_channel(self, channel_no):
         # TODO: Create channels in response to packets
         if channel_no not in self.channels:
-            self.channels[channel_no] = Channel(self, channel_no)
+            self.channels[channel_no] = self.channel_class(self, channel_no, **self.channel_kwargs)
         return self.channels[channel_no]
 
     def has_channel(self, channel_no):
@@ -260,43 +345,15 @@ class WSClient(ThreadedDispatcher):
 
     def close_channel(self, channel_no):
         log.debug("request close")
-        self.send('request_close', port=channel_no)
+        # Queued with the channel data, so it isn't sent before data already written
+        packet = Packet.create(PacketType.request_close, port=channel_no)
+        self.send_bytes(packet.encode_binary(), channel=channel_no)
 
     def hard_close_channels(self):
         """Called when all the channels have been abruptly closed."""
         for channel in self.channels.values():
             channel.on_close()
 
-    def run(self):
-        sockopt = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
-        try:
-            self.app.run_forever(sockopt=sockopt,
-                                 ping_interval=30,
-                                 ping_timeout=10,
-                                 sslopt={"cert_reqs": ssl.CERT_NONE})
-        except (SystemExit, KeyboardInterrupt):
-            log.info('wsclient exit requested')
-        except:
-            log.exception('unable to initialise websocket')
-
-        self.identity = None
-        self.ready_event.set()
-        try:
-            self.app.close()
-        except:
-            log.exception('error closing app')
-
-    def close(self, timeout=5):
-        if not self._closed and self.ready_event.is_set():
-            self.send(PacketType.request_leave)
-            if timeout:
-                self.close_event.wait(timeout)
-            self.clear_callbacks()
-        self._closed = True
-        self.identity = None
-        self.ready_event.set()
-        self.app.close()
-
     def wait_ready(self, timeout=10):
         """Wait until the server is ready, and return identity."""
         # Q. What are we waiting for?
@@ -316,13 +373,28 @@ class WSClient(ThreadedDispatcher):
         packet_bytes = packet.encode_binary()
         self.send_bytes(packet_bytes)
 
-    def send_bytes(self, packet_bytes):
-        """Send bytes over the websocket."""
-        with self.write_lock:
-            self.app.sock.send_binary(packet_bytes)
+    def send_bytes(self, packet_bytes, channel=None, on_sent=None):
+        """Queue bytes to send to the server.
+
+        Bytes for a channel are scheduled fairly with other channels, otherwise they are sent
+        before any channel data. `on_sent` is called once the bytes have been sent.
+
+        """
+        self.scheduler.put(packet_bytes,
+                           channel=channel,
+                           priority=self._get_priority(channel),
+                           on_sent=on_sent)
+        self.on_queued()
+
+    def _get_priority(self, channel_no):
+        channel = self.channels.get(channel_no) if channel_no is not None else None
+        return channel.priority if channel is not None else PRIORITY_BULK
+
+    def on_queued(self):
+        """Called when bytes have been queued to send."""
 
     def on_open(self, app):
-        """Called when WS is opened."""
+        """Called when the connection is opened."""
         log.debug("websocket opened")
         if not self.is_closed:
             if self.identity is None:
@@ -339,31 +411,6 @@ class WSClient(ThreadedDispatcher):
         else:
             self.on_packet(packet)
 
-    def on_error(self, app, error):
-        """Called on WS error."""
-        if error:
-            self.log.error("websocket error %r", error)
-        self._closed = True
-        self.identity = None
-        self.close_event.set()
-        self.ready_event.set()
-        self.hard_close_channels()
-        self.clear_callbacks()
-        try:
-            # Not entirely sure if this is neccesary
-            self.app.close()
-        except:
-            log.exception('error closing ws app in on_error')
-
-    def on_close(self, app):
-        """Called by WS app when socket closes."""
-        self.log.debug('connection closed by peer')
-        self._closed = True
-        self.identity = None
-        self.close_event.set()
-        self.ready_event.set()
-        self.clear_callbacks()
-
     def on_packet(self, packet):
         try:
             packet_type = packets.PacketType(packet[0])
@@ -373,8 +420,20 @@ class WSClient(ThreadedDispatcher):
         else:
             self.dispatch(packet_type, packet_body)
 
-    def channel_write(self, channel, data):
-        self.send(PacketType.request_send, channel=channel, data=data)
+    def channel_write(self, channel, data, on_sent=None):
+        """Write data to a channel, and call `on_sent` when it has been sent."""
+        # Encoded by the scheduler, which may merge it with other writes
+        self.scheduler.put_data(channel,
+                                data,
+                                priority=self._get_priority(channel),
+                                on_sent=on_sent)
+        self.on_queued()
+
+    def channel_write_control(self, channel, data):
+        """Send a control packet to a channel."""
+        # Queued with the channel data, so it is sent in order with writes
+        packet = Packet.create(PacketType.request_send_control, channel=channel, data=data)
+        self.send_bytes(packet.encode_binary(), channel=channel)
 
     def on_instruction(self, sender, data):
         self.log.debug('instruction from {%s} %r', sender, data)
@@ -462,6 +521,133 @@ class WSClient(ThreadedDispatcher):
             log.exception('error handling instruction')
 
 
+class WSClient(threading.Thread, BaseClient):
+    """Interface to the M2M server, with websocket-client running in a thread."""
+
+    def __init__(self, url, uuid=None, log=None,
+                 channel_callback=None, control_callback=None,
+                 high_watermark=None, low_watermark=None,
+                 max_delay=0.002, max_frame_size=64 * 1024, **kwargs):
+        self.url = url
+        kwargs['on_open'] = self.on_open
+        kwargs['on_message'] = self.on_message
+        kwargs['on_error'] = self.on_error
+        kwargs['on_close'] = self.on_close
+        self.kwargs = kwargs
+        self._writer = None
+
+        # threading.Thread doesn't call super
+        threading.Thread.__init__(self)
+        BaseClient.__init__(self,
+                            uuid=uuid,
+                            log=log,
+                            channel_callback=channel_callback,
+                            control_callback=control_callback,
+                            high_watermark=high_watermark,
+                            low_watermark=low_watermark,
+                            max_delay=max_delay,
+                            max_frame_size=max_frame_size)
+        self.name = "m2m"  # Thread name
+        self.daemon = True
+
+        self.app = websocket.WebSocketApp(self.url,
+                                          **self.kwargs)
+
+    def __repr__(self):
+        """Return the URL."""
+        return 'WSClient({!r})'.format(self.url)
+
+    def connect(self, wait=True, timeout=None):
+        """Connect and optionally wait until we are ready to communicate with the server."""
+        self.start()
+        if wait:
+            return self.wait_ready(timeout=timeout)
+        return None
+
+    def run(self):
+        sockopt = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        try:
+            self.app.run_forever(sockopt=sockopt,
+                                 ping_interval=30,
+                                 ping_timeout=10,
+                                 sslopt={"cert_reqs": ssl.CERT_NONE})
+        except (SystemExit, KeyboardInterrupt):
+            log.info('wsclient exit requested')
+        except:
+            log.exception('unable to initialise websocket')
+
+        self.identity = None
+        self.ready_event.set()
+        self.scheduler.close()
+        try:
+            self.app.close()
+        except:
+            log.exception('error closing app')
+
+    def close(self, timeout=5):
+        if not self._closed and self.ready_event.is_set():
+            self.send(PacketType.request_leave)
+            if timeout:
+                self.close_event.wait(timeout)
+            self.clear_callbacks()
+        self._closed = True
+        self.identity = None
+        self.ready_event.set()
+        self.scheduler.close()
+        self.app.close()
+
+    def on_open(self, app):
+        """Start the writer thread when the websocket opens."""
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="m2m-writer")
+            self._writer.daemon = True
+            self._writer.start()
+        super(WSClient, self).on_open(app)
+
+    def _write_loop(self):
+        """Send packets from the scheduler."""
+        while 1:
+            packet = self.scheduler.get()
+            if packet is None:
+                break
+            packet_bytes, on_sent = packet
+            try:
+                self.app.sock.send_binary(packet_bytes)
+            except:
+                log.exception('error sending packet')
+                self.scheduler.close()
+            finally:
+                if on_sent is not None:
+                    on_sent()
+
+    def on_error(self, app, error):
+        """Called on WS error."""
+        if error:
+            self.log.error("websocket error %r", error)
+        self._closed = True
+        self.identity = None
+        self.close_event.set()
+        self.ready_event.set()
+        self.scheduler.close()
+        self.hard_close_channels()
+        self.clear_callbacks()
+        try:
+            # Not entirely sure if this is neccesary
+            self.app.close()
+        except:
+            log.exception('error closing ws app in on_error')
+
+    def on_close(self, app):
+        """Called by WS app when socket closes."""
+        self.log.debug('connection closed by peer')
+        self._closed = True
+        self.identity = None
+        self.close_event.set()
+        self.ready_event.set()
+        self.scheduler.close()
+        self.clear_callbacks()
+
+
 if __name__ == "__main__":
 
     import logging
@@ -0,0 +1,178 @@
+"""
+A pool of connected sockets for a port forward service.
+
+New port forward connections take a socket from the pool, so the first bytes from the channel
+don't have to wait for a connect. The pool is refilled in the background.
+
+Idle sockets are watched for the server closing them, and replaced before they have been idle
+for `max_idle` seconds (servers tend to close connections that haven't sent a request).
+
+Pooling only suits services where the client speaks first. A socket that receives data while
+idle (e.g. an SSH or SMTP banner) is discarded, since a later close by the server would be hidden
+behind the buffered data, and the pool stops connecting ahead of time for that service.
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+import errno
+import logging
+import socket
+
+from ..reactor import selectors
+
+
+log = logging.getLogger("dataplicity")
+
+
+class _PooledSocket(object):
+
+    __slots__ = ['sock', 'timer']
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.timer = None
+
+
+class SocketPool(object):
+    """Keeps up to `size` idle connections to an address. Only use from the reactor thread."""
+
+    def __init__(self, reactor, address, size=2, max_idle=20.0, retry_interval=5.0, connect_timeout=5.0):
+        self.reactor = reactor
+        self.address = address
+        self.size = size
+        self.max_idle = max_idle
+        self.retry_interval = retry_interval
+        self.connect_timeout = connect_timeout
+        self._idle = deque()
+        self._connecting = 0
+        self._retry_timer = None
+        self._closed = False
+        # Set if the server sends data before the client, which makes pooling unsafe
+        self.server_speaks_first = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def __repr__(self):
+        return "<socketpool {}:{} {}/{} idle>".format(self.address[0], self.address[1], len(self._idle), self.size)
+
+    def __len__(self):
+        return len(self._idle)
+
+    @property
+    def metrics(self):
+        """A dict of pool metrics."""
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "connecting": self._connecting,
+            "hits": self.hits,
+            "misses": self.misses,
+            "discarded": self.discarded,
+            "server_speaks_first": self.server_speaks_first
+        }
+
+    def start(self):
+        """Start filling the pool (may be called from any thread)."""
+        self.reactor.call_soon(self.fill)
+
+    def fill(self):
+        """Connect until there are `size` idle or connecting sockets."""
+        if self._closed or self.server_speaks_first or self._retry_timer is not None:
+            return
+        while len(self._idle) + self._connecting < self.size:
+            self._connecting += 1
+            self.reactor.connect(self.address, self._on_connect, self.connect_timeout)
+
+    def _retry(self):
+        self._retry_timer = None
+        self.fill()
+
+    def _on_connect(self, sock, error):
+        self._connecting -= 1
+        if self._closed:
+            if sock is not None:
+                sock.close()
+            return
+        if sock is None:
+            # Wait a while, rather than hammer a service that is down
+            log.debug('unable to pre-connect to %s:%s (%s)', self.address[0], self.address[1], error)
+            if self._retry_timer is None:
+                self._retry_timer = self.reactor.call_later(self.retry_interval, self._retry)
+            return
+        pooled = _PooledSocket(sock)
+        pooled.timer = self.reactor.call_later(self.max_idle, self._expire, pooled)
+        self.reactor.register(sock, selectors.EVENT_READ, lambda events: self._on_readable(pooled))
+        self._idle.append(pooled)
+
+    def _on_readable(self, pooled):
+        if self._is_alive(pooled.sock):
+            # The server sent data first (e.g. a banner). We couldn't tell if it later closed the
+            # socket, so stop pooling and let new connections connect as usual
+            if not self.server_speaks_first:
+                log.info('%s:%s sends data on connect, not pooling connections',
+                         self.address[0], self.address[1])
+                self.server_speaks_first = True
+            self._discard(pooled)
+        else:
+            self._discard(pooled)
+            self.fill()
+
+    def _expire(self, pooled):
+        pooled.timer = None
+        self._discard(pooled)
+        self.fill()
+
+    def _discard(self, pooled):
+        try:
+            self._idle.remove(pooled)
+        except ValueError:
+            return
+        self.discarded += 1
+        self._release(pooled)
+        pooled.sock.close()
+
+    def _release(self, pooled):
+        if pooled.timer is not None:
+            self.reactor.cancel(pooled.timer)
+        self.reactor.unregister(pooled.sock)
+
+    @classmethod
+    def _is_alive(cls, sock):
+        """Check the server hasn't closed (or reset) a connection."""
+        try:
+            return bool(sock.recv(1, socket.MSG_PEEK))
+        except socket.error as error:
+            return error.errno in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def take(self):
+        """Get a connected socket, or None if there are none ready."""
+        sock = None
+        while self._idle:
+            pooled = self._idle.popleft()
+            self._release(pooled)
+            if self._is_alive(pooled.sock):
+                sock = pooled.sock
+                break
+            self.discarded += 1
+            pooled.sock.close()
+        if sock is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.fill()
+        return sock
+
+    def close(self):
+        """Close idle sockets, and stop refilling."""
+        self._closed = True
+        if self._retry_timer is not None:
+            self.reactor.cancel(self._retry_timer)
+            self._retry_timer = None
+        while self._idle:
+            pooled = self._idle.popleft()
+            self._release(pooled)
+            pooled.sock.close()
@@ -8,180 +8,216 @@ Reads and writes to a socket, proxied over m2m
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
 import logging
-import select
 import socket
 import threading
 import weakref
 
+from .pool import SocketPool
+from ..reactor import Reactor, selectors
+from ..m2m.chunkbuffer import ChunkBuffer
+
 
 log = logging.getLogger("dataplicity")
 
+_WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Connection(object):
+    """Handles a single remote controlled TCP/IP connection.
 
-class Connection(threading.Thread):
-    """Handles a single remote controlled TCP/IP connection."""
+    Socket I/O happens in the reactor thread. Data from the channel is buffered and written
+    when the socket is writable, and the socket is only read while the channel is writable, so
+    the local server is throttled by TCP rather than buffering in memory.
+
+    """
 
     # Max to read at-a-time
     BUFFER_SIZE = 1024 * 32
+    # Seconds to wait for the local server to accept the connection
+    CONNECT_TIMEOUT = 5.0
 
     def __init__(self, service, connection_id, channel):
         """Initialize the connection, set up callbacks."""
-        super(Connection, self).__init__()
         self._service = weakref.ref(service)
         self.connection_id = connection_id
         self.channel = channel
+        self.reactor = service.reactor
 
-        self._lock = threading.RLock()
+        self._lock = threading.Lock()
         self.socket = None
-        self.read_buffer = []  # For data received before we connected
+        # Data from the channel, to write to the socket
+        self.write_buffer = ChunkBuffer()
+        self._flush_pending = False
+        self._connected = False
+        self._channel_closed = False
+        self._closed = False
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        self.channel.set_callbacks(on_data=self.on_channel_data,
+                                   on_close=self.on_channel_close,
+                                   on_control=self.on_channel_control,
+                                   on_writable=self.on_channel_writable)
 
-        self.channel.set_callbacks(self.on_channel_data,
-                                   self.on_channel_close,
-                                   self.on_channel_control)
+    def __repr__(self):
+        return "<connection {} on {!r}>".format(self.connection_id, self.channel)
 
     @property
     def service(self):
         """Get the parent service object (weak reference, may return None)."""
         return self._service()
 
-    @property
-    def close_event(self):
-        """Get a threading.Event object."""
-        return self.service.close_event
+    def connect(self):
+        """Connect to the local server (doesn't block)."""
+        self.reactor.call_soon(self._connect)
 
-    def run(self):
-        """Main loop, connects to local server, reads data, and writes it to an m2m channel."""
-        log.debug("connection started")
-        bytes_written = 0
+    def _connect(self):
+        if self._closed:
+            return
+        service = self.service
+        sock = service.pool.take() if service.pool is not None else None
+        if sock is not None:
+            log.debug('using pooled connection to %s', service.url)
+            self._on_connect(sock, None)
+        else:
+            log.debug('connecting to %s', service.url)
+            self.socket = self.reactor.connect(service.host_port, self._on_connect, self.CONNECT_TIMEOUT)
+
+    def _on_connect(self, sock, error):
+        if self._closed:
+            if sock is not None:
+                sock.close()
+            return
+        if sock is None:
+            log.error('error connecting to %s (%s)', self.service.url, error)
+            self.close()
+            return
+        log.debug("connected to %s", self.service.url)
+        self.socket = sock
+        self._connected = True
+        # Send data received before we connected
+        self._flush()
+
+    def _update_events(self):
+        """Wait for the socket events we can handle."""
+        if self._closed or not self._connected:
+            return
+        events = 0
+        if self.channel.writable:
+            events |= selectors.EVENT_READ
+        if self.write_buffer:
+            events |= selectors.EVENT_WRITE
+        self.reactor.modify(self.socket, events, self._on_events)
+
+    def _on_events(self, events):
+        if events & selectors.EVENT_WRITE:
+            self._flush()
+        if events & selectors.EVENT_READ and not self._closed:
+            self._read()
+
+    def _read(self):
+        """Read from the socket, and write to the channel."""
         try:
-            # Connect to remote host
-            if not self._connect():
+            # Reads *up to* BUFFER_SIZE bytes
+            data = self.socket.recv(self.BUFFER_SIZE)
+        except socket.error as error:
+            if error.errno in _WOULD_BLOCK:
                 return
-
-            log.debug("entered recv loop")
-            # Read all the data we can and write it to the channel
-            # TODO: Rework this loop to not use the timeout
-            while not self.close_event.is_set():
-                # Block for a period of time until the socket becomes readable, or there is an error
-                try:
-                    readable, _, exceptional = select.select([self.socket], [], [self.socket], 5.0)
-                except Exception as e:
-                    # For paranoia only.
-                    log.warning('error %s in select', e)
-                    break
-                if readable:
-                    try:
-                        # Reads *up to* BUFFER_SIZE bytes
-                        data = self.socket.recv(self.BUFFER_SIZE)
-                    except:
-                        log.exception('error in recv')
+            log.debug('error in recv (%s)', error)
+            self.close()
+            return
+        if not data:
+            # No data means the socket has been closed
+            self.close()
+            return
+        self.bytes_read += len(data)
+        self.channel.write(data)
+        if not self.channel.writable:
+            # Stop reading until the channel's window reopens
+            self._update_events()
+
+    def _flush(self):
+        """Write as much buffered channel data as the socket will take."""
+        if self._closed or not self._connected:
+            return
+        with self._lock:
+            self._flush_pending = False
+            write_buffer = self.write_buffer
+            try:
+                while write_buffer:
+                    data = write_buffer.peek()
+                    sent = self.socket.send(data)
+                    write_buffer.skip(sent)
+                    self.bytes_written += sent
+                    if sent < len(data):
                         break
-                    else:
-                        if data:
-                            self.channel.write(data)
-                            bytes_written += len(data)
-                        else:
-                            # No data means the socket has been closed
-                            break
-                if exceptional:
-                    # Socket has been closed in another thread, possibly due to
-                    # m2m channel closing
-                    break
-        finally:
-            log.debug("left recv loop (read %s bytes)", bytes_written)
-            # Tell service we're done with this connection
-            self.service.on_connection_complete(self.connection_id)
-            # These close methods are a null operation if the objects are already closed
-            self.channel.close()
-            self._shutdown_read()
+            except socket.error as error:
+                if error.errno not in _WOULD_BLOCK:
+                    log.debug('error in send (%s)', error)
+                    write_buffer.clear()
+                    self._close_later()
+                    return
+            finished = self._channel_closed and not write_buffer
+        if finished:
+            self._shutdown_write()
+        self._update_events()
 
-    def _shutdown_read(self):
-        """Shutdown reading."""
-        with self._lock:
-            if self.socket:
-                try:
-                    self.socket.shutdown(socket.SHUT_RD)
-                except:
-                    pass
+    def _close_later(self):
+        # Called with the lock held
+        self.reactor.call_soon(self.close)
 
     def _shutdown_write(self):
         """Shutdown writing."""
-        with self._lock:
-            if self.socket:
-                try:
-                    self.socket.shutdown(socket.SHUT_WR)
-                except:
-                    pass
-
-    def _close_socket(self):
-        """Shutdown the socket."""
-        with self._lock:
-            if self.socket is not None:
-                try:
-                    self.socket.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                try:
-                    self.socket.close()
-                except:
-                    log.exception('error closing socket')
-
-    def connect(self):
-        """Start thread, and connect to local server."""
-        # Connect may block, so do it in a thread
-        self.start()
-
-    def _connect(self):
-        """Connect to a local server, return True on success."""
-        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # No Nagle since we are going for as close to realtime as possible
-        _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        # Set the timeout for initial connect, as default is too high
-        _socket.settimeout(5.0)
-
-        log.debug('connecting to %s', self.service.url)
         try:
-            _socket.connect(self.service.host_port)
-        except socket.timeout:
-            log.exception('timed out connecting to server')
-            return False
-        except IOError:
-            log.exception('IO Error when connecting')
-            return False
-        except:
-            log.exception('error connecting')
-            return False
-        else:
-            log.debug("connected to %s", self.service.url)
-            _socket.setblocking(0)  # set non-blocking
-            self.socket = _socket
-            self._flush_buffer()
-            return True
+            self.socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    def close(self):
+        """Close the socket and the channel (call from the reactor thread)."""
+        if self._closed:
+            return
+        self._closed = True
+        log.debug("%r closed (read %s bytes, wrote %s bytes)", self, self.bytes_read, self.bytes_written)
+        if self.socket is not None:
+            self.reactor.unregister(self.socket)
+            try:
+                self.socket.close()
+            except socket.error:
+                log.exception('error closing socket')
+        with self._lock:
+            self.write_buffer.clear()
+        service = self.service
+        if service is not None:
+            # Tell service we're done with this connection
+            service.on_connection_complete(self.connection_id)
+        # A null operation if the channel is already closed
+        self.channel.close()
 
     def on_channel_data(self, data):
         """Called by m2m channel."""
         with self._lock:
-            self.read_buffer.append(data)
-            self._flush_buffer()
+            self.write_buffer.append(data)
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        self.reactor.call_soon(self._flush)
 
-    def _flush_buffer(self):
-        with self._lock:
-            if self.socket is not None:
-                try:
-                    for chunk in self.read_buffer:
-                        self.socket.sendall(chunk)
-                finally:
-                    del self.read_buffer[:]
+    def on_channel_writable(self):
+        """Called by m2m channel when we can write again."""
+        self.reactor.call_soon(self._update_events)
 
     def on_channel_close(self):
         """Called when the channel has been closed."""
         log.debug('channel close')
-        with self._lock:
-            # Shut down the socket
-            # This will cause an exeptional condition in the select loop,
-            # which will subsequently exit cleanly
-            self._flush_buffer()
-            self._shutdown_write()
+        self.reactor.call_soon(self._on_channel_close)
+
+    def _on_channel_close(self):
+        # Shut down writing once the buffer is sent, the server will then close the socket
+        self._channel_closed = True
+        self._flush()
 
     def on_channel_control(self, data):
         """Called when the remote end sends a control packet (currently not used)."""
@@ -191,7 +227,7 @@ class Connection(threading.Thread):
 class Service(object):
     """A service defines a host and port to forward."""
 
-    def __init__(self, manager, name, port, host="127.0.0.1"):
+    def __init__(self, manager, name, port, host="127.0.0.1", pool_size=0, pool_max_idle=20.0):
         self._manager = weakref.ref(manager)
         self.name = name
         self.port = port
@@ -199,6 +235,11 @@ class Service(object):
         self._connect_index = 0
         self._connections = {}
         self._lock = threading.RLock()
+        # Sockets connected ahead of time, if pool_size is set
+        self.pool = None
+        if pool_size:
+            self.pool = SocketPool(manager.reactor, self.host_port, size=pool_size, max_idle=pool_max_idle)
+            self.pool.start()
 
     def __repr__(self):
         """Some useful info re the service."""
@@ -219,6 +260,11 @@ class Service(object):
         """The one close event to rule them all."""
         return self.manager.close_event
 
+    @property
+    def reactor(self):
+        """The reactor that handles the sockets."""
+        return self.manager.reactor
+
     @property
     def host_port(self):
         """A tuple of (host, port) as a convenience for socket.connect."""
@@ -237,13 +283,26 @@ class Service(object):
             channel = self.m2m.m2m_client.get_channel(port_no)
             connection = Connection(self, connection_id, channel)
             self._connections[connection_id] = connection
-        connection.start()
+        connection.connect()
         return connection_id
 
     def remove_connection(self, connection_id):
         with self._lock:
             self._connections.pop(connection_id, None)
 
+    def close_connections(self):
+        """Close all connections."""
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            connection.reactor.call_soon(connection.close)
+
+    def close(self):
+        """Close connections and pooled sockets."""
+        self.close_connections()
+        if self.pool is not None:
+            self.pool.reactor.call_soon(self.pool.close)
+
     def on_connection_complete(self, connection_id):
         """Called by a connection when it is finished."""
         with self._lock:
@@ -258,6 +317,8 @@ class PortForwardManager(object):
         self._services = {}
         self._ports = {}
         self._close_event = threading.Event()
+        self._reactor = None
+        self._lock = threading.Lock()
 
     @property
     def client(self):
@@ -275,13 +336,34 @@ class PortForwardManager(object):
             if not conf.get_bool(section, 'enabled', True):
                 continue
             port = conf.get_integer(section, 'port', 80)
-            manager.add_service(name, port)
+            pool_size = conf.get_integer(section, 'pool_size', 0)
+            pool_max_idle = conf.get_float(section, 'pool_max_idle', 20.0)
+            manager.add_service(name, port, pool_size=pool_size, pool_max_idle=pool_max_idle)
         return manager
 
     @property
     def close_event(self):
         return self._close_event
 
+    @property
+    def reactor(self):
+        """Get the reactor, started on first use."""
+        with self._lock:
+            if self._reactor is None:
+                self._reactor = Reactor(name="portforward")
+                self._reactor.start()
+            return self._reactor
+
+    def close(self):
+        """Stop handling connections."""
+        self._close_event.set()
+        for service in self._services.values():
+            service.close()
+        with self._lock:
+            if self._reactor is not None:
+                self._reactor.stop()
+                self._reactor = None
+
     def on_client_close(self):
         """M2M client closed."""
         log.debug('m2m exited')
@@ -297,9 +379,15 @@ class PortForwardManager(object):
         """Get a named service."""
         return self._services.get(service, default)
 
-    def add_service(self, name, port, host="127.0.0.1"):
-        """Add a service to be exposed."""
-        service = Service(self, name, port, host=host)
+    def add_service(self, name, port, host="127.0.0.1", pool_size=0, pool_max_idle=20.0):
+        """Add a service to be exposed.
+
+        If `pool_size` is set, that many connections to the service are kept open and ready
+        for new port forwards. This is only suitable for servers that handle many connections
+        at once, since the idle connections may otherwise block real ones.
+
+        """
+        service = Service(self, name, port, host=host, pool_size=pool_size, pool_max_idle=pool_max_idle)
         self._services[name] = service
         self._ports[port] = name
         log.debug("added port forward service '%s' on port %s", name, port)
@@ -0,0 +1,203 @@
+"""
+An event loop for sockets and file descriptors.
+
+Used where many connections would otherwise need a thread each (port forwards, terminals). All
+I/O is handled in one thread, which waits on the file objects with a selector. Work from other
+threads (data from an m2m channel, a channel closing) is queued with `call_soon`, which wakes
+up the selector.
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+import errno
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors
+
+
+log = logging.getLogger("dataplicity")
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_CONNECT_PENDING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Reactor(threading.Thread):
+    """Runs callbacks when sockets are ready."""
+
+    def __init__(self, name="reactor"):
+        super(Reactor, self).__init__(name=name)
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._timers = []
+        # Tie breaker for timers with the same deadline
+        self._timer_count = itertools.count()
+        self._stopped = False
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self._wake_write.setblocking(False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ, None)
+
+    def __repr__(self):
+        return "<reactor '{}' {} files>".format(self.name, len(self._selector.get_map()) - 1)
+
+    def in_thread(self):
+        """Check if we are running in the reactor thread."""
+        return threading.current_thread() is self
+
+    def call_soon(self, callback, *args):
+        """Call `callback` in the reactor thread (may be called from any thread)."""
+        with self._lock:
+            self._calls.append((callback, args))
+            wake = len(self._calls) == 1
+        if wake and not self.in_thread():
+            try:
+                self._wake_write.send(b'\0')
+            except socket.error:
+                # Already has a wake up pending
+                pass
+
+    def call_later(self, delay, callback, *args):
+        """Call `callback` after `delay` seconds. Only call from the reactor thread."""
+        timer = [_clock() + delay, next(self._timer_count), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer returned from `call_later`."""
+        timer[2] = None
+
+    def register(self, fileobj, events, handler):
+        """Call `handler(events)` when a socket (or file descriptor) is ready."""
+        self._selector.register(fileobj, events, handler)
+
+    def modify(self, fileobj, events, handler):
+        """Change the events a file is waiting for (unregisters if there are no events)."""
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd == -1:
+            # Closed
+            return
+        registered = fd in self._selector.get_map()
+        if not events:
+            if registered:
+                self._selector.unregister(fd)
+        elif registered:
+            self._selector.modify(fd, events, handler)
+        else:
+            self._selector.register(fd, events, handler)
+
+    def unregister(self, fileobj):
+        self.modify(fileobj, 0, None)
+
+    def connect(self, address, callback, timeout=5.0):
+        """Connect a TCP socket without blocking. Only call from the reactor thread.
+
+        Calls `callback(sock, None)` when connected, or `callback(None, error message)`. Returns
+        the socket, which may be closed to abandon the connect.
+
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # No Nagle since we are going for as close to realtime as possible
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        error = sock.connect_ex(address)
+        if error and error not in _CONNECT_PENDING:
+            sock.close()
+            self.call_soon(callback, None, os.strerror(error))
+            return sock
+
+        def on_connect(events):
+            self.cancel(timer)
+            self.unregister(sock)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                sock.close()
+                callback(None, os.strerror(error))
+            else:
+                callback(sock, None)
+
+        def on_timeout():
+            self.unregister(sock)
+            sock.close()
+            callback(None, 'timed out')
+
+        self.register(sock, selectors.EVENT_WRITE, on_connect)
+        timer = self.call_later(timeout, on_timeout)
+        return sock
+
+    def stop(self):
+        """Stop the reactor thread."""
+        self._stopped = True
+        self.call_soon(lambda: None)
+
+    def _run_calls(self):
+        with self._lock:
+            calls = self._calls
+            self._calls = deque()
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception:
+                log.exception('error in reactor callback')
+
+    def _run_timers(self):
+        timers = self._timers
+        now = _clock()
+        while timers and timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(timers)
+            if callback is not None:
+                try:
+                    callback(*args)
+                except Exception:
+                    log.exception('error in reactor timer')
+
+    def _get_timeout(self):
+        if self._calls:
+            return 0
+        timers = self._timers
+        while timers and timers[0][2] is None:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return max(0, timers[0][0] - _clock())
+
+    def run(self):
+        log.debug('%r started', self)
+        selector = self._selector
+        try:
+            while not self._stopped:
+                for key, events in selector.select(self._get_timeout()):
+                    if key.data is None:
+                        try:
+                            while self._wake_read.recv(4096):
+                                pass
+                        except socket.error:
+                            pass
+                        continue
+                    try:
+                        key.data(events)
+                    except Exception:
+                        log.exception('error handling events')
+                self._run_calls()
+                self._run_timers()
+            # Calls queued before the stop
+            self._run_calls()
+        finally:
+            selector.close()
+            self._wake_read.close()
+            self._wake_write.close()
+            log.debug('%r exited', self)
@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import asyncio
+import threading
+import unittest
+
+from dataplicity.m2m import bencode, rfc6455
+from dataplicity.m2m.asyncclient import AsyncWSClient, WebSocketConnection
+from dataplicity.m2m.packets import PacketType
+
+
+class EchoServer(object):
+    """A local M2M server that sends channel data back on the same channel."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.packets = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.started.wait(5)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, '127.0.0.1', 0)
+        )
+        self.url = 'ws://127.0.0.1:{}/m2m/'.format(self.server.sockets[0].getsockname()[1])
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+    async def handle(self, reader, writer):
+        request = await reader.readuntil(b'\r\n\r\n')
+        writer.write(rfc6455.handshake_response(request))
+        connection = WebSocketConnection(reader, writer, mask=False)
+        while 1:
+            data = await connection.recv()
+            if data is None:
+                break
+            packet = bencode.decode(data)
+            self.packets.append(packet[0])
+            if packet[0] == PacketType.request_join:
+                connection.send_binary(bencode.encode([PacketType.set_identity, b'device']))
+                connection.send_binary(bencode.encode([PacketType.welcome]))
+            elif packet[0] == PacketType.request_send:
+                connection.send_binary(bencode.encode([PacketType.route, packet[1], packet[2]]))
+            elif packet[0] == PacketType.request_leave:
+                break
+        connection.close()
+
+
+class TestAsyncClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EchoServer()
+        self.client = AsyncWSClient(self.server.url)
+
+    def tearDown(self):
+        self.client.close(timeout=1)
+        self.server.close()
+
+    def test_connect(self):
+        """Test joining and leaving the server"""
+        self.assertEqual(self.client.connect(timeout=5), b'device')
+        self.client.close()
+        self.assertTrue(self.client.close_event.wait(5))
+        self.assertEqual(self.server.packets, [PacketType.request_join, PacketType.request_leave])
+
+    def test_blocking_channel(self):
+        """Test the blocking channel interface"""
+        self.client.connect(timeout=5)
+        channel = self.client.get_channel(1)
+        channel.write(b'hello')
+        self.assertEqual(channel.read(5, timeout=5, block=True), b'hello')
+
+    def test_async_channels(self):
+        """Test many channels read and written with coroutines, in one thread"""
+        self.client.connect(timeout=5)
+        thread_count = threading.active_count()
+
+        async def echo(channel_no):
+            channel = self.client.get_channel(channel_no)
+            data = 'channel {}'.format(channel_no).encode('ascii') * 100
+            await channel.awrite(data)
+            received = b''
+            while len(received) < len(data):
+                received += await channel.aread(len(data))
+            return received == data
+
+        async def echo_all():
+            return await asyncio.gather(*[echo(channel_no) for channel_no in range(1, 301)])
+
+        results = self.client.run_coroutine(echo_all()).result(10)
+        self.assertEqual(results, [True] * 300)
+        self.assertEqual([channel.metrics['window'] for channel in self.client.channels.values()], [0] * 300)
+        self.assertEqual(threading.active_count(), thread_count)
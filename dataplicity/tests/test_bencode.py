@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+
+from dataplicity.m2m import bencode
+from dataplicity.m2m.bencode import decode, DecodeError
+
+
+class TestBencode(unittest.TestCase):
+
+    def test_decode(self):
+        """Test decoding nested values"""
+        self.assertEqual(decode(b'i-20e'), -20)
+        self.assertEqual(decode(b'0:'), b'')
+        self.assertEqual(decode(b'li1e4:spamd3:cowl3:mooi2eee0:e'),
+                         [1, b'spam', {b'cow': [b'moo', 2]}, b''])
+
+    def test_decode_errors(self):
+        """Test badly formatted data is rejected"""
+        for data in [b'', b'i1', b'l', b'e', b'5:abc', b'i1x2e', b'i1ei2e', b'd1:ae', b'x', b'-1:a', b'dli1ee1:ae']:
+            self.assertRaises(DecodeError, decode, data)
+        self.assertRaises(DecodeError, decode, 'i1e')
+
+    def test_limits(self):
+        """Test maximum depth and size"""
+        self.assertEqual(decode(b'll' + b'e' * 2, max_depth=2), [[]])
+        self.assertRaises(DecodeError, decode, b'lll' + b'e' * 3, max_depth=2)
+        self.assertEqual(decode(b'3:abc', max_size=5), b'abc')
+        self.assertRaises(DecodeError, decode, b'4:abcd', max_size=5)
+
+    def test_zero_copy(self):
+        """Test large strings may be returned as memoryviews"""
+        data = b'x' * bencode.ZERO_COPY_SIZE
+        encoded = 'li1e3:abc{}:'.format(len(data)).encode('ascii') + data + b'e'
+        decoded = decode(encoded, zero_copy=True)
+        self.assertEqual(decoded[1], b'abc')
+        self.assertIsInstance(decoded[2], memoryview)
+        self.assertEqual(decoded[2].tobytes(), data)
+        self.assertIsInstance(decode(encoded)[2], bytes)
+
+    def test_encode(self):
+        """Test encoding round trips"""
+        obj = [5, -7, 5000, b'abc', {b'b': 1, b'a': [1, {}]}, []]
+        encoded = bencode.encode(obj)
+        self.assertEqual(encoded, b'li5ei-7ei5000e3:abcd1:ali1edee1:bi1eelee')
+        self.assertEqual(decode(encoded), obj)
+        self.assertEqual(bencode.encode('text'), b'4:text')
+        self.assertEqual(bencode.encode(bytearray(b'xy')), b'2:xy')
+        self.assertRaises(bencode.EncodingError, bencode.encode, {'key': 1})
+        self.assertRaises(bencode.EncodingError, bencode.encode, object())
+
+    def test_encode_channel_packet(self):
+        """Test the channel packet fast path matches the general encoder"""
+        data = b'\x00' * 65536
+        self.assertEqual(bencode.encode_channel_packet(5, 3, data), bencode.encode([5, 3, data]))
+        self.assertEqual(bencode.encode_channel_packet(5, 3000, b''), b'li5ei3000e0:e')
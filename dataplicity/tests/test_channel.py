@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import threading
+import unittest
+
+from dataplicity.m2m.chunkbuffer import ChunkBuffer
+from dataplicity.m2m.wsclient import Channel
+
+
+class DeferredClient(object):
+    """Collects channel writes, and reports them sent when asked."""
+
+    def __init__(self):
+        self.unsent = []
+
+    def channel_write(self, channel, data, on_sent=None):
+        self.unsent.append(on_sent)
+
+    def send_all(self):
+        for on_sent in self.unsent:
+            on_sent()
+        del self.unsent[:]
+
+
+class TestChannel(unittest.TestCase):
+
+    def test_flow_control(self):
+        """Test the window closes at the high watermark and opens at the low watermark"""
+        client = DeferredClient()
+        channel = Channel(client, 1, high_watermark=1000, low_watermark=500)
+        for _ in range(9):
+            channel.write(b'x' * 100)
+        self.assertTrue(channel.writable)
+        channel.write(b'x' * 100)
+        self.assertFalse(channel.writable)
+        self.assertFalse(channel.wait_writable(0.01))
+
+        # Sending half isn't enough to open the window
+        for on_sent in client.unsent[:5]:
+            on_sent()
+        del client.unsent[:5]
+        self.assertTrue(channel.writable)
+        channel.write(b'x' * 500)
+        self.assertFalse(channel.writable)
+
+        thread = threading.Timer(0.05, client.send_all)
+        thread.start()
+        self.assertTrue(channel.wait_writable(5))
+        thread.join()
+
+        metrics = channel.metrics
+        self.assertEqual(metrics['bytes_written'], 1500)
+        self.assertEqual(metrics['window'], 0)
+        self.assertEqual(metrics['pause_count'], 2)
+        self.assertGreater(metrics['pause_time'], 0)
+
+    def test_close(self):
+        """Test closing a channel wakes up writers"""
+        channel = Channel(DeferredClient(), 1, high_watermark=10, low_watermark=0)
+        channel.write(b'x' * 10)
+        threading.Timer(0.05, channel.on_close).start()
+        self.assertTrue(channel.wait_writable(5))
+
+
+class TestChunkBuffer(unittest.TestCase):
+
+    def test_read(self):
+        """Test reading across chunk boundaries"""
+        buffer = ChunkBuffer()
+        buffer.append(b'hello')
+        buffer.append(b'')
+        buffer.append(memoryview(b' world'))
+        self.assertEqual(len(buffer), 11)
+        self.assertEqual(buffer.read(3), b'hel')
+        self.assertEqual(buffer.read(4), b'lo w')
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.read(100), b'orld')
+        self.assertFalse(buffer)
+        self.assertEqual(buffer.read(10), b'')
+
+    def test_readinto(self):
+        """Test reading in to a bytearray"""
+        buffer = ChunkBuffer()
+        buffer.append(b'abc')
+        buffer.append(b'defg')
+        target = bytearray(5)
+        self.assertEqual(buffer.readinto(target), 5)
+        self.assertEqual(target, bytearray(b'abcde'))
+        self.assertEqual(buffer.readinto(target), 2)
+        self.assertEqual(target[:2], bytearray(b'fg'))
+
+    def test_channel_read(self):
+        """Test a channel reads from its buffer"""
+        channel = Channel(DeferredClient(), 1)
+        channel.on_data(b'x' * 100)
+        self.assertEqual(channel.size, 100)
+        self.assertEqual(channel.read(60), b'x' * 60)
+        target = bytearray(60)
+        self.assertEqual(channel.readinto(target, timeout=1, block=True), 40)
+        self.assertEqual(channel.read(10, timeout=0.01, block=True), b'')
@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+
+from dataplicity.m2m.dispatcher import Dispatcher, PacketFormatError, expose
+from dataplicity.m2m.packets import M2MPacket, PacketType
+
+
+class Handler(Dispatcher):
+
+    def __init__(self, **kwargs):
+        self.received = []
+        super(Handler, self).__init__(M2MPacket, **kwargs)
+
+    @expose(PacketType.route)
+    def handle_route(self, packet_type, channel, data):
+        self.received.append((packet_type, channel, data))
+
+    @expose(PacketType.welcome)
+    def handle_welcome(self, packet_type):
+        self.received.append((packet_type,))
+
+    @expose(PacketType.log)
+    def handle_log(self, packet_type, msg, extra):
+        pass
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_dispatch(self):
+        """Test packets are dispatched to handlers"""
+        for debug in (False, True):
+            handler = Handler(debug=debug)
+            handler.dispatch(PacketType.route, [3, b'hello'])
+            handler.dispatch(PacketType.welcome, [])
+            self.assertEqual(handler.received, [(PacketType.route, 3, b'hello'), (PacketType.welcome,)])
+            self.assertRaises(PacketFormatError, handler.dispatch, PacketType.log, [b'message'])
+
+    def test_handler_instance(self):
+        """Test dispatching to methods of another object"""
+        handler = Handler()
+        dispatcher = Dispatcher(handler_instance=handler)
+        dispatcher.dispatch_packet(M2MPacket.create(PacketType.route, 1, b'data'))
+        self.assertEqual(handler.received, [(PacketType.route, 1, b'data')])
@@ -0,0 +1,259 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import tempfile
+import shutil
+
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from base64 import b64encode
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from dataplicity.jsonrpc import encode_request, JSONRPC, RequestBody, ServerUnreachableError, StreamedBase64
+from dataplicity.transport import HTTPTransport
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Responds to calls with their params, and counts connections."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        content_encoding = self.headers.get('Content-Encoding')
+        self.server.request_encodings.append(content_encoding)
+        reject = self.server.reject_compressed
+        if content_encoding is not None and reject is not None:
+            if reject == 'parse_error':
+                # A server that ignores Content-Encoding, and can't parse the body
+                self.send_json({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "Parse error"}})
+            else:
+                self.send_response(reject)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            return
+        if content_encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif content_encoding == 'deflate':
+            body = zlib.decompress(body)
+        time.sleep(self.server.response_delay)
+        if self.server.fail_count:
+            self.server.fail_count -= 1
+            self.send_response(self.server.fail_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        call = json.loads(body.decode('utf-8'))
+        if isinstance(call, list):
+            result = [{"jsonrpc": "2.0", "id": c['id'], "result": c['params']} for c in call]
+        else:
+            result = {"jsonrpc": "2.0", "id": call['id'], "result": call['params']}
+        self.send_json(result)
+
+    def send_json(self, result):
+        response = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        response_encoding = self.server.response_encoding
+        if response_encoding is not None and response_encoding in self.headers.get('Accept-Encoding', ''):
+            if response_encoding == 'gzip':
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            else:
+                compressor = zlib.compressobj()
+            response = compressor.compress(response) + compressor.flush()
+            self.send_header('Content-Encoding', response_encoding)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        # Close without telling the client, like a server with a short keep-alive timeout
+        self.close_connection = self.server.close_idle
+
+    def log_message(self, *args):
+        pass
+
+
+class TestJSONRPC(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp('dptest')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_encode_request(self):
+        """Test files are streamed in to the request body"""
+        self.assertEqual(json.loads(encode_request({"a": 1}).decode('utf-8')), {"a": 1})
+
+        data = os.urandom(100000)
+        path = os.path.join(self.temp_dir, 'data')
+        with open(path, 'wb') as f:
+            f.write(data)
+        call = {"method": "device.add_events", "params": {"data": StreamedBase64(path), "text": "hello"}}
+        body = encode_request(call)
+        self.assertIsInstance(body, RequestBody)
+
+        chunks = []
+        while 1:
+            chunk = body.read(8192)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        body_bytes = b''.join(chunks)
+        self.assertEqual(len(body), len(body_bytes))
+        decoded = json.loads(body_bytes.decode('utf-8'))
+        self.assertEqual(decoded['params']['data'], b64encode(data).decode('ascii'))
+        self.assertEqual(decoded['params']['text'], 'hello')
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp('dptest')
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = 0
+        self.server.fail_count = 0
+        self.server.fail_status = 503
+        self.server.response_delay = 0
+        self.server.close_idle = False
+        self.server.request_encodings = []
+        self.server.reject_compressed = None
+        self.server.response_encoding = None
+        self.server_thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.transport = HTTPTransport(backoff=0.01)
+        self.url = "http://127.0.0.1:{}/jsonrpc/".format(self.server.server_address[1])
+        self.remote = JSONRPC(self.url, transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_keep_alive(self):
+        """Test calls reuse a connection"""
+        for n in range(10):
+            self.assertEqual(self.remote.call('echo', n=n), {"n": n})
+        with self.remote.batch() as batch:
+            batch.call_with_id('a', 'echo', n=10)
+        self.assertEqual(batch.get_result('a'), {"n": 10})
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.transport.connections, 1)
+
+    def test_closed_connection(self):
+        """Test a connection closed by the server is replaced"""
+        self.server.close_idle = True
+        for n in range(5):
+            self.assertEqual(self.remote.call('echo', n=n), {"n": n})
+        self.assertEqual(self.server.connections, 5)
+
+    def test_retry(self):
+        """Test requests are retried when the server is unavailable"""
+        self.server.fail_count = 2
+        path = os.path.join(self.temp_dir, 'data')
+        with open(path, 'wb') as f:
+            f.write(b'hello')
+        result = self.remote.call('echo', data=StreamedBase64(path))
+        self.assertEqual(result, {"data": b64encode(b'hello').decode('ascii')})
+        self.assertEqual(self.transport.retried, 2)
+
+        self.server.fail_count = 10
+        with self.assertRaises(ServerUnreachableError):
+            self.remote.call('echo')
+
+    def test_gateway_timeout(self):
+        """Test requests aren't sent again if the gateway timed out, as the server may have handled them"""
+        self.server.fail_count = 1
+        self.server.fail_status = 504
+        with self.assertRaises(ServerUnreachableError):
+            self.remote.call('echo')
+        self.assertEqual(len(self.server.request_encodings), 1)
+        self.assertEqual(self.transport.retried, 0)
+
+    def test_response_timeout(self):
+        """Test requests that time out waiting for a response aren't sent again"""
+        transport = HTTPTransport(timeout=0.2, backoff=0.01)
+        remote = JSONRPC(self.url, transport=transport)
+        self.assertEqual(remote.call('echo', n=1), {"n": 1})
+        self.server.response_delay = 0.5
+        with self.assertRaises(ServerUnreachableError):
+            remote.call('echo', n=2)
+        self.assertEqual(len(self.server.request_encodings), 2)
+        self.assertEqual(transport.retried, 0)
+        transport.close()
+
+    def test_unreachable(self):
+        """Test connection errors are retried, then raised"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = "http://127.0.0.1:{}/jsonrpc/".format(sock.getsockname()[1])
+        sock.close()
+        with self.assertRaises(ServerUnreachableError):
+            JSONRPC(url, transport=self.transport).call('echo')
+        self.assertEqual(self.transport.retried, self.transport.retries)
+
+    def test_compressed_request(self):
+        """Test large requests are compressed"""
+        self.remote.compression = 'gzip'
+        self.assertEqual(self.remote.call('echo', text='small'), {"text": "small"})
+        text = 'hello, world ' * 1000
+        self.assertEqual(self.remote.call('echo', text=text), {"text": text})
+        self.remote.compression = 'deflate'
+        self.assertEqual(self.remote.call('echo', text=text), {"text": text})
+        self.assertEqual(self.server.request_encodings, [None, 'gzip', 'deflate'])
+
+        # Streamed bodies are compressed too
+        data = os.urandom(10000) * 10
+        path = os.path.join(self.temp_dir, 'data')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.server.fail_count = 1
+        result = self.remote.call('echo', data=StreamedBase64(path))
+        self.assertEqual(result, {"data": b64encode(data).decode('ascii')})
+
+    def test_compression_off(self):
+        """Test requests aren't compressed unless compression is enabled"""
+        text = 'hello, world ' * 1000
+        self.assertEqual(self.remote.call('echo', text=text), {"text": text})
+        self.assertEqual(self.server.request_encodings, [None])
+
+    def test_unsupported_compression(self):
+        """Test requests are sent uncompressed if the server doesn't support compression"""
+        text = 'hello, world ' * 1000
+        for reject in (415, 400, 'parse_error'):
+            self.server.reject_compressed = reject
+            self.server.request_encodings = []
+            self.remote.compression = 'gzip'
+            self.assertEqual(self.remote.call('echo', text=text), {"text": text})
+            with self.remote.batch() as batch:
+                batch.call_with_id('a', 'echo', text=text)
+            self.assertEqual(batch.get_result('a'), {"text": text})
+            self.assertEqual(self.server.request_encodings, ['gzip', None, None])
+
+    def test_compressed_response(self):
+        """Test compressed responses are decompressed"""
+        text = 'hello, world ' * 10000
+        for encoding in ('gzip', 'deflate'):
+            self.server.response_encoding = encoding
+            self.assertEqual(self.remote.call('echo', text=text), {"text": text})
+        self.assertEqual(self.server.connections, 1)
@@ -0,0 +1,40 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+
+from dataplicity.m2m.packetbase import PacketFormatError
+from dataplicity.m2m.packets import (M2MPacket, PacketType, RequestSendPacket, RoutePacket,
+                                     CommandAddRoutePacket)
+
+
+class TestPackets(unittest.TestCase):
+
+    def test_encode(self):
+        """Test compiled encoding matches bencode of the packet data"""
+        packet = RequestSendPacket(3, b'hello')
+        self.assertEqual(packet.encode(), [PacketType.request_send, 3, b'hello'])
+        self.assertEqual(packet.as_bytes, b'li5ei3e5:helloe')
+        packet = CommandAddRoutePacket(1, 'node1', 2, b'node2', 3, b'requester', 0)
+        self.assertEqual(packet.node1, b'node1')
+        self.assertEqual(M2MPacket.from_bytes(packet.as_bytes).kwargs, packet.kwargs)
+
+    def test_decode(self):
+        """Test packets are created from bytes"""
+        packet = M2MPacket.from_bytes(b'li6ei3e5:helloe')
+        self.assertIsInstance(packet, RoutePacket)
+        self.assertEqual((packet.channel, packet.data), (3, b'hello'))
+        self.assertEqual(packet.get_method_args(1), ([3], {'data': b'hello'}))
+
+    def test_errors(self):
+        """Test bad parameters raise PacketFormatError"""
+        self.assertRaises(PacketFormatError, RequestSendPacket, data=b'hello')
+        self.assertRaises(PacketFormatError, RequestSendPacket, b'3', b'hello')
+        self.assertRaises(PacketFormatError, M2MPacket.create, 'request_send', 3, b'hello', data=b'again')
+        self.assertRaises(PacketFormatError, M2MPacket.from_bytes, b'li6ei3ee')
+
+    def test_slots(self):
+        """Test packets don't have an instance dict"""
+        packet = RequestSendPacket(True, b'hello')
+        self.assertEqual(packet.channel, True)
+        self.assertFalse(hasattr(packet, '__dict__'))
@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from collections import defaultdict
+import socket
+import threading
+import time
+import unittest
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from dataplicity.m2m.wsclient import Channel
+from dataplicity.portforward import PortForwardManager
+
+
+class LoopbackM2M(object):
+    """Stands in for the M2M client, and collects the data written to channels."""
+
+    def __init__(self):
+        self.m2m_client = self
+        self.channels = {}
+        self.received = defaultdict(bytes)
+        self.controls = defaultdict(list)
+        self.closed = set()
+        self.condition = threading.Condition()
+
+    def get_channel(self, channel_no):
+        channel = self.channels[channel_no] = Channel(self, channel_no)
+        return channel
+
+    def channel_write(self, channel_no, data, on_sent=None):
+        with self.condition:
+            self.received[channel_no] += data
+            self.condition.notify_all()
+        if on_sent is not None:
+            on_sent()
+
+    def channel_write_control(self, channel_no, data):
+        with self.condition:
+            self.controls[channel_no].append(data)
+            self.condition.notify_all()
+
+    def close_channel(self, channel_no):
+        with self.condition:
+            self.closed.add(channel_no)
+            self.condition.notify_all()
+        self.channels[channel_no].on_close()
+
+    def wait(self, predicate, timeout=5):
+        with self.condition:
+            return self.condition.wait_for(predicate, timeout)
+
+
+class Client(object):
+    def __init__(self):
+        self.m2m = LoopbackM2M()
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class BannerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.sendall(b'SSH-2.0-Test\r\n')
+        time.sleep(0.1)
+
+
+class EchoServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class TestPortForward(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EchoServer(('127.0.0.1', 0), EchoHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.server_thread.start()
+        self.client = Client()
+        self.m2m = self.client.m2m
+        self.manager = PortForwardManager(self.client)
+        self.manager.add_service('echo', self.server.server_address[1])
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def test_connections(self):
+        """Test many connections are forwarded by one thread"""
+        for channel_no in range(1, 31):
+            self.manager.open(channel_no, service='echo')
+        # Data may arrive before the connection is made
+        for channel_no in range(1, 31):
+            self.m2m.channels[channel_no].on_data(b'hello %i ' % channel_no * 1000)
+        self.assertTrue(self.m2m.wait(lambda: all(
+            len(self.m2m.received[channel_no]) == len(b'hello %i ' % channel_no * 1000)
+            for channel_no in range(1, 31)
+        )))
+        self.assertEqual(self.m2m.received[7], b'hello 7 ' * 1000)
+        thread_names = [thread.name for thread in threading.enumerate()]
+        self.assertEqual(thread_names.count('portforward'), 1)
+
+    def wait_for(self, predicate, timeout=5):
+        for _ in range(int(timeout * 100)):
+            if predicate():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_pool(self):
+        """Test connections use pooled sockets"""
+        self.manager.add_service('pooled', self.server.server_address[1], pool_size=2)
+        pool = self.manager.get_service('pooled').pool
+        self.assertTrue(self.wait_for(lambda: len(pool) == 2))
+        self.manager.open(1, service='pooled')
+        self.m2m.channels[1].on_data(b'hello')
+        self.assertTrue(self.m2m.wait(lambda: self.m2m.received[1] == b'hello'))
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 0)
+        # Refilled in the background
+        self.assertTrue(self.wait_for(lambda: len(pool) == 2))
+
+    def test_pool_expire(self):
+        """Test idle pooled sockets are replaced"""
+        self.manager.add_service('pooled', self.server.server_address[1], pool_size=1, pool_max_idle=0.05)
+        pool = self.manager.get_service('pooled').pool
+        self.assertTrue(self.wait_for(lambda: pool.discarded >= 2))
+        self.assertTrue(self.wait_for(lambda: len(pool) == 1))
+
+    def test_pool_banner(self):
+        """Test sockets the server sends data on aren't pooled"""
+        server = EchoServer(('127.0.0.1', 0), BannerHandler)
+        server_thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        server_thread.start()
+        try:
+            self.manager.add_service('banner', server.server_address[1], pool_size=2)
+            pool = self.manager.get_service('banner').pool
+            self.assertTrue(self.wait_for(lambda: pool.server_speaks_first and not len(pool)))
+            # The server has closed the connections since sending the banner
+            time.sleep(0.2)
+            self.assertEqual(len(pool), 0)
+            self.manager.open(1, service='banner')
+            self.assertTrue(self.m2m.wait(lambda: self.m2m.received[1] == b'SSH-2.0-Test\r\n'))
+            self.assertEqual(pool.hits, 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+
+    def test_close(self):
+        """Test closing the channel closes the connection"""
+        self.manager.open(1, service='echo')
+        channel = self.m2m.channels[1]
+        channel.on_data(b'goodbye')
+        channel.on_close()
+        service = self.manager.get_service('echo')
+        self.assertTrue(self.wait_for(lambda: not service._connections))
+        self.assertEqual(self.m2m.received[1], b'goodbye')
+
+    def test_connect_error(self):
+        """Test a connection that is refused closes the channel"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.manager.add_service('closed', port)
+        self.manager.open(1, service='closed')
+        self.assertTrue(self.m2m.wait(lambda: 1 in self.m2m.closed))
@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import json
+import threading
+import time
+import unittest
+import zlib
+
+from dataplicity.m2m.remoteprocess import RemoteProcess
+from dataplicity.reactor import Reactor
+from dataplicity.tests.test_portforward import LoopbackM2M
+
+
+def wait_for(predicate, timeout=5):
+    for _ in range(int(timeout * 100)):
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestRemoteProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor(name="pty")
+        self.reactor.start()
+        self.m2m = LoopbackM2M()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.reactor.join(5)
+
+    def launch(self, command, channel_no=1):
+        process = RemoteProcess(command, self.m2m.get_channel(channel_no), self.reactor)
+        process.start()
+        return process
+
+    def test_terminals(self):
+        """Test many processes are handled by the reactor thread"""
+        thread_count = threading.active_count()
+        processes = [self.launch('cat', channel_no) for channel_no in range(1, 21)]
+        for channel_no in range(1, 21):
+            self.m2m.channels[channel_no].on_data(b'hello\n' * 100)
+        # Echoed by the pty, and written back by cat
+        self.assertTrue(self.m2m.wait(lambda: all(
+            self.m2m.received[channel_no].count(b'hello') == 200
+            for channel_no in range(1, 21)
+        ), timeout=10))
+        self.assertEqual(threading.active_count(), thread_count)
+
+        for process in processes:
+            process.channel.on_close()
+        self.assertTrue(wait_for(lambda: all(process.is_closed for process in processes)))
+        self.assertEqual(processes[0].exit_status, 9)
+
+    def test_exit(self):
+        """Test the channel is closed when the process exits"""
+        process = self.launch('echo goodbye')
+        self.assertTrue(self.m2m.wait(lambda: 1 in self.m2m.closed))
+        self.assertTrue(wait_for(lambda: process.is_closed))
+        self.assertEqual(self.m2m.received[1], b'goodbye\r\n')
+        self.assertEqual(process.exit_status, 0)
+
+    def test_terminal_options(self):
+        """Test compression and screen diffs are negotiated with a control packet"""
+        # Clears the screen, then redraws the same line
+        process = RemoteProcess(
+            'sh -c \'printf "\\033[H\\033[2J"; for i in $(seq 100); do printf "\\033[Hhello\\r\\n"; done; sleep 0.5\'',
+            self.m2m.get_channel(1), self.reactor
+        )
+        process.channel.on_control(json.dumps({
+            "type": "terminal_options",
+            "compression": ["gzip", "deflate"],
+            "screen_diff": True
+        }))
+        process.start()
+        self.assertTrue(self.m2m.wait(lambda: self.m2m.controls[1]))
+        self.assertEqual(json.loads(self.m2m.controls[1][0].decode('utf-8')),
+                         {"type": "terminal_options", "compression": "deflate", "screen_diff": True})
+        self.assertTrue(self.m2m.wait(lambda: 1 in self.m2m.closed))
+        output = zlib.decompressobj().decompress(self.m2m.received[1])
+        self.assertIn(b'hello', output)
+        # Only the final screen is sent, not every redraw
+        self.assertEqual(output.count(b'hello'), 1)
+
+    def test_session(self):
+        """Test a session keeps running when its channel closes, and replays output when attached"""
+        process = RemoteProcess('cat', self.m2m.get_channel(1), self.reactor, session='s1')
+        process.start()
+        process.channel.on_data(b'before\n')
+        self.assertTrue(self.m2m.wait(lambda: self.m2m.received[1].count(b'before') == 2))
+        # Connection lost
+        self.m2m.channels[1].on_close()
+        self.assertTrue(wait_for(lambda: process.is_detached))
+        self.assertFalse(process.is_closed)
+
+        process.attach(self.m2m.get_channel(2))
+        self.m2m.channels[2].on_data(b'after\n')
+        self.assertTrue(self.m2m.wait(lambda: self.m2m.received[2].count(b'after') == 2))
+        self.assertEqual(self.m2m.received[2].count(b'before'), 2)
+
+        # Attaching another channel takes over the session
+        process.attach(self.m2m.get_channel(3))
+        self.assertTrue(self.m2m.wait(lambda: 2 in self.m2m.closed))
+        self.assertFalse(process.is_closed)
+        self.assertTrue(self.m2m.received[3].startswith(self.m2m.received[2]))
+        process.close()
+        self.assertTrue(wait_for(lambda: process.is_closed))
+
+    def test_detach_timeout(self):
+        """Test a detached session is closed after the detach timeout"""
+        process = RemoteProcess('cat', self.m2m.get_channel(1), self.reactor, session='s1', detach_timeout=0.2)
+        process.start()
+        process.detach()
+        self.assertTrue(wait_for(lambda: process.is_detached))
+        self.assertFalse(process.is_closed)
+        self.assertTrue(wait_for(lambda: process.is_closed))
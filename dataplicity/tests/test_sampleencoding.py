@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import json
+import math
+
+from dataplicity.client.sampleencoding import encode_samples, decode_samples, SampleEncodingError
+
+
+class TestSampleEncoding(unittest.TestCase):
+    """Check the compact sample encoding round trips"""
+
+    def test_regular_floats(self):
+        """Test regular interval float samples"""
+        timestamps = [1450000000.25 + n * 5.0 for n in range(1000)]
+        values = [round(math.sin(n / 10.0), 2) for n in range(1000)]
+        encoded = encode_samples(timestamps, values)
+        decoded_timestamps, decoded_values = decode_samples(encoded)
+        self.assertEqual(decoded_values, values)
+        for a, b in zip(timestamps, decoded_timestamps):
+            self.assertAlmostEqual(a, b, places=6)
+        self.assertLess(len(encoded) * 2, len(json.dumps(list(zip(timestamps, values)))))
+
+    def test_slowly_changing(self):
+        """Test the typical system sampler case, where values rarely change"""
+        timestamps = [1450000000.0 + n * 60.0 for n in range(1000)]
+        values = [3858.5 if n < 500 else 3860.25 for n in range(1000)]
+        encoded = encode_samples(timestamps, values)
+        self.assertEqual(decode_samples(encoded), (timestamps, values))
+        self.assertLess(len(encoded) * 10, len(json.dumps(list(zip(timestamps, values)))))
+
+    def test_integers(self):
+        """Test integer values and irregular timestamps"""
+        timestamps = [0, 1, 3, 2, 100000, 100000]
+        values = [0, -1, 2 ** 40, -2 ** 62, 5, 5]
+        self.assertEqual(decode_samples(encode_samples(timestamps, values)),
+                         ([float(t) for t in timestamps], values))
+
+    def test_special_floats(self):
+        """Test floats that XOR to use every byte"""
+        values = [0.0, -0.0, 1e308, -1e-308, float('inf'), 1.5, 1.5, 3.0]
+        timestamps = list(range(len(values)))
+        self.assertEqual(decode_samples(encode_samples(timestamps, values))[1], values)
+
+    def test_empty(self):
+        self.assertEqual(decode_samples(encode_samples([], [])), ([], []))
+
+    def test_errors(self):
+        with self.assertRaises(SampleEncodingError):
+            encode_samples([1.0], [])
+        encoded = encode_samples([1.0, 2.0], [1.5, 2.5])
+        with self.assertRaises(SampleEncodingError):
+            decode_samples(encoded[:-4])
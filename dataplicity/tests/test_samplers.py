@@ -6,8 +6,13 @@ import tempfile
 import shutil
 
 import os
+import time
+from os.path import getsize
 
-from dataplicity.client.sampler import Sampler
+from dataplicity import errors
+from dataplicity.client import sampler as sampler_module
+from dataplicity.client.aggregate import Aggregator
+from dataplicity.client.sampler import Sampler, RingSampler, SamplerManager, sample_columns, column_to_list
 
 
 class TestSamplers(unittest.TestCase):
@@ -122,3 +127,211 @@ class TestSamplers(unittest.TestCase):
             do_check('signed', time_format, convert(test_signed_integer_samples), ['h', 'l', 'q'])
             do_check('unsigned', time_format, convert(test_unsigned_integer_samples), ['h', 'l', 'q'])
             do_check('float', time_format, convert(test_float_samples), ['f', 'd'])
+
+    def test_ring_sampler(self):
+        """Test the ring sampler overwrites old samples and survives re-opening"""
+        path = os.path.join(self.temp_dir, 'ring')
+        sampler = RingSampler(path, "ring", max_samples=4)
+
+        for n in range(6):
+            self.assertTrue(sampler.add_sample(float(n), float(n * 10)))
+        self.assertEqual(sampler.read_samples(),
+                         [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0), (5.0, 50.0)])
+        sampler.close()
+
+        # Re-open, samples should still be there
+        sampler = RingSampler(path, "ring", max_samples=4)
+        self.assertEqual(sampler.count, 4)
+        sampler.add_sample(6.0, 60.0)
+
+        samples = sampler.snapshot_samples()
+        self.assertEqual(samples, [(3.0, 30.0), (4.0, 40.0), (5.0, 50.0), (6.0, 60.0)])
+        self.assertEqual(sampler.read_samples(), [])
+
+        # Sampling continues while the snapshot exists
+        sampler.add_sample(7.0, 70.0)
+        self.assertEqual(sampler.snapshot_samples(), samples)
+        sampler.remove_snapshot()
+        self.assertEqual(sampler.snapshot_samples(), [(7.0, 70.0)])
+
+        # Samples added after closing re-open the ring
+        sampler.close()
+        sampler.add_sample(8.0, 80.0)
+        sampler.close()
+        sampler.add_samples([9.0], [90.0])
+        self.assertEqual(sampler.read_samples(), [(8.0, 80.0), (9.0, 90.0)])
+        sampler.close()
+        sampler.reset()
+        self.assertEqual(sampler.count, 0)
+
+        # A different capacity resets the ring
+        sampler.close()
+        sampler = RingSampler(path, "ring", max_samples=8)
+        self.assertEqual(sampler.read_samples(), [])
+        sampler.close()
+
+    def test_read_samples_array(self):
+        """Test reading samples as an array matches reading samples as tuples"""
+        samples = [(1, 1), (2, -2), (3, 4)]
+        for sampler_cls in (Sampler, RingSampler):
+            for time_format, value_format in [('d', 'd'), ('f', 'l'), ('i', 'q'), ('l', 'h')]:
+                path = os.path.join(self.temp_dir, 'array_{}_{}{}'.format(sampler_cls.storage, time_format, value_format))
+                sampler = sampler_cls(path, "array", time_format=time_format, value_format=value_format)
+                for t, v in samples:
+                    sampler.add_sample(t, v)
+                expected = sampler.read_samples()
+                for read in (sampler.read_samples_array, sampler.snapshot_samples_array):
+                    timestamps, values = sample_columns(read())
+                    self.assertEqual(list(zip(column_to_list(timestamps), column_to_list(values))), expected)
+                sampler.close()
+
+    def test_read_samples_array_fallback(self):
+        """Test reading an array without NumPy returns tuples"""
+        numpy = sampler_module.numpy
+        sampler_module.numpy = None
+        try:
+            sampler = RingSampler(os.path.join(self.temp_dir, 'fallback'), "fallback")
+            sampler.add_sample(1.0, 2.0)
+            self.assertEqual(sampler.read_samples_array(), [(1.0, 2.0)])
+            self.assertEqual(sample_columns(sampler.snapshot_samples_array()), ([1.0], [2.0]))
+            sampler.close()
+        finally:
+            sampler_module.numpy = numpy
+
+    def test_read_samples_array_unsupported_format(self):
+        """Test reading an array in a format NumPy doesn't support returns tuples"""
+        for sampler_cls in (Sampler, RingSampler):
+            path = os.path.join(self.temp_dir, 'bool_' + sampler_cls.storage)
+            sampler = sampler_cls(path, "bool", time_format='d', value_format='?')
+            sampler.add_samples([1.0, 2.0], [True, False])
+            self.assertEqual(sampler.read_samples_array(), [(1.0, True), (2.0, False)])
+            self.assertEqual(sampler.snapshot_samples_array(), [(1.0, True), (2.0, False)])
+            sampler.close()
+
+    def test_add_samples(self):
+        """Test batched and buffered sample ingestion"""
+        timestamps = [float(n) for n in range(10)]
+        values = [float(n * 2) for n in range(10)]
+        for sampler_cls in (Sampler, RingSampler):
+            path = os.path.join(self.temp_dir, 'batch_' + sampler_cls.storage)
+            sampler = sampler_cls(path, "batch", buffer_size=100, buffer_time=60.0)
+            sampler.add_samples(timestamps[:5], values[:5])
+            for t, v in zip(timestamps[5:], values[5:]):
+                sampler.add_sample(t, v)
+            # Samples are buffered until read
+            self.assertEqual(sampler._buffer_count, 10)
+            self.assertEqual(sampler.read_samples(), list(zip(timestamps, values)))
+            self.assertEqual(sampler._buffer_count, 0)
+
+            # Buffer flushed when full
+            sampler.buffer_size = 3
+            sampler.add_samples(timestamps[:2], values[:2])
+            self.assertEqual(sampler._buffer_count, 2)
+            sampler.add_sample(2.0, 4.0)
+            self.assertEqual(sampler._buffer_count, 0)
+
+            # Buffer flushed when the oldest sample is too old
+            sampler.buffer_time = 0.0
+            sampler.add_sample(3.0, 6.0)
+            self.assertEqual(sampler._buffer_count, 0)
+
+            # Buffered samples go in to the snapshot
+            sampler.buffer_time = 60.0
+            sampler.add_sample(4.0, 8.0)
+            self.assertEqual(len(sampler.snapshot_samples()), 15)
+            sampler.close()
+
+    def test_add_samples_length(self):
+        """Test batches with mismatched timestamps and values are rejected"""
+        numpy = sampler_module.numpy
+        try:
+            for numpy_module in (numpy, None):
+                sampler_module.numpy = numpy_module
+                sampler = Sampler(os.path.join(self.temp_dir, 'length'), "length")
+                with self.assertRaises(ValueError):
+                    sampler.add_samples([1.0, 2.0, 3.0], [1.0, 2.0])
+                self.assertEqual(sampler.read_samples(), [])
+        finally:
+            sampler_module.numpy = numpy
+
+    def test_buffer_time(self):
+        """Test buffered samples are written after buffer_time, when no more samples are added"""
+        manager = SamplerManager(self.temp_dir)
+        sampler = Sampler(os.path.join(self.temp_dir, 'idle'), "idle", buffer_size=100, buffer_time=0.1)
+        manager.add_sampler("idle", sampler)
+        try:
+            sampler.add_sample(1.0, 2.0)
+            self.assertEqual(sampler._buffer_count, 1)
+            for _ in range(100):
+                if getsize(sampler.samples_path) > len(sampler.header):
+                    break
+                time.sleep(0.02)
+            self.assertEqual(getsize(sampler.samples_path), len(sampler.header) + sampler.sample_size)
+            self.assertEqual(sampler._buffer_count, 0)
+        finally:
+            manager.close()
+
+    def test_add_samples_full(self):
+        """Test batches are truncated / wrapped when the sampler is full"""
+        timestamps = [float(n) for n in range(7)]
+        sampler = Sampler(os.path.join(self.temp_dir, 'full_file'), "full", max_samples=5)
+        self.assertFalse(sampler.add_samples(timestamps, timestamps))
+        self.assertEqual(sampler.read_samples(), list(zip(timestamps[:5], timestamps[:5])))
+        self.assertFalse(sampler.add_sample(8.0, 8.0))
+
+        sampler = RingSampler(os.path.join(self.temp_dir, 'full_ring'), "full", max_samples=5)
+        sampler.add_samples(timestamps[:3], timestamps[:3])
+        self.assertTrue(sampler.add_samples(timestamps, timestamps))
+        self.assertEqual(sampler.read_samples(), list(zip(timestamps[2:], timestamps[2:])))
+        sampler.add_samples(timestamps[:4], timestamps[:4])
+        self.assertEqual(sampler.read_samples(), [(6.0, 6.0), (0.0, 0.0), (1.0, 1.0), (2.0, 2.0), (3.0, 3.0)])
+        sampler.close()
+
+    def test_aggregate(self):
+        """Test aggregation pipelines"""
+        timestamps = [0.0, 0.5, 1.0, 1.5, 2.0, 2.5]
+        values = [1.0, 1.05, 3.0, 3.0, 5.0, 5.01]
+
+        def run(*spec):
+            return Aggregator.from_spec(spec)(timestamps, values)
+
+        self.assertEqual(run('deadband 0.1'), ([0.0, 1.0, 2.0, 2.5], [1.0, 3.0, 5.0, 5.01]))
+        self.assertEqual(run('min 1'), ([0.0, 1.0, 2.0], [1.0, 3.0, 5.0]))
+        self.assertEqual(run('max 1'), ([0.0, 1.0, 2.0], [1.05, 3.0, 5.01]))
+        t, v = run('mean 2', 'max 10')
+        self.assertEqual(t, [0.0])
+        self.assertAlmostEqual(v[0], 5.005)
+        self.assertEqual(run('lttb 10'), (timestamps, values))
+
+        t, v = run('lttb 4')
+        self.assertEqual(len(t), 4)
+        self.assertEqual((t[0], t[-1]), (0.0, 2.5))
+
+        for spec in (['median 1'], ['mean'], ['lttb 1.5']):
+            with self.assertRaises(errors.ConfigError):
+                Aggregator.from_spec(spec)
+
+    @unittest.skipIf(sampler_module.numpy is None, "requires NumPy")
+    def test_aggregate_arrays(self):
+        """Test aggregating arrays gives the same results as aggregating lists"""
+        numpy = sampler_module.numpy
+        random = numpy.random.RandomState(1)
+        timestamps = numpy.cumsum(random.uniform(0.0, 1.0, 1000))
+        for values in (random.normal(0.0, 1.0, 1000), random.randint(0, 255, 1000).astype('u1')):
+            for spec in (['deadband 0.5'], ['min 5'], ['max 5'], ['mean 5'], ['lttb 50'], ['deadband 1', 'mean 2', 'lttb 20']):
+                aggregator = Aggregator.from_spec(spec)
+                array_timestamps, array_values = aggregator(timestamps, values)
+                self.assertIsInstance(array_values, numpy.ndarray)
+                list_timestamps, list_values = aggregator(timestamps.tolist(), values.tolist())
+                self.assertEqual(array_timestamps.tolist(), list_timestamps)
+                for array_value, list_value in zip(array_values.tolist(), list_values):
+                    self.assertAlmostEqual(array_value, list_value)
+                self.assertEqual(len(array_values), len(list_values))
+
+    def test_sampler_aggregate(self):
+        """Test the sampler applies its aggregator to snapshots"""
+        sampler = RingSampler(os.path.join(self.temp_dir, 'aggregate'), "aggregate",
+                              aggregator=Aggregator.from_spec(['mean 10']))
+        sampler.add_samples([1.0, 2.0, 11.0], [1.0, 3.0, 5.0])
+        self.assertEqual(sampler.aggregate(sampler.snapshot_samples_array()), ([0.0, 10.0], [2.0, 5.0]))
+        sampler.close()
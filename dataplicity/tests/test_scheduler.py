@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import threading
+import unittest
+
+from dataplicity.m2m import bencode
+from dataplicity.m2m.scheduler import (SendScheduler, PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def drain(self, scheduler):
+        packets = []
+        while 1:
+            packet = scheduler.pop()
+            if packet is None:
+                return packets
+            packets.append(packet[0])
+
+    def test_round_robin(self):
+        """Test channels share by bytes, not packets"""
+        scheduler = SendScheduler(quantum=1000)
+        for _ in range(4):
+            scheduler.put(b'a' * 1000, channel=1, priority=PRIORITY_BULK)
+        for _ in range(8):
+            scheduler.put(b'b' * 250, channel=2, priority=PRIORITY_BULK)
+        self.assertEqual(len(scheduler), 6000)
+        sent = [packet[:1] for packet in self.drain(scheduler)]
+        self.assertEqual(sent, [b'a', b'b', b'b', b'b', b'b', b'a', b'b', b'b', b'b', b'b', b'a', b'a'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_priority(self):
+        """Test control packets, then interactive channels, are sent before bulk channels"""
+        scheduler = SendScheduler()
+        scheduler.put(b'bulk1', channel=1, priority=PRIORITY_BULK)
+        scheduler.put(b'bulk2', channel=1, priority=PRIORITY_BULK)
+        scheduler.put(b'key', channel=2, priority=PRIORITY_INTERACTIVE)
+        scheduler.put(b'pong')
+        self.assertEqual(self.drain(scheduler), [b'pong', b'key', b'bulk1', b'bulk2'])
+
+    def test_coalesce(self):
+        """Test small writes to a channel are merged"""
+        scheduler = SendScheduler(max_delay=0.05, max_frame_size=10)
+        sent = []
+        for n in range(3):
+            scheduler.put_data(1, b'abc', on_sent=lambda n=n: sent.append(n))
+        self.assertIsNone(scheduler.pop())
+        self.assertGreater(scheduler.wait_time(), 0)
+
+        packet_bytes, on_sent = scheduler.get(timeout=5)
+        self.assertEqual(bencode.decode(packet_bytes), [5, 1, b'abcabcabc'])
+        on_sent()
+        self.assertEqual(sent, [0, 1, 2])
+
+        # A full frame is sent without waiting
+        scheduler.put_data(1, b'abcdef')
+        scheduler.put_data(1, b'ghijkl')
+        self.assertEqual(bencode.decode(scheduler.pop()[0]), [5, 1, b'abcdef'])
+        self.assertIsNone(scheduler.pop())
+
+    def test_close(self):
+        """Test closing releases waiting writers and readers"""
+        scheduler = SendScheduler()
+        sent = []
+        scheduler.put(b'data', channel=1, on_sent=lambda: sent.append(1))
+        self.assertEqual(scheduler.get()[0], b'data')
+        scheduler.put(b'data', channel=1, on_sent=lambda: sent.append(2))
+        scheduler.close()
+        self.assertEqual(sent, [2])
+        self.assertIsNone(scheduler.get())
+
+        scheduler = SendScheduler()
+        threading.Timer(0.05, scheduler.close).start()
+        self.assertIsNone(scheduler.get(timeout=5))
@@ -0,0 +1,80 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+
+from dataplicity.m2m.screen import Screen, ScreenDiffFilter
+
+
+def replay(data, columns=40, rows=10):
+    """Get the lines and cursor of a terminal that displays `data`."""
+    screen = Screen(columns, rows)
+    screen.reset(alternate=True)
+    text = data.decode('utf-8')
+    while text:
+        count = screen.feed(text)
+        if count is None:
+            break
+        text = text[count:]
+    return screen.lines, (screen.x, screen.y)
+
+
+class TestScreen(unittest.TestCase):
+
+    def filter(self, data, chunk_size):
+        screen_filter = ScreenDiffFilter(40, 10)
+        output = b''
+        for pos in range(0, len(data), chunk_size):
+            output += screen_filter.feed(data[pos:pos + chunk_size])
+        return screen_filter, output + screen_filter.render()
+
+    def test_render(self):
+        """Test the remote screen ends up the same as if the output was sent unchanged"""
+        data = (
+            '\x1b[?1049h\x1b[H\x1b[2J'
+            '\x1b[1;31mtitle\x1b[0m\r\n'
+            'one\r\ntwo\r\nthree\x1b[3;10H\x1b[7mbox\x1b[27m'
+            '\x1b[5;1Héè and long line that wraps past the last column of the screen'
+            '\x1b[2;1H\x1b[K\x1b[8;5r\x1b[8;1H\n\nscrolled\x1b[r\x1b[10;40H'
+        ).encode('utf-8')
+        for chunk_size in (1, 3, 7, len(data)):
+            screen_filter, output = self.filter(data, chunk_size)
+            self.assertTrue(screen_filter.active)
+            self.assertEqual(replay(output), replay(data))
+
+    def test_redraw(self):
+        """Test redrawing the same screen sends nothing"""
+        frame = '\x1b[H' + ''.join('\x1b[{};1Hline {}'.format(row, row) for row in range(1, 11))
+        screen_filter = ScreenDiffFilter(40, 10)
+        screen_filter.feed(('\x1b[?1049h' + frame).encode('utf-8'))
+        screen_filter.render()
+        self.assertEqual(screen_filter.feed((frame * 10).encode('utf-8')), b'')
+        self.assertEqual(screen_filter.render(), b'')
+
+    def test_leave(self):
+        """Test output is sent unchanged after leaving the alternate screen"""
+        screen_filter = ScreenDiffFilter(40, 10)
+        output = screen_filter.feed(b'\x1b[?1049hfull screen\x1b[?1049lprompt$ ')
+        self.assertFalse(screen_filter.active)
+        self.assertTrue(output.startswith(b'\x1b[?1049h'))
+        self.assertTrue(output.endswith(b'\x1b[?1049lprompt$ '))
+        self.assertEqual(screen_filter.feed(b'ls\r\n'), b'ls\r\n')
+
+    def test_scroll(self):
+        """Test output that scrolls the normal screen is sent unchanged"""
+        screen_filter = ScreenDiffFilter(40, 10)
+        screen_filter.feed(b'\x1b[H\x1b[2J')
+        self.assertTrue(screen_filter.active)
+        lines = b''.join(b'line ' + str(n).encode('ascii') + b'\r\n' for n in range(20))
+        output = screen_filter.feed(lines)
+        self.assertFalse(screen_filter.active)
+        self.assertTrue(output.endswith(b'line 19\r\n'))
+
+    def test_partial_escape(self):
+        """Test an escape code split between reads is held back"""
+        screen_filter = ScreenDiffFilter(40, 10)
+        self.assertEqual(screen_filter.feed(b'hello\x1b['), b'hello')
+        self.assertTrue(screen_filter.pending)
+        self.assertEqual(screen_filter.feed(b'1mworld'), b'\x1b[1mworld')
+        self.assertEqual(screen_filter.feed(b'\x1b'), b'')
+        self.assertEqual(screen_filter.render(), b'\x1b')
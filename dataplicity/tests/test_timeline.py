@@ -0,0 +1,254 @@
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import unittest
+import tempfile
+import shutil
+
+import json
+import os
+import time
+from base64 import b64encode
+from io import BytesIO
+
+from dataplicity.jsonrpc import StreamedBase64
+from dataplicity.client.eventlog import EventLog
+from dataplicity.client.timeline import Timeline, TimelineFullError
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp('dptest')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_put_delete(self):
+        """Test writing, overwriting and deleting records"""
+        event_log = EventLog(self.temp_dir)
+        event_log.put('a', b'alpha')
+        event_log.put('b', b'beta')
+        event_log.put('a', b'aleph')
+        self.assertEqual(len(event_log), 2)
+        self.assertEqual(event_log.items(), [('b', b'beta'), ('a', b'aleph')])
+        self.assertEqual(event_log.delete(['b', 'missing']), 1)
+        self.assertEqual(event_log.keys(), ['a'])
+        self.assertRaises(KeyError, event_log.get, 'b')
+        event_log.close()
+
+        # Replaying the segments gives the same index
+        event_log = EventLog(self.temp_dir)
+        self.assertEqual(event_log.items(), [('a', b'aleph')])
+        event_log.close()
+
+    def test_corrupt_tail(self):
+        """Test a partially written record is ignored"""
+        event_log = EventLog(self.temp_dir)
+        event_log.put('a', b'alpha')
+        event_log.put('b', b'beta')
+        event_log.close()
+        segment_path = os.path.join(self.temp_dir, '00000000.0000.log')
+        with open(segment_path, 'r+b') as f:
+            f.truncate(os.path.getsize(segment_path) - 2)
+
+        event_log = EventLog(self.temp_dir)
+        self.assertEqual(event_log.keys(), ['a'])
+        event_log.put('c', b'gamma')
+        event_log.close()
+        event_log = EventLog(self.temp_dir)
+        self.assertEqual(event_log.items(), [('a', b'alpha'), ('c', b'gamma')])
+        event_log.close()
+
+    def test_compact(self):
+        """Test compaction keeps live records and removes old segments"""
+        event_log = EventLog(self.temp_dir, segment_size=256, background=False, compact_min_bytes=1024)
+        for n in range(100):
+            event_log.put('event{}'.format(n), b'x' * 20)
+        event_log.delete(['event{}'.format(n) for n in range(90)])
+        self.assertEqual(event_log.keys(), ['event{}'.format(n) for n in range(90, 100)])
+        self.assertEqual(event_log.garbage, 0)
+        self.assertLess(len(os.listdir(self.temp_dir)), 5)
+        event_log.put('event100', b'y')
+        event_log.close()
+
+        event_log = EventLog(self.temp_dir)
+        self.assertEqual(len(event_log), 11)
+        self.assertEqual(event_log.get('event95'), b'x' * 20)
+        self.assertEqual(event_log.get('event100'), b'y')
+        event_log.close()
+
+    def test_compact_overwrites(self):
+        """Test a log that is only overwritten is compacted"""
+        event_log = EventLog(self.temp_dir, segment_size=256, background=False, compact_min_bytes=1024)
+        for n in range(200):
+            event_log.put('status', 'status {}'.format(n).encode('utf-8'))
+        self.assertLess(event_log.garbage, 1024)
+        self.assertLess(len(os.listdir(self.temp_dir)), 10)
+        self.assertEqual(event_log.items(), [('status', b'status 199')])
+        event_log.close()
+
+    def test_other_writer(self):
+        """Test records appended by another log on the same directory are seen"""
+        event_log = EventLog(self.temp_dir, segment_size=256)
+        other_log = EventLog(self.temp_dir, segment_size=256)
+        for n in range(20):
+            other_log.put('event{}'.format(n), b'x' * 20)
+        event_log.put('mine', b'y')
+        self.assertEqual(len(event_log), 21)
+        event_log.delete(['event{}'.format(n) for n in range(20)])
+        event_log.compact()
+        self.assertEqual(other_log.items(), [('mine', b'y')])
+        other_log.put('other', b'z')
+        self.assertEqual(event_log.keys(), ['mine', 'other'])
+        other_log.close()
+        event_log.close()
+
+    def test_compact_tmp_files(self):
+        """Test compaction only removes tmp files left by processes that have exited"""
+        event_log = EventLog(self.temp_dir, segment_size=256, background=False)
+        # One being written by a running process, and one left by a process that has exited
+        running_path = os.path.join(self.temp_dir, '00000005.0001.log.1.tmp')
+        exited_pid = os.fork()
+        if not exited_pid:
+            os._exit(0)
+        os.waitpid(exited_pid, 0)
+        exited_path = os.path.join(self.temp_dir, '00000006.0001.log.{}.tmp'.format(exited_pid))
+        for path in (running_path, exited_path):
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+        for n in range(20):
+            event_log.put('event{}'.format(n), b'x' * 20)
+        event_log.compact()
+        self.assertTrue(os.path.exists(running_path))
+        self.assertFalse(os.path.exists(exited_path))
+        event_log.close()
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp('dptest')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_events(self):
+        """Test writing, reading and clearing events"""
+        timeline = Timeline(self.temp_dir, 'test', max_events=2)
+        with timeline.new_event('TEXT', timestamp=200, text='second', event_id='b'):
+            pass
+        with timeline.new_event('TEXT', timestamp=100, text='first', event_id='a') as event:
+            event.attach_bytes(b'hello', filename='hello.txt')
+        self.assertRaises(TimelineFullError, timeline.new_event, 'TEXT')
+
+        events = timeline.get_events()
+        self.assertEqual([event['text'] for event in events], ['first', 'second'])
+        self.assertEqual(events[0]['attachments'][0]['data'], 'aGVsbG8=')
+
+        timeline.clear_events(['a'])
+        self.assertEqual([event['event_id'] for event in timeline.get_events()], ['b'])
+        timeline.clear_all()
+        self.assertEqual(len(timeline), 0)
+        timeline.close()
+
+    def test_migrate(self):
+        """Test events from JSON files are moved in to the log"""
+        event = {"event_id": "TEXT_100_1", "timestamp": 100, "event_type": "TEXT", "text": "old"}
+        with open(os.path.join(self.temp_dir, 'TEXT_100_1.json'), 'wb') as f:
+            f.write(json.dumps(event).encode('utf-8'))
+        timeline = Timeline(self.temp_dir, 'test')
+        self.assertEqual(timeline.get_events(), [event])
+        self.assertFalse([filename for filename in os.listdir(self.temp_dir) if filename.endswith('.json')])
+        timeline.close()
+
+    def test_overwrite_slot(self):
+        """Test overwrite events are only written when their content changes"""
+        timeline = Timeline(self.temp_dir, 'test', max_events=1)
+
+        def write_status(text, timestamp):
+            timeline.new_event('TEXT', timestamp=timestamp, text=text, overwrite=True, hide=True, event_id='status').write()
+
+        write_status('idle', 100)
+        write_status('idle', 200)
+        self.assertEqual(timeline.event_log.garbage, 0)
+        self.assertEqual([event['timestamp'] for event in timeline.get_events()], [100])
+
+        write_status('busy', 300)
+        self.assertEqual([event['text'] for event in timeline.get_events()], ['busy'])
+
+        # Once synced, an unchanged slot isn't sent again
+        timeline.clear_events(['status'])
+        write_status('busy', 400)
+        self.assertEqual(timeline.get_events(), [])
+        write_status('idle', 500)
+        self.assertEqual([event['timestamp'] for event in timeline.get_events()], [500])
+        timeline.close()
+
+    def test_attachments(self):
+        """Test attachments are stored once, streamed, and removed when no longer referenced"""
+        timeline = Timeline(self.temp_dir, 'test')
+        photo_path = os.path.join(self.temp_dir, 'photo.jpg')
+        with open(photo_path, 'wb') as f:
+            f.write(b'\xff\xd8' * 1000)
+        with timeline.new_event('TEXT', timestamp=100, event_id='a') as event:
+            event.attach_file(photo_path, name='photo')
+        timeline.new_photo(BytesIO(b'\xff\xd8' * 1000), timestamp=200, event_id='b').write()
+        self.assertEqual(len(timeline.blobs.blob_ids()), 1)
+
+        events = timeline.get_events()
+        self.assertEqual(events[0]['attachments'][0]['data'], b64encode(b'\xff\xd8' * 1000).decode('ascii'))
+        self.assertNotIn('blob', events[0]['attachments'][0])
+        streamed = timeline.get_events(stream=True)[1]['attachments'][0]['data']
+        self.assertIsInstance(streamed, StreamedBase64)
+        self.assertEqual(b''.join(streamed.iter_chunks()), events[1]['attachments'][0]['data'].encode('ascii'))
+
+        timeline.clear_events(['a'])
+        self.assertEqual(len(timeline.blobs.blob_ids()), 1)
+        timeline.clear_events(['b'])
+        self.assertEqual(timeline.blobs.blob_ids(), [])
+        timeline.close()
+
+    def test_unreferenced_blobs(self):
+        """Test only unreferenced blobs older than the grace period are removed"""
+        timeline = Timeline(self.temp_dir, 'test')
+        # As stored by another process that hasn't written its event yet
+        new_blob_id, _ = timeline.blobs.add_bytes(b'new')
+        old_blob_id, _ = timeline.blobs.add_bytes(b'old')
+        old_time = time.time() - Timeline.blob_grace_period - 60
+        os.utime(timeline.blobs.get_path(old_blob_id), (old_time, old_time))
+        timeline.close()
+
+        timeline = Timeline(self.temp_dir, 'test')
+        self.assertEqual(timeline.blobs.blob_ids(), [new_blob_id])
+
+        # Storing a blob again counts as new
+        os.utime(timeline.blobs.get_path(new_blob_id), (old_time, old_time))
+        timeline.blobs.add_bytes(b'new')
+        timeline.clear_all()
+        self.assertEqual(timeline.blobs.blob_ids(), [new_blob_id])
+        timeline.close()
+
+    def test_cursor(self):
+        """Test reading events in pages bounded by count and size"""
+        timeline = Timeline(self.temp_dir, 'test')
+        for n in range(10):
+            timeline.new_event('TEXT', timestamp=n, text='x' * 100, event_id='e{}'.format(n)).write()
+        timeline.new_event('TEXT', timestamp=10, text='x' * 1000, event_id='big').write()
+
+        event_size = len(timeline.event_log.get('e0'))
+        page_bytes = event_size * 3 + 10
+
+        cursor = timeline.get_cursor()
+        events, size = cursor.next_page(4, 100000)
+        self.assertEqual([event['event_id'] for event in events], ['e0', 'e1', 'e2', 'e3'])
+        events, size = cursor.next_page(100, page_bytes)
+        self.assertEqual([event['event_id'] for event in events], ['e4', 'e5', 'e6'])
+        self.assertLessEqual(size, page_bytes)
+        events, size = cursor.next_page(100, page_bytes)
+        self.assertEqual([event['event_id'] for event in events], ['e7', 'e8', 'e9'])
+        self.assertEqual(cursor.next_page(100, page_bytes, force=False), ([], 0))
+        events, size = cursor.next_page(100, page_bytes)
+        self.assertEqual([event['event_id'] for event in events], ['big'])
+        self.assertTrue(cursor.exhausted)
+        timeline.close()
@@ -0,0 +1,345 @@
+"""
+HTTP transport for calls to the dataplicity api.
+
+Connections are kept open between requests, so a sync doesn't pay for a new TCP connection and
+TLS handshake every time. When a new connection is needed (typically because the server closed
+an idle one), the TLS session from the previous connection is resumed, where the ssl module
+supports it.
+
+Responses may be compressed with gzip or deflate, and are decompressed as they are read.
+
+Requests are retried with exponential backoff if a connection can't be made, or the server
+responds with 502 or 503 (not 504, since the call may have been handled after the gateway gave
+up). A request is only sent again on a new connection if sending it on a kept-alive connection
+failed, or the server closed that connection without sending any of a response; calls that may
+have been handled, such as those that time out waiting for a response, aren't repeated.
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import select
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+from dataplicity.compat import http_client, urlparse, getproxies, proxy_bypass, HTTPError
+
+
+log = logging.getLogger('dataplicity')
+
+
+# ssl module can resume sessions (Python 3.6+)
+_SESSION_RESUMPTION = hasattr(ssl, 'SSLSession')
+
+# Statuses that mean the request wasn't handled, and may be retried
+RETRY_STATUSES = (502, 503)
+
+# Content encodings we can decompress
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class ContentEncodingError(Exception):
+    """The response body couldn't be decoded."""
+
+
+class _Decoder(object):
+    """Incrementally decompresses a response body."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        else:
+            raise ContentEncodingError("unsupported content encoding '{}'".format(encoding))
+        self._first = True
+
+    def decompress(self, data):
+        try:
+            if self._first and self.encoding == 'deflate':
+                self._first = False
+                try:
+                    return self._decompressor.decompress(data)
+                except zlib.error:
+                    # Some servers send raw deflate, without the zlib header
+                    self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(data)
+        except zlib.error as error:
+            raise ContentEncodingError("unable to decode {} response ({})".format(self.encoding, error))
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class _HTTPSConnection(http_client.HTTPSConnection):
+    """An HTTPS connection that resumes a previous TLS session."""
+
+    tls_session = None
+
+    def connect(self):
+        if not _SESSION_RESUMPTION or self.tls_session is None:
+            return http_client.HTTPSConnection.connect(self)
+        http_client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=server_hostname,
+                                              session=self.tls_session)
+
+
+class _ConnectError(Exception):
+    """Wraps an error making a connection, which is safe to retry."""
+
+    def __init__(self, original):
+        self.original = original
+        super(_ConnectError, self).__init__(str(original))
+
+
+class HTTPTransport(object):
+    """Sends HTTP requests over a pool of kept-alive connections. Thread safe.
+
+    `timeout` applies to connecting, and to each read of the response. Up to `max_idle`
+    connections per server are kept, for up to `idle_timeout` seconds.
+
+    """
+
+    # Bytes to read (and decompress) at a time
+    read_size = 64 * 1024
+
+    def __init__(self, timeout=60.0, retries=3, backoff=0.5, max_idle=4, idle_timeout=60.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # Maps (scheme, host, port, proxy) on to a list of (connection, idle since)
+        self._idle = {}
+        self._tls_sessions = {}
+        self._ssl_context = None
+        self.requests = 0
+        self.connections = 0
+        self.tls_resumed = 0
+        self.retried = 0
+
+    def __repr__(self):
+        return "<httptransport {} idle>".format(sum(len(idle) for idle in self._idle.values()))
+
+    @property
+    def metrics(self):
+        """A dict of transport metrics."""
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "tls_resumed": self.tls_resumed,
+            "retried": self.retried
+        }
+
+    @property
+    def ssl_context(self):
+        with self._lock:
+            if self._ssl_context is None and hasattr(ssl, 'create_default_context'):
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context
+
+    @ssl_context.setter
+    def ssl_context(self, context):
+        with self._lock:
+            self._ssl_context = context
+
+    @classmethod
+    def _parse_url(cls, url):
+        """Get the pool key, and the path to request."""
+        parsed_url = urlparse(url)
+        scheme = parsed_url.scheme
+        if scheme not in ('http', 'https'):
+            raise ValueError("unsupported url scheme in '{}'".format(url))
+        host = parsed_url.hostname
+        port = parsed_url.port or (443 if scheme == 'https' else 80)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path = "{}?{}".format(path, parsed_url.query)
+        proxy = None
+        if not proxy_bypass(host):
+            proxy = getproxies().get(scheme)
+        if proxy is not None and scheme == 'http':
+            # Plain http proxies take the full url
+            path = url
+        return (scheme, host, port, proxy), path
+
+    def _connect(self, key):
+        """Make a new connection."""
+        scheme, host, port, proxy = key
+        if proxy is not None:
+            proxy_url = urlparse(proxy if '://' in proxy else 'http://' + proxy)
+            connect_host, connect_port = proxy_url.hostname, proxy_url.port or 8080
+        else:
+            connect_host, connect_port = host, port
+        if scheme == 'https':
+            connection = _HTTPSConnection(connect_host, connect_port, timeout=self.timeout, context=self.ssl_context)
+            if proxy is not None:
+                connection.set_tunnel(host, port)
+            with self._lock:
+                connection.tls_session = self._tls_sessions.get(key)
+        else:
+            connection = http_client.HTTPConnection(connect_host, connect_port, timeout=self.timeout)
+        try:
+            connection.connect()
+        except (socket.error, http_client.HTTPException) as error:
+            connection.close()
+            raise _ConnectError(error)
+        # Requests are often written in more than one send, which Nagle's algorithm would delay
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        if getattr(connection.sock, 'session_reused', False):
+            self.tls_resumed += 1
+        log.debug('connected to %s:%s', host, port)
+        return connection
+
+    @classmethod
+    def _is_closed(cls, connection):
+        """Check if the server has closed an idle connection."""
+        if connection.sock is None:
+            return True
+        try:
+            # An idle connection shouldn't be readable, unless it has been closed
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def _get_connection(self, key):
+        """Get an idle connection, or make a new one. Returns a tuple of (connection, reused)."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                connection, idle_since = idle.pop()
+                if now - idle_since < self.idle_timeout and not self._is_closed(connection):
+                    return connection, True
+                connection.close()
+        return self._connect(key), False
+
+    def _release(self, key, connection):
+        """Return a connection to the pool."""
+        session = getattr(connection.sock, 'session', None)
+        with self._lock:
+            if session is not None:
+                self._tls_sessions[key] = session
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    @classmethod
+    def _read_body(cls, response):
+        """Read the response body, decompressing it if necessary."""
+        encoding = (response.getheader('Content-Encoding') or 'identity').strip().lower()
+        if encoding == 'identity':
+            return response.read()
+        decoder = _Decoder(encoding)
+        chunks = []
+        while 1:
+            chunk = response.read(cls.read_size)
+            if not chunk:
+                break
+            chunks.append(decoder.decompress(chunk))
+        chunks.append(decoder.flush())
+        return b''.join(chunks)
+
+    @classmethod
+    def _nothing_received(cls, error):
+        """Check if an error getting a response means the server closed the connection without
+        responding (as opposed to a timeout, or a failure part way through the response)."""
+        if not isinstance(error, http_client.BadStatusLine):
+            return False
+        # An empty status line is stored as its repr
+        return error.line in ("''", "u''")
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request, and return the response body as bytes.
+
+        `body` may be bytes, or a file-like object. File-like bodies are rewound (by calling
+        `rewind`) if the request has to be sent again. Raises HTTPError if the server responds
+        with an error status.
+
+        """
+        key, path = self._parse_url(url)
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        self.requests += 1
+        attempt = 0
+        while 1:
+            try:
+                connection, reused = self._get_connection(key)
+            except _ConnectError as error:
+                if attempt >= self.retries:
+                    raise error.original
+                log.debug('unable to connect to %s (%s)', url, error)
+            else:
+                if hasattr(body, 'rewind'):
+                    body.rewind()
+                sent = False
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                    sent = True
+                    response = connection.getresponse()
+                except (socket.error, http_client.HTTPException) as error:
+                    connection.close()
+                    # Only resend if the server can't have handled the request
+                    if not reused or attempt >= self.retries or (sent and not self._nothing_received(error)):
+                        raise
+                    log.debug('connection to %s was closed (%s), reconnecting', url, error)
+                    attempt += 1
+                    self.retried += 1
+                    continue
+                try:
+                    data = self._read_body(response)
+                except Exception:
+                    connection.close()
+                    raise
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._release(key, connection)
+                if response.status < 400:
+                    return data
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise HTTPError(url, response.status, response.reason, response.msg, None)
+                log.debug('%s responded with %s', url, response.status)
+            attempt += 1
+            self.retried += 1
+            delay = self.backoff * (2 ** (attempt - 1))
+            log.debug('retrying %s in %.1f seconds', url, delay)
+            time.sleep(delay)
+
+    def post(self, url, body, headers=None):
+        """Send a POST request, and return the response body."""
+        return self.request('POST', url, body=body, headers=headers)
+
+    def close(self):
+        """Close idle connections."""
+        with self._lock:
+            idle_connections = [connection for idle in self._idle.values() for connection, _ in idle]
+            self._idle.clear()
+        for connection in idle_connections:
+            connection.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Get the transport shared by api clients in this process."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HTTPTransport()
+        return _transport
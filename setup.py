@@ -39,5 +39,6 @@ setup(
         'enum34',
         'six',
         'python-daemon==2.1.1',
+        'selectors2; python_version < "3.4"',
     ]
 )